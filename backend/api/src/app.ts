@@ -6,6 +6,8 @@ import prisma from "./libs/db";
 // import meiliClient, { checkMeiliConnection } from "./libs/meili";
 import { auth } from "./libs/auth";
 import { errorHandler } from "./middlewares/errorHandler";
+import { requestId } from "./middlewares/requestId";
+import { refreshAdRotation } from "./utils/adRotation";
 import authRoute from "./routes/authRoutes";
 import systemRoute from "./routes/systemRoutes";
 import userRoute from "./routes/userRoutes";
@@ -33,6 +35,7 @@ import  adminAnalyticsRouter  from "./routes/adminAnalyticsRouter";
 const app = express();
 
 
+app.use(requestId);
 app.use(cors(config.corsOptions));
 
 app.all("/api/auth/{*any}", toNodeHandler(auth));
@@ -140,5 +143,6 @@ app.use(errorHandler);
 
 app.listen(config.port, () => {
     console.log(`Backend listening on port ${config.port}`);
+    refreshAdRotation();
     // checkMeiliConnection();
 });
@@ -6,6 +6,8 @@ import { uploadImageToCloudinary, deleteImageFromCloudinary } from '../libs/clou
 import { uploadAudioToS3, deleteAudioFromS3 } from '../libs/s3Client';
 import { createAdvertisementSchema } from "../validators/advertisementValidator";
 import { uuidSchema, searchSchema, paginationSchema } from '../validators';
+import { queueTranscode } from '../jobs/audioQueue';
+import { refreshAdRotation } from '../utils/adRotation';
 
 
 export const advertisementController = {
@@ -66,6 +68,9 @@ export const advertisementController = {
             }
         });
 
+        queueTranscode(audioId, true);
+        refreshAdRotation();
+
         res.status(201).json({
             success: true,
             message: "Advertisement created successfully",
@@ -96,6 +101,8 @@ export const advertisementController = {
             },
         });
 
+        refreshAdRotation();
+
         res.status(200).json({
             success: true,
             message: "Advertisement updated successfully",
@@ -207,6 +214,8 @@ export const advertisementController = {
 
         //TODO: remove hls segments
 
+        refreshAdRotation();
+
         res.status(200).json({
             success: true,
             message: "Advertisement deleted successfully",
@@ -228,6 +237,8 @@ export const advertisementController = {
                 active: !ad.active,
             }
         });
+        refreshAdRotation();
+
         res.status(200).json({
             success: true,
             message: `Advertisement ${updatedAd.active ? 'activated' : 'deactivated'} successfully`,
@@ -3,50 +3,100 @@ import prisma from '../libs/db';
 import { CustomErrors } from '../errors';
 import { uuidSchema } from "../validators";
 import { redisClient } from "../libs/redis";
-import { generateSignedUrl } from "../utils/generateSignedUrl";
+import { fetchSignedPlaylist, generateSignedUrls } from "../utils/generateSignedUrl";
+import { prefetchStreamSchema, variantStreamSchema } from "../validators/streamValidator";
 
 
-const getPlaylistFromCacheOrGenerate = async (audioId: string, isAdd: boolean = false) => {
+// Playlists of finished tracks are cached for 19 minutes
+// cache minutes must be less than signed url expiration time
+const SIGNED_URL_EXPIRATION = 1200;
+const PLAYLIST_CACHE_SECONDS = 1140;
 
-    const cacheKey = `playlist:${audioId}`;
+const getPlaylistFromCacheOrFetch = async (audioId: string, isAdd: boolean = false, variant?: string): Promise<string | null> => {
 
-    // Try to get the playlist from Redis
-    const cachedPlaylist = await new Promise((resolve, reject) => {
-        redisClient.get(cacheKey, (err, result) => {
-            if (err) reject(err);
-            resolve(result ? JSON.parse(result) : null);
-        });
-    });
+    const cacheKey = `m3u8:${isAdd ? 'add' : 'music'}:${audioId}${variant ? `:${variant}` : ''}`;
 
+    const cachedPlaylist = await redisClient.get(cacheKey);
     if (cachedPlaylist) {
         return cachedPlaylist;
     }
 
-    // If not found in cache, generate a new playlist
-    const newPlaylist = await generateSignedUrl(audioId, isAdd, 1200); // Generate signed URL with 20 minutes expiration
+    // The media service signs the segments into its cached template of the ffmpeg playlist
+    const { m3u8 } = await fetchSignedPlaylist(audioId, isAdd, SIGNED_URL_EXPIRATION, variant);
+    if (!m3u8) {
+        return null;
+    }
 
-    // Cache the playlist in Redis for performance 19 minutes
-    // cache minutes must be less than signed url expiration time
-    if (newPlaylist.length > 0)
-        redisClient.setex(cacheKey, 1140, JSON.stringify(newPlaylist)); // Cache for 19 minutes
+    // a track that is still being transcoded grows, so its playlist (no ENDLIST yet) is never cached;
+    // master playlists of adaptive tracks only point back at the variant playlists
+    if (m3u8.includes('#EXT-X-ENDLIST') || m3u8.includes('#EXT-X-STREAM-INF'))
+        redisClient.setex(cacheKey, PLAYLIST_CACHE_SECONDS, m3u8);
 
-    return newPlaylist;
+    return m3u8;
 };
 
 
+// Playlist of a free listener: the media service stitches the ad breaks into the track's playlist.
+// Not cached here, the ads rotate; the signed segments are cached by the media service.
+const getPlaylistWithAds = async (audioId: string, userId?: string, variant?: string): Promise<string | null> => {
+    const { m3u8, adIds } = await fetchSignedPlaylist(audioId, false, SIGNED_URL_EXPIRATION, variant, true);
 
-// Helper to build M3U8 content from playlist
-const buildM3U8Content = async (playlist: string[]) => {
-    let m3u8Content = '#EXTM3U\n#EXT-X-VERSION:3\n#EXT-X-TARGETDURATION:10\n#EXT-X-MEDIA-SEQUENCE:0\n';
+    if (adIds.length > 0) {
+        recordAdImpressions(audioId, adIds, userId).catch((e) => console.error('Error recording ad impressions', e));
+    }
+    return m3u8;
+};
 
-    playlist.forEach((segmentUrl) => {
-        m3u8Content += `#EXTINF:10.0,\n${segmentUrl}\n`;
+// Players reload the playlist of a track that is still transcoding and fetch every variant of an
+// adaptive one, so a break is only counted the first time a listener gets it within the lifetime
+// of its signed URLs, which is how long the media service keeps serving the same ads for the track
+const newAdBreaks = async (audioId: string, adTrackIds: string[], userId?: string): Promise<string[]> => {
+    const pipeline = redisClient.pipeline();
+    adTrackIds.forEach((adTrackId, adBreak) =>
+        pipeline.set(`ad_impression:${userId || 'anonymous'}:${audioId}:${adBreak}:${adTrackId}`, '1', 'EX', SIGNED_URL_EXPIRATION, 'NX')
+    );
+    const results = await pipeline.exec();
+    return adTrackIds.filter((_, adBreak) => results?.[adBreak]?.[1] === 'OK');
+};
+
+const recordAdImpressions = async (audioId: string, adBreakIds: string[], userId?: string) => {
+    const adTrackIds = await newAdBreaks(audioId, adBreakIds, userId);
+    if (adTrackIds.length === 0) {
+        return;
+    }
+
+    const adTracks = await prisma.adTrack.findMany({
+        where: { id: { in: adTrackIds } },
+        select: { id: true, adId: true }
     });
+    const adIds = new Map(adTracks.map((adTrack) => [adTrack.id, adTrack.adId]));
 
-    m3u8Content += '#EXT-X-ENDLIST\n';
-    return m3u8Content;
+    // one impression per ad break
+    await prisma.adImpression.createMany({
+        data: adTrackIds
+            .filter((adTrackId) => adIds.has(adTrackId))
+            .map((adTrackId) => ({ adId: adIds.get(adTrackId)!, userId }))
+    });
 };
 
+const isPremiumListener = (req: Request) =>
+    (req.user as any)?.subscription?.status === "ACTIVE" && ((req.user as any).subscription.plan || "FREE") !== "FREE";
+
+
+// Signs the upcoming tracks of a queue in a single batch request to the media service, which
+// transcodes the missing ones and caches the signed URLs the playlists of the others are built from.
+// Returns the status of every track.
+const prefetchPlaylists = async (audioIds: string[]): Promise<Record<string, string>> => {
+    const renditions = await generateSignedUrls(audioIds, false, SIGNED_URL_EXPIRATION);
+
+    const statuses: Record<string, string> = {};
+    for (const audioId of audioIds) {
+        statuses[audioId] = renditions[audioId]?.status || 'missing';
+    }
+    return statuses;
+};
+
+
 const setPlayHistory = async (userId: string, trackId: string) => {
     const history = await prisma.playHistory.findFirst({
         where: {
@@ -165,16 +215,14 @@ export const streamController = {
             throw new CustomErrors.NotFoundError("Requested song doesn't exist.");
         }
 
-        const baseAudioSegments = await getPlaylistFromCacheOrGenerate(track.id, false);
+        const m3u8Content = isPremiumListener(req)
+            ? await getPlaylistFromCacheOrFetch(track.id, false)
+            : await getPlaylistWithAds(track.id, userId);
 
-        if (!baseAudioSegments || baseAudioSegments.length === 0) {
+        if (!m3u8Content) {
             throw new CustomErrors.NotFoundError("Audio segments not found for the requested track.");
         }
 
-
-        // build m3u8 content
-        const m3u8Content = await buildM3U8Content(baseAudioSegments);
-
         // TODO: use advanced playHistory latter
         setPlayHistory(userId!, track.id);
 
@@ -183,6 +231,42 @@ export const streamController = {
         res.send(m3u8Content);
     },
 
+    // Media playlist of one bitrate of an adaptive track, requested by players through the
+    // relative variant URIs of the master playlist
+    variantStream: async (req: Request, res: Response) => {
+        const { audio_id: audioId, is_add: isAdd, variant } = variantStreamSchema.parse(req.query);
+
+        const m3u8Content = isAdd || isPremiumListener(req)
+            ? await getPlaylistFromCacheOrFetch(audioId, isAdd, variant)
+            : await getPlaylistWithAds(audioId, req.user?.id, variant);
+
+        if (!m3u8Content) {
+            throw new CustomErrors.NotFoundError("Audio segments not found for the requested variant.");
+        }
+
+        res.setHeader('Content-Type', 'application/vnd.apple.mpegurl')
+        res.send(m3u8Content);
+    },
+
+    // Called with the upcoming items of a queue or playlist so that playing them needs no signing
+    prefetch: async (req: Request, res: Response) => {
+        const { trackIds } = prefetchStreamSchema.parse(req.body);
+
+        const tracks = await prisma.track.findMany({
+            where: {
+                id: { in: trackIds }
+            },
+            select: { id: true }
+        });
+
+        const statuses = tracks.length > 0 ? await prefetchPlaylists(tracks.map((track) => track.id)) : {};
+
+        res.json({
+            success: true,
+            data: statuses
+        });
+    },
+
     addStream: async (req: Request, res: Response) => {
         const userId = req.user?.id;
         const audioId = uuidSchema.parse(req.params?.audioId || "");
@@ -202,15 +286,12 @@ export const streamController = {
             throw new CustomErrors.NotFoundError("Requested advertisement doesn't exist.");
         }
 
-        const adAudioSegments = await getPlaylistFromCacheOrGenerate(ad.tracks[0].id, true);
+        const m3u8Content = await getPlaylistFromCacheOrFetch(ad.tracks[0].id, true);
 
-        if (!adAudioSegments || adAudioSegments.length === 0) {
+        if (!m3u8Content) {
             throw new CustomErrors.NotFoundError("Audio segments not found for the requested advertisement.");
         }
 
-        // build m3u8 content
-        const m3u8Content = await buildM3U8Content(adAudioSegments);
-
         // create add impression
         await prisma.adImpression.create({
             data: {
@@ -244,24 +325,10 @@ export const streamController = {
         // Cache or serve the main M3U8 somewhere, or generate signed URL to a virtual endpoint
         const mainStreamUrl = `http://localhost:5000/stream/${track.id}/master.m3u8`;
 
-        let adStreamUrl: string | null = null;
-        let advertisement: any = null;
-        if (!isPremium) {
-            // TODO: Select ad based on various factors
-
-            // for now, randomly select the first ad
-            const ads = await prisma.advertisement.findMany({
-                where: { active: true },
-            });
-            if (ads.length === 0) {
-                advertisement = null;
-            } else {
-                const idx = Math.floor(Math.random() * ads.length);
-                advertisement = ads[idx];
-            }
-
-            adStreamUrl = advertisement ? `http://localhost:5000/stream/${advertisement.id}/ads/ad.m3u8` : null;
-        }
+        // Ad breaks of free listeners are stitched into the main playlist by the media service,
+        // the player no longer switches to a separate ad stream
+        const adStreamUrl: string | null = null;
+        const advertisement: any = null;
 
         // Return metadata for the frontend player
         res.json({
@@ -271,6 +338,7 @@ export const streamController = {
                 adStreamUrl,
                 advertisement,
                 adIntervalSeconds: 120,
+                adsStitched: !isPremium,
                 isPremium
             }
         });
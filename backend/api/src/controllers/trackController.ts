@@ -7,7 +7,7 @@ import { uuidSchema, searchSchema, paginationSchema } from '../validators';
 import { uploadImageToCloudinary, deleteImageFromCloudinary } from '../libs/cloudinary';
 import { uploadAudioToS3, deleteAudioFromS3 } from '../libs/s3Client';
 import { addTrackToMeiliIndex } from '../libs/meili';
-import { embeddingQueue } from '../jobs/audioQueue';
+import { embeddingQueue, queueTranscodeWithAudioEmbedding } from '../jobs/audioQueue';
 import { searchTracks } from '../prisma/vectorQueries';
 
 
@@ -96,7 +96,9 @@ export const trackController = {
         // addTrackToMeiliIndex(newTrack.id);
 
         // TODO: queue sonic, metadata embedding and LUFS tasks with
-        embeddingQueue.add('embedding', { type: 'track_audio', track_id: newTrack.id });
+        // transcode now so the first listener does not wait for it (also measures LUFS); the
+        // sonic embedding follows it and reuses its decode
+        queueTranscodeWithAudioEmbedding(newTrack.id);
         embeddingQueue.add('embedding', { type: 'track', track_id: newTrack.id });
 
         // Return the response
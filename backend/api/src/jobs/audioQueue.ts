@@ -1,6 +1,7 @@
-import { Queue, QueueEvents } from 'bullmq';
+import { FlowProducer, Queue, QueueEvents } from 'bullmq';
 import config from '../config/config';
 import { redisClient } from '../libs/redis';
+import { currentRequestId } from '../middlewares/requestId';
 
 // Helper to create a queue
 const createQueue = (name: string) => new Queue(name, { connection: redisClient });
@@ -11,3 +12,32 @@ export const embeddingQueueEvents = new QueueEvents('embedding', { connection: r
 
 export const personalizationQueue = createQueue('personalization');
 export const personalizationQueueEvents = new QueueEvents('personalization', { connection: redisClient });
+
+// HLS transcode on ingest, consumed by the media service; lower priority runs first
+export const audioTasksQueue = createQueue('audio-tasks');
+export const TRANSCODE_PRIORITY = { interactive: 1, ingest: 5, backfill: 10 };
+
+const transcodeJob = (audioId: string, isAdd: boolean = false) => ({
+    name: 'transcode',
+    // the upload request, so the logs of the transcode can be matched with it
+    data: { type: 'transcode', audio_id: audioId, is_add: isAdd, force: false, request_id: currentRequestId() },
+    opts: { priority: TRANSCODE_PRIORITY.ingest, removeOnComplete: true, removeOnFail: 1000 }
+});
+
+export const queueTranscode = (audioId: string, isAdd: boolean = false) => {
+    const { name, data, opts } = transcodeJob(audioId, isAdd);
+    return audioTasksQueue.add(name, data, opts);
+};
+
+const flowProducer = new FlowProducer({ connection: redisClient });
+
+// The sonic embedding reads the analysis sidecar the transcode writes next to the rendition, so it
+// is queued as the parent of the transcode: BullMQ only starts it once the transcode is done.
+// A failed transcode still completes its job, the embedding then decodes the original.
+export const queueTranscodeWithAudioEmbedding = (trackId: string) =>
+    flowProducer.add({
+        name: 'embedding',
+        queueName: 'embedding',
+        data: { type: 'track_audio', track_id: trackId },
+        children: [{ ...transcodeJob(trackId), queueName: 'audio-tasks' }]
+    });
@@ -1,4 +1,5 @@
 import axios, { AxiosInstance, AxiosResponse, AxiosError } from 'axios';
+import { currentRequestId } from '../middlewares/requestId';
 
 const MEDIA_SERVER_BASE_URL = process.env.MEDIA_SERVER_BASE_URL || 'http://localhost:8000';
 
@@ -11,6 +12,15 @@ const mediaServer: AxiosInstance = axios.create({
     },
 });
 
+// lets the logs of the media service be matched with the request that called it
+mediaServer.interceptors.request.use((request) => {
+    const requestId = currentRequestId();
+    if (requestId) {
+        request.headers.set('X-Request-ID', requestId);
+    }
+    return request;
+});
+
 mediaServer.interceptors.response.use(
     (response: AxiosResponse) => response,
     (error: AxiosError) => {
@@ -1,6 +1,7 @@
-import { S3Client, PutObjectCommand, DeleteObjectCommand, ListObjectsV2Command, DeleteObjectsCommand } from "@aws-sdk/client-s3";
+import { S3Client, PutObjectCommand, DeleteObjectCommand } from "@aws-sdk/client-s3";
 import fs from "fs";
 import config from "../config/config";
+import { mediaServer } from "./axios";
 import  { v4 as uuidv4 } from "uuid";
 
 export const s3Client = new S3Client({
@@ -24,6 +25,9 @@ export const uploadAudioToS3 = async (filePath: string, audioId: string, mimeTyp
         Key: `${path}/${audioId}`, // use audioId as file name
         Body: fileStream,
         ContentType: mimeType,
+        // S3 keeps the checksum with the object; the media service shares one rendition
+        // between uploads of identical files by it
+        ChecksumAlgorithm: 'SHA256' as const,
     };
 
     try {
@@ -42,37 +46,28 @@ export const generatePresignedUrl = (key: string, expiresIn: number = 3600) => {
     return url;
 }
 
+// The media service deletes the rendition: its objects may be shared with identical uploads
+// under cas/, and it tracks links, sizes and recency of every rendition in Redis
+const deleteRendition = async (key: string) => {
+    const [kind, audioId] = key.split('/');
+    await mediaServer.delete('/transcode/rendition', {
+        params: { audio_id: audioId, is_add: kind === 'add' }
+    });
+}
+
 export const deleteAudioFromS3 = async (key: string) => {
     const deleteParams = {
         Bucket: config.s3Storage.bucketName,
         Key: key,
     };
 
-    // Delete HLS segments folder if exists
-    const listParams = {
-        Bucket: 'hls-playlist',
-        Prefix: key,
-    };
-
     try {
         // Delete the single audio object
         await s3Client.send(new DeleteObjectCommand(deleteParams));
 
-        // Delete HLS segments folder if exists
-        const listed = await s3Client.send(new ListObjectsV2Command(listParams));
-        if (listed.Contents && listed.Contents.length > 0) {
-            const objects = listed.Contents.map(obj => ({ Key: obj.Key! }));
-            await s3Client.send(new DeleteObjectsCommand({
-                Bucket: listParams.Bucket,
-                Delete: {
-                    Objects: objects,
-                    Quiet: false,
-                },
-            }));
-        }
+        await deleteRendition(key);
     } catch (err) {
         console.error("Error deleting audio from S3:", err);
         throw err;
     }
 }
-
@@ -0,0 +1,15 @@
+import { AsyncLocalStorage } from "async_hooks";
+import { randomUUID } from "crypto";
+import { NextFunction, Request, Response } from "express";
+
+const requestIds = new AsyncLocalStorage<string>();
+
+// The id of the request being served, forwarded to the media service so its logs of the
+// request (and of the transcodes it starts) can be found by it
+export const currentRequestId = (): string | undefined => requestIds.getStore();
+
+export function requestId(req: Request, res: Response, next: NextFunction) {
+    const id = req.get("x-request-id") || randomUUID().replace(/-/g, "");
+    res.setHeader("X-Request-ID", id);
+    requestIds.run(id, next);
+}
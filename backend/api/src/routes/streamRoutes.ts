@@ -8,6 +8,10 @@ const router = Router();
 // router.get("/:audioId/master.m3u8", requireAuth, streamController.stream);
 router.get("/:audioId/master.m3u8", requireAuth, streamController.mainStream);
 router.get("/:audioId/ads/ad.m3u8", requireAuth, streamController.addStream);
+// variant playlists, relative to the master playlists above
+router.get("/:audioId/playlist", requireAuth, streamController.variantStream);
+router.get("/:audioId/ads/playlist", requireAuth, streamController.variantStream);
 router.get("/:audioId/stream-url", requireAuth, streamController.stream);
+router.post("/prefetch", requireAuth, streamController.prefetch);
 
 export default router;
@@ -0,0 +1,24 @@
+import prisma from '../libs/db';
+import { redisClient } from '../libs/redis';
+
+// Redis set of ad audio ids the media service stitches ad breaks from (AD_ROTATION_KEY there)
+const AD_ROTATION_KEY = 'hls_ad_rotation';
+
+// Publishes the audio of every active advertisement as the ad rotation of the media service.
+// Called whenever advertisements change; the media service re-reads the set every minute.
+export const syncAdRotation = async () => {
+    const adTracks = await prisma.adTrack.findMany({
+        where: { advertisement: { active: true } },
+        select: { id: true }
+    });
+
+    const transaction = redisClient.multi().del(AD_ROTATION_KEY);
+    if (adTracks.length > 0) {
+        transaction.sadd(AD_ROTATION_KEY, ...adTracks.map((adTrack) => adTrack.id));
+    }
+    await transaction.exec();
+};
+
+export const refreshAdRotation = () => {
+    syncAdRotation().catch((e) => console.error('Error syncing the ad rotation', e));
+};
@@ -1,7 +1,8 @@
 import { mediaServer } from "../libs/axios";
 
 
-export const generateSignedUrl = async (audioId: string, isAdd: boolean = false, expiresInSeconds?: number) => {
+// status is "streaming" while the media service is still encoding the tail of the track
+export const generateSignedUrl = async (audioId: string, isAdd: boolean = false, expiresInSeconds?: number): Promise<{ segments: string[], status: string }> => {
     
     // Generate the presigned URL
     try {
@@ -9,9 +10,70 @@ export const generateSignedUrl = async (audioId: string, isAdd: boolean = false,
             audio_id: audioId, 
             is_add: isAdd, 
             expiration: expiresInSeconds } });
-        return response.data?.data || [];
+        return {
+            segments: response.data?.data || [],
+            status: response.data?.status || 'ready'
+        };
     } catch(e) {
         console.error('Error generating signed URL', e);
         throw new Error('Error generating signed URL');
     }
 }
+
+
+export type SignedRendition = { segments: string[], status: string };
+
+// Signs many renditions in one request to the media service; duplicate ids are signed once.
+// Missing or still transcoding renditions come back with their status and no segments.
+export const generateSignedUrls = async (audioIds: string[], isAdd: boolean = false, expiresInSeconds?: number): Promise<Record<string, SignedRendition>> => {
+    try {
+        const response = await mediaServer.post('/signed_url/batch', {
+            audio_ids: audioIds,
+            is_add: isAdd,
+            expiration: expiresInSeconds
+        });
+
+        const renditions: Record<string, SignedRendition> = {};
+        for (const [audioId, item] of Object.entries<any>(response.data?.data || {})) {
+            renditions[audioId] = {
+                segments: item?.data || [],
+                status: item?.status || 'missing'
+            };
+        }
+        return renditions;
+    } catch(e) {
+        console.error('Error generating signed URLs', e);
+        throw new Error('Error generating signed URLs');
+    }
+}
+
+
+export type SignedPlaylist = { m3u8: string | null, status: number, adIds: string[] };
+
+// Fetches the ready-to-play m3u8 the media service renders with the real segment durations.
+// Status 202 means the track is still being transcoded and 404 that it has no rendition.
+// With ads, the media service stitches ad breaks into the playlist; adIds lists the ad audio played.
+export const fetchSignedPlaylist = async (audioId: string, isAdd: boolean = false, expiresInSeconds?: number, variant?: string, ads: boolean = false): Promise<SignedPlaylist> => {
+    try {
+        const response = await mediaServer.get('/signed_url/playlist', {
+            params: {
+                audio_id: audioId,
+                is_add: isAdd,
+                expiration: expiresInSeconds,
+                variant,
+                ads
+            },
+            responseType: 'text',
+            validateStatus: (status) => status === 200 || status === 202 || status === 404
+        });
+        const adIds = response.headers['x-ad-ids'];
+        return {
+            m3u8: response.status === 200 ? response.data : null,
+            status: response.status,
+            adIds: adIds ? String(adIds).split(',') : []
+        };
+    } catch(e) {
+        console.error('Error fetching signed playlist', e);
+        throw new Error('Error fetching signed playlist');
+    }
+}
@@ -0,0 +1,11 @@
+import { z } from "zod";
+
+export const prefetchStreamSchema = z.object({
+    trackIds: z.array(z.string().uuid("Invalid track ID")).min(1, "At least one track ID must be provided").max(50, "Cannot prefetch more than 50 tracks at once"),
+});
+
+export const variantStreamSchema = z.object({
+    audio_id: z.string().uuid("Invalid audio ID"),
+    is_add: z.enum(["true", "false"]).optional().default("false").transform((value) => value === "true"),
+    variant: z.string().regex(/^[0-9a-z]{1,16}$/, "Invalid variant"),
+});
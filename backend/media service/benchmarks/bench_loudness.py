@@ -0,0 +1,95 @@
+"""
+Check the streaming loudness meter against pyloudnorm and time both.
+
+Synthetic signals cover the cases gating matters for: steady noise, a quiet intro before a
+loud section (relative gate), silence gaps (absolute gate), mono and stereo, and several
+sample rates. Each signal is fed to the streaming meter in odd-sized chunks so filter state
+and gating blocks straddle chunk boundaries. The run fails if any result differs from
+pyloudnorm by more than --tolerance LU. `tests/test_loudness.py` runs the same comparison under pytest.
+
+Usage (from the media service directory):
+    python -m benchmarks.bench_loudness --seconds 120
+"""
+import argparse
+import sys
+import time
+import numpy as np
+import pyloudnorm as pyln
+from utils.pyloudnorm import StreamingLoudnessMeter
+
+
+def signals(rate: int, seconds: float, rng) -> dict:
+    frames = int(rate * seconds)
+    t = np.arange(frames) / rate
+    noise = rng.standard_normal((frames, 2)) * 0.1
+
+    quiet_then_loud = noise.copy()
+    quiet_then_loud[: frames // 3] *= 0.01
+
+    gaps = noise.copy()
+    for start in range(0, frames, 10 * rate):
+        gaps[start:start + 3 * rate] = 0.0
+
+    tone = 0.5 * np.sin(2 * np.pi * 997 * t)
+    sweep = 0.3 * np.sin(2 * np.pi * (50 + 4000 * t / seconds) * t)
+
+    return {
+        "noise": noise,
+        "quiet_then_loud": quiet_then_loud,
+        "silence_gaps": gaps,
+        "tone_mono": tone,
+        "sweep_stereo": np.stack([sweep, 0.5 * sweep], axis=1),
+    }
+
+
+def stream(audio, rate: int, rng) -> float:
+    meter = StreamingLoudnessMeter(rate, channels=1 if audio.ndim == 1 else audio.shape[1])
+    start = 0
+    while start < len(audio):
+        size = int(rng.integers(1, 3 * rate))
+        meter.process(audio[start:start + size])
+        start += size
+    return meter.integrated_loudness()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=120, help="length of every test signal")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="maximum difference in LU")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(1770)
+    failures = 0
+    reference_time = streaming_time = 0.0
+    audio_seconds = 0.0
+
+    for rate in (22050, 44100, 48000):
+        for name, audio in signals(rate, args.seconds, rng).items():
+            started = time.perf_counter()
+            expected = pyln.Meter(rate).integrated_loudness(audio)
+            reference_time += time.perf_counter() - started
+
+            started = time.perf_counter()
+            measured = stream(audio, rate, rng)
+            streaming_time += time.perf_counter() - started
+            audio_seconds += args.seconds
+
+            difference = abs(measured - expected)
+            ok = difference <= args.tolerance
+            failures += not ok
+            print(
+                f"{'ok  ' if ok else 'FAIL'} {rate:>5} Hz {name:<16} "
+                f"pyloudnorm {expected:8.3f} LUFS  streaming {measured:8.3f} LUFS  diff {difference:.4f} LU"
+            )
+
+    print(f"pyloudnorm : {audio_seconds / reference_time:10,.0f}x realtime")
+    print(f"streaming  : {audio_seconds / streaming_time:10,.0f}x realtime")
+
+    if failures:
+        print(f"{failures} signals differ from pyloudnorm by more than {args.tolerance} LU")
+        sys.exit(1)
+    print(f"All signals within {args.tolerance} LU of pyloudnorm")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Benchmark the batch presigner against boto3's per-object `generate_presigned_url`.
+
+Presigning is an offline computation, so no S3 server is needed; any credentials set in
+the environment (or .env) work. Before timing, every batch-signed URL is checked against
+the boto3 reference URL signed at the same timestamp, and the run fails on any difference.
+The same equivalence is covered with fixed credentials by `tests/test_presign.py`.
+
+Usage (from the media service directory):
+    python -m benchmarks.bench_presign --keys 40 --rounds 200
+"""
+import argparse
+import datetime
+import sys
+import time
+from urllib.parse import parse_qs, urlsplit
+from libs.s3_client import client
+from utils.generate_signed_url import (
+    HLS_BUCKET_NAME,
+    SIGV4_TIMESTAMP_FORMAT,
+    batch_presigner,
+    generate_signed_url,
+)
+
+
+def segment_keys(count: int) -> list:
+    return [
+        f"music/7c0cf737-4c65-4515-a90c-df6a54f0c087/segment_{index:03d}.ts"
+        for index in range(count)
+    ]
+
+
+def check_against_boto3(bucket_name: str, object_keys: list) -> int:
+    """
+    Compare batch-signed URLs with boto3's reference URLs. Returns the number of mismatches.
+    """
+    mismatches = 0
+    for object_key in object_keys:
+        reference_url = client.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': bucket_name, 'Key': object_key},
+            ExpiresIn=1200
+        )
+        query = parse_qs(urlsplit(reference_url).query)
+        signed_at = datetime.datetime.strptime(query["X-Amz-Date"][0], SIGV4_TIMESTAMP_FORMAT)
+        expires_in = int(query["X-Amz-Expires"][0])
+
+        batch_url = batch_presigner.sign(bucket_name, [object_key], expires_in, signed_at)[0]
+        if batch_url != reference_url:
+            mismatches += 1
+            print(f"MISMATCH {object_key}\n  boto3: {reference_url}\n  batch: {batch_url}")
+
+    return mismatches
+
+
+def urls_per_second(sign_round, object_keys: list, rounds: int) -> float:
+    started = time.perf_counter()
+    for _ in range(rounds):
+        sign_round(object_keys)
+    elapsed = time.perf_counter() - started
+    return len(object_keys) * rounds / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bucket", default=HLS_BUCKET_NAME)
+    parser.add_argument("--keys", type=int, default=40, help="segments per request")
+    parser.add_argument("--rounds", type=int, default=200, help="requests to sign")
+    args = parser.parse_args()
+
+    object_keys = segment_keys(args.keys)
+
+    if batch_presigner.sign(args.bucket, object_keys[:1], 1200) is None:
+        print("Batch presigner is disabled for this bucket (see log above); nothing to compare.")
+        sys.exit(1)
+
+    mismatches = check_against_boto3(args.bucket, object_keys)
+    if mismatches:
+        print(f"{mismatches} of {len(object_keys)} URLs differ from boto3")
+        sys.exit(1)
+    print(f"All {len(object_keys)} batch-signed URLs are byte-identical to boto3")
+
+    def boto3_round(keys):
+        for object_key in keys:
+            generate_signed_url(args.bucket, object_key, 1200)
+
+    def batch_round(keys):
+        batch_presigner.sign(args.bucket, keys, 1200)
+
+    boto3_rate = urls_per_second(boto3_round, object_keys, args.rounds)
+    batch_rate = urls_per_second(batch_round, object_keys, args.rounds)
+
+    print(f"boto3 per-object : {boto3_rate:12,.0f} URLs/s")
+    print(f"batch presigner  : {batch_rate:12,.0f} URLs/s")
+    print(f"speedup          : {batch_rate / boto3_rate:12.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,413 @@
+"""
+Load test /signed_url end to end against local stand-ins for S3 and Redis.
+
+The app runs under uvicorn in a subprocess, configured through the environment to use a
+moto S3 server (or any S3-compatible endpoint, e.g. MinIO) and a throwaway redis-server
+(or a given Redis database, which is flushed). The sources are sine tones generated with
+ffmpeg, one frequency per track so identical uploads never share a rendition.
+
+Scenarios:
+    cold        one request per fresh track: probe, transcode, upload and sign, timed until
+                the first playable answer (a 202 is polled until segments are signed)
+    warm        requests for tracks with complete renditions: manifest lookup and signing
+    same_track  many clients asking for one fresh track at once, which must share a single
+                transcode; the transcodes the scheduler ran are reported with it
+
+Every scenario reports p50/p95/p99/mean/max latency in milliseconds, throughput and the
+HTTP statuses seen. The results are printed as a table and written as JSON (--output) with
+the commit and parameters of the run, so runs of different releases can be compared.
+
+Usage (from the media service directory):
+    python -m benchmarks.bench_signed_url --tracks 10 --warm-requests 2000 --output bench.json
+    python -m benchmarks.bench_signed_url --s3-endpoint http://127.0.0.1:9000 \\
+        --s3-access-key minioadmin --s3-secret-key minioadmin --redis-url redis://127.0.0.1:6379/15
+
+Needs ffmpeg, uvicorn and httpx; moto[server] without --s3-endpoint and redis-server on the
+PATH without --redis-url.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from urllib.parse import urlsplit
+import boto3
+import httpx
+from botocore.config import Config
+
+
+SOURCE_BUCKET = "bench-source"
+HLS_BUCKET = "bench-hls"
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_until(check, timeout: float, what: str):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if check():
+                return
+        except Exception:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError(f"{what} did not come up within {timeout}s")
+
+
+def percentile(values: list, fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def summarize(latencies: list, statuses: dict, elapsed: float) -> dict:
+    """
+    Describe the latencies (seconds) of one scenario in milliseconds.
+    """
+    milliseconds = [latency * 1000 for latency in latencies]
+    return {
+        "requests": len(latencies),
+        "p50_ms": round(percentile(milliseconds, 0.50), 2),
+        "p95_ms": round(percentile(milliseconds, 0.95), 2),
+        "p99_ms": round(percentile(milliseconds, 0.99), 2),
+        "mean_ms": round(sum(milliseconds) / len(milliseconds), 2) if milliseconds else 0.0,
+        "max_ms": round(max(milliseconds, default=0.0), 2),
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "elapsed_s": round(elapsed, 3),
+        "statuses": statuses,
+    }
+
+
+class StandIns:
+    """
+    The S3 endpoint and Redis the app under test talks to, started here unless given.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self._moto = None
+        self._redis = None
+        self.s3_endpoint = args.s3_endpoint
+        self.redis_url = args.redis_url
+
+    def start(self):
+        if not self.s3_endpoint:
+            from moto.server import ThreadedMotoServer
+
+            port = free_port()
+            self._moto = ThreadedMotoServer(ip_address="127.0.0.1", port=port)
+            self._moto.start()
+            self.s3_endpoint = f"http://127.0.0.1:{port}"
+
+        if not self.redis_url:
+            if not shutil.which("redis-server"):
+                raise RuntimeError("redis-server is not on the PATH, pass --redis-url")
+            port = free_port()
+            self._redis = subprocess.Popen(
+                ["redis-server", "--port", str(port), "--save", "", "--appendonly", "no"],
+                stdout=subprocess.DEVNULL
+            )
+            self.redis_url = f"redis://127.0.0.1:{port}/0"
+
+        redis_url = urlsplit(self.redis_url)
+        self.redis = {
+            "host": redis_url.hostname or "127.0.0.1",
+            "port": redis_url.port or 6379,
+            "db": int(redis_url.path.lstrip("/") or 0),
+            "password": redis_url.password or "",
+        }
+        wait_until(self._flush_redis, 10, "Redis")
+
+    def _flush_redis(self) -> bool:
+        from redis import Redis
+
+        Redis(self.redis["host"], self.redis["port"], db=self.redis["db"], password=self.redis["password"] or None).flushdb()
+        return True
+
+    def s3(self):
+        return boto3.client(
+            "s3",
+            endpoint_url=self.s3_endpoint,
+            aws_access_key_id=self.args.s3_access_key,
+            aws_secret_access_key=self.args.s3_secret_key,
+            region_name=self.args.s3_region,
+            config=Config(signature_version="s3v4")
+        )
+
+    def stop(self):
+        if self._moto:
+            self._moto.stop()
+        if self._redis:
+            self._redis.terminate()
+            self._redis.wait()
+
+
+def generate_tone(path: str, frequency: int, seconds: float, codec: str):
+    codec_args = ["-c:a", "libmp3lame", "-b:a", "192k", "-f", "mp3"] if codec == "mp3" else ["-c:a", "aac", "-b:a", "128k", "-f", "adts"]
+    subprocess.run(
+        [
+            "ffmpeg", "-v", "error", "-y",
+            "-f", "lavfi", "-i", f"sine=frequency={frequency}:duration={seconds}:sample_rate=44100",
+            "-ac", "2", *codec_args, path
+        ],
+        check=True
+    )
+
+
+def upload_tracks(s3, count: int, seconds: float, codec: str) -> list:
+    """
+    Upload `count` distinct tones to the source bucket. Returns their audio ids.
+    """
+    audio_ids = []
+    with tempfile.TemporaryDirectory() as directory:
+        for index in range(count):
+            audio_id = str(uuid.uuid4())
+            path = os.path.join(directory, f"{audio_id}.{codec}")
+            generate_tone(path, 220 + 7 * index, seconds, codec)
+            with open(path, "rb") as source:
+                s3.put_object(Bucket=SOURCE_BUCKET, Key=f"music/{audio_id}", Body=source, ChecksumAlgorithm="SHA256")
+            audio_ids.append(audio_id)
+    return audio_ids
+
+
+class App:
+    """
+    The media service under uvicorn, configured for the stand-ins.
+    """
+
+    def __init__(self, stand_ins: StandIns, args):
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.log = tempfile.TemporaryFile(mode="w+")
+        env = dict(
+            os.environ,
+            S3_ENDPOINT=stand_ins.s3_endpoint,
+            S3_ACCESS_KEY_ID=args.s3_access_key,
+            S3_SECRET_ACCESS_KEY=args.s3_secret_key,
+            S3_REGION=args.s3_region,
+            S3_BUCKET_NAME=SOURCE_BUCKET,
+            HLS_BUCKET_NAME=HLS_BUCKET,
+            HOST=stand_ins.redis["host"],
+            PORT=str(stand_ins.redis["port"]),
+            DB=str(stand_ins.redis["db"]),
+            PASSWORD=stand_ins.redis["password"],
+            HLS_TRANSCODE_DISPATCH="local",
+        )
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(self.port), "--no-access-log"],
+            env=env,
+            stdout=self.log,
+            stderr=subprocess.STDOUT
+        )
+        wait_until(lambda: httpx.get(f"{self.url}/health").status_code == 200, 60, "The media service")
+
+    def tail(self, lines: int = 40) -> str:
+        self.log.seek(0)
+        return "".join(self.log.readlines()[-lines:])
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        self.log.close()
+
+
+async def sign(client: httpx.AsyncClient, audio_id: str, statuses: dict, timeout: float) -> float:
+    """
+    Ask for the signed URLs of a track until some are returned. Returns the seconds it took.
+    """
+    started = time.perf_counter()
+    while True:
+        response = await client.get("/signed_url/", params={"audio_id": audio_id, "wait": 30})
+        statuses[str(response.status_code)] = statuses.get(str(response.status_code), 0) + 1
+        if response.status_code == 200 and response.json()["data"]:
+            return time.perf_counter() - started
+        if response.status_code not in (200, 202) or time.perf_counter() - started > timeout:
+            raise RuntimeError(f"{audio_id}: {response.status_code} {response.text[:200]}")
+        await asyncio.sleep(0.1)
+
+
+async def wait_until_ready(client: httpx.AsyncClient, audio_ids: list, timeout: float):
+    deadline = time.monotonic() + timeout
+    pending = set(audio_ids)
+    while pending and time.monotonic() < deadline:
+        for audio_id in list(pending):
+            response = await client.get("/signed_url/status", params={"audio_id": audio_id})
+            if response.json()["data"]["status"] == "ready":
+                pending.discard(audio_id)
+        await asyncio.sleep(0.2)
+    if pending:
+        raise RuntimeError(f"{len(pending)} renditions not ready after {timeout}s")
+
+
+async def transcodes_completed(client: httpx.AsyncClient) -> int:
+    stats = (await client.get("/transcode/scheduler")).json()["data"]
+    return stats["completed"] + stats["failed"]
+
+
+async def run_cold(client: httpx.AsyncClient, audio_ids: list, concurrency: int, timeout: float) -> dict:
+    statuses = {}
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(audio_id):
+        async with semaphore:
+            return await sign(client, audio_id, statuses, timeout)
+
+    started = time.perf_counter()
+    latencies = await asyncio.gather(*(one(audio_id) for audio_id in audio_ids))
+    return summarize(latencies, statuses, time.perf_counter() - started)
+
+
+async def run_warm(client: httpx.AsyncClient, audio_ids: list, requests: int, concurrency: int) -> dict:
+    statuses = {}
+    latencies = []
+    remaining = requests
+
+    async def worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            started = time.perf_counter()
+            response = await client.get("/signed_url/", params={"audio_id": random.choice(audio_ids), "wait": 0})
+            latencies.append(time.perf_counter() - started)
+            statuses[str(response.status_code)] = statuses.get(str(response.status_code), 0) + 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, statuses, time.perf_counter() - started)
+
+
+async def run_same_track(client: httpx.AsyncClient, audio_id: str, clients: int, timeout: float) -> dict:
+    statuses = {}
+    completed_before = await transcodes_completed(client)
+
+    started = time.perf_counter()
+    latencies = await asyncio.gather(*(sign(client, audio_id, statuses, timeout) for _ in range(clients)))
+    result = summarize(latencies, statuses, time.perf_counter() - started)
+
+    await wait_until_ready(client, [audio_id], timeout)
+    result["transcodes"] = await transcodes_completed(client) - completed_before
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+async def run(args, app: App, cold_ids: list, same_track_id: str) -> dict:
+    limits = httpx.Limits(max_connections=max(args.concurrency, args.same_track_clients) + 8)
+    async with httpx.AsyncClient(base_url=app.url, timeout=args.timeout, limits=limits) as client:
+        scenarios = {}
+        print(f"cold: {len(cold_ids)} tracks, concurrency {args.cold_concurrency}", file=sys.stderr)
+        scenarios["cold"] = await run_cold(client, cold_ids, args.cold_concurrency, args.timeout)
+
+        await wait_until_ready(client, cold_ids, args.timeout)
+        print(f"warm: {args.warm_requests} requests, concurrency {args.concurrency}", file=sys.stderr)
+        scenarios["warm"] = await run_warm(client, cold_ids, args.warm_requests, args.concurrency)
+
+        print(f"same_track: {args.same_track_clients} clients", file=sys.stderr)
+        scenarios["same_track"] = await run_same_track(client, same_track_id, args.same_track_clients, args.timeout)
+        return scenarios
+
+
+def print_table(scenarios: dict):
+    print(f"{'scenario':<12}{'requests':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}{'req/s':>10}", file=sys.stderr)
+    for name, result in scenarios.items():
+        print(
+            f"{name:<12}{result['requests']:>10}{result['p50_ms']:>10.1f}{result['p95_ms']:>10.1f}"
+            f"{result['p99_ms']:>10.1f}{result['max_ms']:>10.1f}{result['throughput_rps']:>10.1f}",
+            file=sys.stderr
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tracks", type=int, default=10, help="fresh tracks of the cold scenario")
+    parser.add_argument("--seconds", type=float, default=60, help="length of every test tone")
+    parser.add_argument("--codec", choices=("mp3", "aac"), default="mp3", help="mp3 is re-encoded, aac remuxed")
+    parser.add_argument("--cold-concurrency", type=int, default=1)
+    parser.add_argument("--warm-requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=32, help="clients of the warm scenario")
+    parser.add_argument("--same-track-clients", type=int, default=32)
+    parser.add_argument("--timeout", type=float, default=120, help="seconds a track may take to become playable")
+    parser.add_argument("--s3-endpoint", help="use this S3 endpoint instead of starting moto")
+    parser.add_argument("--s3-access-key", default="bench")
+    parser.add_argument("--s3-secret-key", default="bench-secret")
+    parser.add_argument("--s3-region", default="us-east-1")
+    parser.add_argument("--redis-url", help="use (and flush) this Redis database instead of starting redis-server")
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    stand_ins = StandIns(args)
+    app = None
+    try:
+        stand_ins.start()
+        s3 = stand_ins.s3()
+        for bucket in (SOURCE_BUCKET, HLS_BUCKET):
+            try:
+                s3.create_bucket(Bucket=bucket)
+            except (s3.exceptions.BucketAlreadyOwnedByYou, s3.exceptions.BucketAlreadyExists):
+                pass
+
+        print(f"Generating {args.tracks + 1} {args.seconds:g}s test tones", file=sys.stderr)
+        audio_ids = upload_tracks(s3, args.tracks + 1, args.seconds, args.codec)
+
+        app = App(stand_ins, args)
+        try:
+            scenarios = asyncio.run(run(args, app, audio_ids[:-1], audio_ids[-1]))
+        except Exception:
+            print(app.tail(), file=sys.stderr)
+            raise
+    finally:
+        if app:
+            app.stop()
+        stand_ins.stop()
+
+    print_table(scenarios)
+    results = {
+        "benchmark": "signed_url",
+        "timestamp": int(time.time()),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "s3": "external" if args.s3_endpoint else "moto",
+        "parameters": {
+            key: value for key, value in vars(args).items()
+            if key not in ("s3_access_key", "s3_secret_key", "redis_url", "output")
+        },
+        "scenarios": scenarios,
+    }
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+        print(f"Results written to {args.output}", file=sys.stderr)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if scenarios["same_track"]["transcodes"] != 1:
+        print(f"same_track ran {scenarios['same_track']['transcodes']} transcodes instead of 1", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -20,6 +20,9 @@ class RedisConfig(BaseSettingClass):
     username: str = ""
     password: str = ""
     db: int = 0
+    # pool of the async client used by the async request handlers
+    async_max_connections: int = 256
+    async_pool_timeout: float = 5.0
 
 
 class CloudinaryConfig(BaseSettingClass):
@@ -35,12 +38,117 @@ class S3StorageConfig(BaseSettingClass):
     s3_secret_access_key: str = ""
     s3_bucket_name: str = "addis-music"
     hls_bucket_name: str = "hls-playlist"
+    s3_max_pool_connections: int = 32
+    # connections of the async client serving the async request handlers
+    s3_async_max_pool_connections: int = 256
+
+
+class SignedUrlCacheConfig(BaseSettingClass):
+    # expiry times are aligned to fixed windows of this many seconds
+    signed_url_window: int = 600
+    # cached URL sets are dropped this many seconds before their window closes
+    signed_url_cache_margin: int = 30
+    signed_url_local_cache_size: int = 1024
+    # audio ids accepted by one POST /signed_url/batch, and how many are resolved at once
+    signed_url_batch_max_items: int = 100
+    signed_url_batch_concurrency: int = 16
+
+class HlsConfig(BaseSettingClass):
+    hls_manifest_ttl: int = 86400
+    # how long "no rendition yet" answers are remembered before S3 is asked again
+    hls_manifest_missing_ttl: int = 60
+    # a transcode still holding its lock after this many seconds is considered dead
+    hls_transcode_lock_ttl: int = 900
+    # concurrent encodes: a fixed number, or 0 for this share of the available cores
+    hls_transcode_workers: int = 0
+    hls_transcode_cpu_share: float = 0.75
+    # threads per ffmpeg, 0 splits the cores evenly between the encode slots
+    hls_ffmpeg_threads: int = 0
+    # "local" transcodes missing renditions in this process, "queue" hands them to the
+    # audio-tasks ingest worker at the interactive priority
+    hls_transcode_dispatch: str = "local"
+    hls_ingest_concurrency: int = 2
+    # default and maximum time a /signed_url request waits for a running transcode
+    hls_transcode_wait: int = 10
+    hls_transcode_max_wait: int = 30
+    # pipe the source into ffmpeg and upload segments as soon as ffmpeg closes them
+    hls_streaming_transcode: bool = True
+    hls_stream_chunk_size: int = 256 * 1024
+    hls_segment_poll_interval: float = 0.25
+    # "ts" writes one MPEG-TS object per segment, "cmaf" one fragmented MP4 object per track
+    # addressed with byte ranges
+    hls_output_mode: str = "ts"
+    # adaptive bitrate: encode every bitrate of the ladder in one ffmpeg pass
+    hls_abr_enabled: bool = False
+    hls_abr_ladder: str = "48k,96k,192k"
+    hls_abr_default_variant: str = "96k"
+    # segment AAC sources at or below this bitrate with -c:a copy instead of re-encoding them
+    hls_remux_enabled: bool = True
+    hls_remux_max_bitrate: int = 128000
+    hls_probe_timeout: int = 30
+    # loudness is measured in every transcode; once known, the gain to the target is applied
+    # in the encode of later transcodes
+    hls_loudness_normalize: bool = True
+    hls_loudness_target: float = -14.0
+    hls_loudness_true_peak_ceiling: float = -1.0
+    hls_loudness_max_gain: float = 12.0
+    # a first transcode that measures a gain at least this large (dB) queues the re-encode
+    # applying it, at backfill priority
+    hls_loudness_reencode_min_gain: float = 0.5
+    # the sweeper deletes the least recently played renditions above this many bytes (0: never)
+    hls_storage_budget_bytes: int = 0
+    # renditions played more recently than this are kept, longer than any signed URL lives
+    hls_eviction_min_idle: int = 7 * 86400
+    hls_sweep_interval: int = 3600
+    # fast start: the first segments are short so playback starts after a small download, the
+    # rest are grouped back to about hls_segment_duration seconds
+    hls_segment_duration: int = 10
+    hls_fast_start_enabled: bool = True
+    hls_fast_start_segment_duration: int = 2
+    hls_fast_start_segments: int = 3
+    # the fast start segments are signed on windows of this many seconds, so their URLs (and
+    # any cache in front of them) stay the same across plays; 0 signs them like the others
+    hls_intro_url_window: int = 86400
+    # ads stitched into free listeners' playlists: a pre-roll, then a break every this many
+    # seconds (0: pre-roll only); the rotation the API publishes is re-read this often
+    hls_ad_interval: int = 120
+    hls_ad_rotation_ttl: int = 60
+    # renditions are stored once per source content (the SHA-256 checksum S3 keeps for the
+    # source) and encoding profile under cas/, a duplicate upload only links to them
+    hls_content_addressing: bool = True
+    # also key sources uploaded without a checksum by ETag and size; MD5 ETags can be made to
+    # collide, so this lets an uploader choose which rendition another upload links to
+    hls_content_key_etag_fallback: bool = False
+    # the transcode also writes an analysis sidecar (duration, loudness, waveform peaks) and a
+    # 48 kHz mono excerpt for the embedding workers from the same decode
+    hls_analysis_enabled: bool = True
+    hls_analysis_peaks: int = 1000
+    # the excerpt sonic embeddings are computed from; the recommendation service cuts the same
+    # window from originals without an analysis (`audio_embedding_excerpt_*` there)
+    hls_analysis_excerpt_offset: int = 30
+    hls_analysis_excerpt_duration: int = 30
+    hls_upload_concurrency: int = 8
+    hls_upload_retries: int = 4
+    hls_segment_cache_control: str = "public, max-age=31536000, immutable"
+    hls_playlist_cache_control: str = "no-cache"
+    # playlist templates of complete renditions kept in process
+    hls_playlist_template_cache_size: int = 1024
+
+
+class LoggingConfig(BaseSettingClass):
+    log_level: str = "INFO"
+    # one JSON object per line, with the request id and audio id of the request being served
+    log_json: bool = True
+
 
 class Settings():
     database: DatabaseConfig = DatabaseConfig()
     redis: RedisConfig = RedisConfig()
     cloudinary: CloudinaryConfig = CloudinaryConfig()
     s3_storage: S3StorageConfig = S3StorageConfig()
+    signed_url_cache: SignedUrlCacheConfig = SignedUrlCacheConfig()
+    hls: HlsConfig = HlsConfig()
+    logging: LoggingConfig = LoggingConfig()
 
 
 settings = Settings()
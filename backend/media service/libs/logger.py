@@ -0,0 +1,61 @@
+import contextvars
+import json
+import logging
+import sys
+import time
+from config.config import settings
+
+
+# the request being served, set by the middleware of main.py and carried into the transcode
+# and upload threads the request starts
+request_id_var = contextvars.ContextVar("request_id", default=None)
+audio_id_var = contextvars.ContextVar("audio_id", default=None)
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Format a record as one JSON object, with the request id and audio id of its context.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "request_id": request_id_var.get(),
+            "audio_id": audio_id_var.get(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class ContextFormatter(logging.Formatter):
+    """
+    Plain text for local runs, with the request and audio id when there are any.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        context = " ".join(
+            f"{name}={value}"
+            for name, value in (("request_id", request_id_var.get()), ("audio_id", audio_id_var.get()))
+            if value
+        )
+        message = super().format(record)
+        return f"{message} [{context}]" if context else message
+
+
+def _handler() -> logging.Handler:
+    handler = logging.StreamHandler(sys.stdout)
+    if settings.logging.log_json:
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(ContextFormatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    return handler
+
+
+logger = logging.getLogger("media")
+logger.setLevel(settings.logging.log_level.upper())
+logger.addHandler(_handler())
+logger.propagate = False
@@ -1,7 +1,9 @@
 from redis import Redis
+from redis.asyncio import BlockingConnectionPool, Redis as AsyncRedis
 from config.config import settings
+from libs.logger import logger
 
-print("Connecting to Redis at "
+logger.info("Connecting to Redis at "
       f"{settings.redis.host}:{settings.redis.port}, DB: {settings.redis.db}")
 
 redis_connection = Redis(
@@ -11,6 +13,18 @@ redis_connection = Redis(
     password=settings.redis.password
 )
 
+# Used by the async request handlers; waits for a free connection instead of opening more
+async_redis_connection = AsyncRedis(
+    connection_pool=BlockingConnectionPool(
+        host=settings.redis.host,
+        port=settings.redis.port,
+        db=settings.redis.db,
+        password=settings.redis.password,
+        max_connections=settings.redis.async_max_connections,
+        timeout=settings.redis.async_pool_timeout
+    )
+)
+
 connection_url = (
     f"redis://:{settings.redis.password}@"
     f"{settings.redis.host}:{settings.redis.port}/{settings.redis.db}"
@@ -1,5 +1,10 @@
+import asyncio
 import boto3
+from aiobotocore.config import AioConfig
+from aiobotocore.session import get_session
+from botocore.config import Config
 from config.config import settings
+from libs.logger import logger
 
 try:
     client = boto3.client(
@@ -7,8 +12,59 @@ try:
         endpoint_url=settings.s3_storage.s3_endpoint,
         aws_access_key_id=settings.s3_storage.s3_access_key_id,
         aws_secret_access_key=settings.s3_storage.s3_secret_access_key,
-        region_name=settings.s3_storage.s3_region
+        region_name=settings.s3_storage.s3_region,
+        config=Config(
+            # presigned URLs must be SigV4 so the batch signer can reproduce them
+            signature_version='s3v4',
+            # sized for the parallel segment uploads of concurrent transcodes
+            max_pool_connections=settings.s3_storage.s3_max_pool_connections,
+            retries={'max_attempts': 5, 'mode': 'adaptive'}
+        )
     )
 except Exception as error:
-    print("Failed to create S3 client: ", error)
+    logger.error(f"Failed to create S3 client: {error}")
     client = None
+
+
+class AsyncS3Client:
+    """
+    The aiobotocore S3 client of the async request handlers, opened on first use and closed
+    when the app shuts down.
+    """
+
+    def __init__(self):
+        self._client = None
+        self._context = None
+        self._lock = None
+
+    async def get(self):
+        if self._client is not None:
+            return self._client
+
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._client is None:
+                self._context = get_session().create_client(
+                    's3',
+                    endpoint_url=settings.s3_storage.s3_endpoint,
+                    aws_access_key_id=settings.s3_storage.s3_access_key_id,
+                    aws_secret_access_key=settings.s3_storage.s3_secret_access_key,
+                    region_name=settings.s3_storage.s3_region,
+                    config=AioConfig(
+                        signature_version='s3v4',
+                        max_pool_connections=settings.s3_storage.s3_async_max_pool_connections,
+                        retries={'max_attempts': 5, 'mode': 'adaptive'}
+                    )
+                )
+                self._client = await self._context.__aenter__()
+        return self._client
+
+    async def close(self):
+        if self._context is not None:
+            await self._context.__aexit__(None, None, None)
+            self._client = None
+            self._context = None
+
+
+async_client = AsyncS3Client()
@@ -1,28 +1,26 @@
-# from bullmq import Worker
-# import asyncio
-
-# async def process(job):
-#     print("Received job:", job.data)
-#     # Do audio processing, LUFS normalization, etc.
-#     return {"status": "done"}
-
-# worker = Worker(
-#     "audio-tasks",
-#     process,
-#     connection={"host": "localhost", "port": 6379}
-# )
-
-# asyncio.get_event_loop().run_forever()
-
-
-
+import time
+import uuid
+from contextlib import asynccontextmanager
 from typing import Union
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from libs.logger import audio_id_var, request_id_var
+from libs.redis import async_redis_connection
+from libs.s3_client import async_client
+from utils.metrics import http_request_seconds, render_metrics
 from routers.generate_signed_url import router as signed_url_router
+from routers.transcode import router as transcode_router
+
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # the pools of the async handlers belong to this event loop
+    await async_client.close()
+    await async_redis_connection.aclose()
 
-app = FastAPI()
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -32,11 +30,39 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def request_context(request: Request, call_next):
+    # the id the API sent (or a new one) and the track tag every log line of the request, and
+    # the threads it starts
+    request_id = request.headers.get("x-request-id") or uuid.uuid4().hex
+    request_id_var.set(request_id)
+    audio_id_var.set(request.query_params.get("audio_id"))
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        response.headers["X-Request-ID"] = request_id
+        return response
+    finally:
+        # by route template, so every track shares one series
+        route = request.scope.get("route")
+        http_request_seconds.labels(
+            request.method, route.path if route else "unmatched", str(status)
+        ).observe(time.perf_counter() - started)
+
+
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    content, content_type = render_metrics()
+    return Response(content=content, media_type=content_type)
+
 @app.get("/health")
 def health_check():
     return {"status": "healthy"}
 
 app.include_router(signed_url_router, prefix="/signed_url", tags=["Signed URL"])
+app.include_router(transcode_router, prefix="/transcode", tags=["Transcode"])
 
 if __name__ == "__main__":
     app.run()
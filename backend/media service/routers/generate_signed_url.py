@@ -1,38 +1,291 @@
-from fastapi import APIRouter, Query
+from fastapi import APIRouter, Query, Response
+from fastapi.responses import JSONResponse
+import asyncio
 import json
 from pydantic import BaseModel, Field, UUID4
-from utils.generate_signed_url import generate_signed_urls_for_folder
+from config.config import settings
+from libs.logger import audio_id_var, logger
+from utils.ad_stitching import stitch_ads
+from utils.generate_signed_url import sign_rendition_async
+from urllib.parse import urlencode
+from utils.hls_playlist import PLAYLIST_MEDIA_TYPE, render_master_playlist, render_playlist
+from utils.transcode_jobs import (
+    PENDING_STATUSES,
+    PLAYABLE_STATUSES,
+    STATUS_MISSING,
+    STATUS_READY,
+    STATUS_STREAMING,
+    get_transcode_status_async,
+)
+from utils.transcode_scheduler import PRIORITY_PREFETCH
 
 router = APIRouter()
 
+class Variant(BaseModel):
+    name: str = Field(..., example="96k")
+    bandwidth: int | None = Field(None, example=101376)
+    codecs: str = Field(..., example="mp4a.40.2")
+
+
+class Loudness(BaseModel):
+    integrated: float = Field(..., example=-19.5)
+    range: float | None = Field(None, example=5.2)
+    true_peak: float | None = Field(None, example=-3.2)
+    target: float = Field(..., example=-14.0)
+    # gain baked into the segments, and the gain players should still apply to reach the target
+    applied_gain: float = Field(0.0, example=0.0)
+    gain: float = Field(..., example=2.2)
+
+
 class SignResponse(BaseModel):
     success: bool
+    status: str = Field(STATUS_READY, example=STATUS_READY)
+    # "cmaf" renditions are a single byte-ranged object: play them through /signed_url/playlist
+    mode: str = Field("ts", example="ts")
     data: list[str] = Field(..., example=[
         "https://signed-url-example.com/audio/segment_000.ts?signature=abc123",
         "https://signed-url-example.com/audio/segment_001.ts?signature=def456",
         "https://signed-url-example.com/audio/segment_002.ts?signature=ghi789"
     ])
+    # bitrates of an adaptive rendition, pick one with the `variant` query parameter
+    variants: list[Variant] = []
+    loudness: Loudness | None = None
+    # the segments in `data` start at this index; `durations` covers every segment of the
+    # rendition so players can map a seek to the next window
+    start: int = Field(0, example=0)
+    segment_count: int | None = Field(None, example=36)
+    durations: list[float] = Field([], example=[10.0, 10.0, 10.0])
+
+
+class BatchSignRequest(BaseModel):
+    audio_ids: list[UUID4] = Field(
+        ...,
+        min_length=1,
+        max_length=settings.signed_url_cache.signed_url_batch_max_items,
+        example=["65614671-2214-4818-b3d1-454e-be39-c82afdd2748e"]
+    )
+    is_add: bool = Field(False, example=False)
+    expiration: int = Field(1200, example=1200)
+    # a batch answers with what is playable now: missing renditions are queued, not waited for
+    wait: float = Field(0, ge=0, le=settings.hls.hls_transcode_max_wait, example=0)
+    variant: str | None = Field(None, example="96k")
+    # sign only the first segments of every item, e.g. to prefetch the start of a queue
+    count: int | None = Field(None, ge=1, example=3)
+
+
+class BatchSignResponse(BaseModel):
+    success: bool
+    # one entry per distinct audio id, each reporting its own status
+    data: dict[str, SignResponse]
+
+
+class SourceInfo(BaseModel):
+    codec: str | None = Field(None, example="aac")
+    profile: str | None = Field(None, example="LC")
+    bitrate: int | None = Field(None, example=128000)
+    sample_rate: int | None = Field(None, example=44100)
+    channels: int | None = Field(None, example=2)
+    format: str | None = Field(None, example="mov,mp4,m4a,3gp,3g2,mj2")
+    duration: float | None = Field(None, example=215.3)
+
+
+class TranscodeStatus(BaseModel):
+    status: str = Field(..., example="processing")
+    message: str | None = None
+    updated_at: int | None = None
+    # the probed source of the last transcode, and whether its audio was copied as it is
+    source: SourceInfo | None = None
+    remux: bool | None = None
+    loudness: Loudness | None = None
+
+
+class StatusResponse(BaseModel):
+    success: bool
+    data: TranscodeStatus
+
+
+def _sign_response(manifest: dict, signed_urls: dict) -> SignResponse:
+    durations = manifest.get("durations")
+    if durations is None:
+        durations = [segment["duration"] or 0 for segment in manifest.get("segments", [])]
+
+    return SignResponse(
+        success=True,
+        status=STATUS_READY if manifest.get("complete", True) else STATUS_STREAMING,
+        mode=manifest.get("mode", "ts"),
+        data=list(signed_urls.values()),
+        variants=[
+            Variant(name=v["name"], bandwidth=v["bandwidth"], codecs=v["codecs"])
+            for v in manifest.get("variants") or []
+        ],
+        loudness=manifest.get("loudness"),
+        start=manifest.get("media_sequence", 0),
+        segment_count=manifest.get("segment_count", len(durations)),
+        durations=durations
+    )
 
 
-@router.get("/", response_model=SignResponse)
-def get_signed_url(
+@router.get("/", response_model=SignResponse, responses={202: {"model": SignResponse}})
+async def get_signed_url(
     audio_id: UUID4 = Query(..., example="65614671-2214-4818-b3d1-454e-be39-c82afdd2748e"),
     is_add: bool = Query(False, example=False),
-    expiration: int = Query(1200, example=1200)  # 20 minutes in seconds  
+    expiration: int = Query(1200, example=1200),  # 20 minutes in seconds  
+    wait: float = Query(settings.hls.hls_transcode_wait, ge=0, le=settings.hls.hls_transcode_max_wait, example=10),
+    variant: str | None = Query(None, example="96k"),
+    start: int | None = Query(None, ge=0, example=0),
+    offset: float | None = Query(None, ge=0, example=95.5),
+    count: int | None = Query(None, ge=1, example=3)
 ):
     """
     Generate a signed URL for the requested object using query parameters.
+
+    When the rendition does not exist yet a background transcode is started and the request
+    waits up to `wait` seconds for it; if it is still running the response is a 202 with an
+    empty list and the status to poll at `/signed_url/status`. While a streaming transcode is
+    still encoding, the segments produced so far are returned with the `streaming` status.
+    Adaptive renditions return the default bitrate unless `variant` names another one.
+
+    With `start` (a segment index) or `offset` (seconds), and `count`, only that window of
+    segments is signed; the response still carries the duration of every segment so the
+    player can request the next window lazily, or the window of a seek.
     """
 
     audio_id_str = str(audio_id)
+    windowed = start is not None or offset is not None or count is not None
 
-    signed_urls = generate_signed_urls_for_folder(
+    manifest, signed_urls = await sign_rendition_async(
         audio_id_str,
         is_add=is_add,
-        expiration=expiration
+        expiration=expiration,
+        wait=wait,
+        variant=variant,
+        start=start,
+        offset=offset,
+        count=count
     )
 
-    return SignResponse(
+    # a window past the last segment of a rendition is empty, not missing
+    if manifest is None or not (signed_urls or windowed):
+        status = (await get_transcode_status_async(audio_id_str, is_add))["status"]
+        response = SignResponse(success=False, status=status, data=[])
+        if status in PENDING_STATUSES:
+            return JSONResponse(status_code=202, content=response.model_dump())
+        if variant and status in PLAYABLE_STATUSES:
+            return JSONResponse(status_code=404, content=response.model_dump())
+        return response
+
+    return _sign_response(manifest, signed_urls)
+
+
+@router.post("/batch", response_model=BatchSignResponse)
+async def get_signed_urls_batch(request: BatchSignRequest):
+    """
+    Sign the renditions of many audio files at once, e.g. a playlist or the next items of a
+    queue, in one round trip.
+
+    Duplicate ids are signed once and the ids are resolved concurrently. Every id gets its own
+    entry: a rendition that is missing or still transcoding is reported with its status and an
+    empty list, and never fails the rest of the batch.
+    """
+    audio_ids = list(dict.fromkeys(str(audio_id) for audio_id in request.audio_ids))
+    semaphore = asyncio.Semaphore(settings.signed_url_cache.signed_url_batch_concurrency)
+
+    async def sign(audio_id: str) -> SignResponse:
+        # each id runs in its own task, so its log lines name its own track
+        audio_id_var.set(audio_id)
+        async with semaphore:
+            manifest, signed_urls = await sign_rendition_async(
+                audio_id,
+                is_add=request.is_add,
+                expiration=request.expiration,
+                wait=request.wait,
+                variant=request.variant,
+                count=request.count,
+                # upcoming items, not what is playing: their transcodes yield to interactive ones
+                priority=PRIORITY_PREFETCH
+            )
+            if signed_urls:
+                return _sign_response(manifest, signed_urls)
+
+            try:
+                status = (await get_transcode_status_async(audio_id, request.is_add))["status"]
+            except Exception as e:
+                logger.error(f"Error reading transcode status of {audio_id}: {e}")
+                status = STATUS_MISSING
+            return SignResponse(success=False, status=status, data=[])
+
+    responses = await asyncio.gather(*(sign(audio_id) for audio_id in audio_ids))
+    return BatchSignResponse(success=True, data=dict(zip(audio_ids, responses)))
+
+
+@router.get(
+    "/playlist",
+    response_class=Response,
+    responses={200: {"content": {PLAYLIST_MEDIA_TYPE: {}}}, 202: {"model": SignResponse}}
+)
+async def get_signed_playlist(
+    audio_id: UUID4 = Query(..., example="65614671-2214-4818-b3d1-454e-be39-c82afdd2748e"),
+    is_add: bool = Query(False, example=False),
+    expiration: int = Query(1200, example=1200),
+    wait: float = Query(settings.hls.hls_transcode_wait, ge=0, le=settings.hls.hls_transcode_max_wait, example=10),
+    variant: str | None = Query(None, example="96k"),
+    ads: bool = Query(False, example=False),
+    ad_interval: int | None = Query(None, ge=0, example=120)
+):
+    """
+    Return a ready-to-play m3u8 playlist of signed URLs with the real segment durations
+    (and byte ranges for CMAF renditions).
+
+    For adaptive renditions the master playlist is returned, its variants pointing back at
+    this endpoint with `variant` set, so the player switches bitrate on its own.
+
+    With `ads`, ad breaks from the rotation are stitched in: a pre-roll, then one every
+    `ad_interval` seconds (default `hls_ad_interval`), each between `#EXT-X-DISCONTINUITY` tags.
+    A break whose ad is not ready is skipped and the track plays on without a discontinuity.
+    The ads played are listed in the `X-Ad-Ids` header.
+    """
+    audio_id_str = str(audio_id)
+
+    manifest, signed_urls = await sign_rendition_async(
+        audio_id_str,
+        is_add=is_add,
+        expiration=expiration,
+        wait=wait,
+        variant=variant
+    )
+
+    if not signed_urls:
+        status = (await get_transcode_status_async(audio_id_str, is_add))["status"]
+        response = SignResponse(success=False, status=status, data=[])
+        return JSONResponse(status_code=202 if status in PENDING_STATUSES else 404, content=response.model_dump())
+
+    if manifest.get("variants") and not variant:
+        def variant_uri(v):
+            query = {"audio_id": audio_id_str, "is_add": str(is_add).lower(), "expiration": expiration, "variant": v["name"]}
+            if ads:
+                query["ads"] = "true"
+                if ad_interval is not None:
+                    query["ad_interval"] = ad_interval
+            return f"playlist?{urlencode(query)}"
+
+        return Response(content=render_master_playlist(manifest, variant_uri), media_type=PLAYLIST_MEDIA_TYPE)
+
+    if ads and not is_add:
+        playlist, ad_ids = await stitch_ads(manifest, signed_urls, audio_id_str, expiration, variant, ad_interval)
+        return Response(content=playlist, media_type=PLAYLIST_MEDIA_TYPE, headers={"X-Ad-Ids": ",".join(ad_ids)})
+
+    return Response(content=render_playlist(manifest, signed_urls), media_type=PLAYLIST_MEDIA_TYPE)
+
+
+@router.get("/status", response_model=StatusResponse)
+async def get_status(
+    audio_id: UUID4 = Query(..., example="65614671-2214-4818-b3d1-454e-be39-c82afdd2748e"),
+    is_add: bool = Query(False, example=False)
+):
+    """
+    Report whether the HLS rendition of an audio file is queued, processing, ready, failed or missing.
+    """
+    return StatusResponse(
         success=True,
-        data=list(signed_urls.values())
+        data=TranscodeStatus(**await get_transcode_status_async(str(audio_id), is_add))
     )
@@ -0,0 +1,59 @@
+from fastapi import APIRouter, Query
+from pydantic import BaseModel, Field, UUID4
+from utils.rendition_storage import delete_rendition
+from utils.transcode_scheduler import transcode_scheduler
+
+router = APIRouter()
+
+
+class WaitTimes(BaseModel):
+    avg: float = Field(..., example=0.4)
+    p95: float = Field(..., example=2.1)
+    max: float = Field(..., example=3.8)
+
+
+class SchedulerStats(BaseModel):
+    slots: int = Field(..., example=3)
+    ffmpeg_threads: int = Field(..., example=1)
+    running: int = Field(..., example=3)
+    queued: int = Field(..., example=5)
+    queued_by_priority: dict[str, int] = Field(..., example={"interactive": 1, "prefetch": 0, "ingest": 0, "backfill": 4})
+    completed: int = Field(..., example=120)
+    failed: int = Field(..., example=2)
+    # time recent transcodes spent queued before getting a slot
+    wait_seconds: WaitTimes
+
+
+class SchedulerResponse(BaseModel):
+    success: bool
+    data: SchedulerStats
+
+
+@router.get("/scheduler", response_model=SchedulerResponse)
+def get_scheduler_stats():
+    """
+    Report the transcode slots of this process, the queue depth per priority and recent wait times.
+    """
+    return SchedulerResponse(success=True, data=SchedulerStats(**transcode_scheduler.stats()))
+
+
+class DeletedRendition(BaseModel):
+    deleted: int = Field(..., example=42)
+
+
+class DeleteRenditionResponse(BaseModel):
+    success: bool
+    data: DeletedRendition
+
+
+@router.delete("/rendition", response_model=DeleteRenditionResponse)
+def delete_track_rendition(
+    audio_id: UUID4 = Query(..., example="65614671-2214-4818-b3d1-454e-be39-c82afdd2748e"),
+    is_add: bool = Query(False, example=False)
+):
+    """
+    Delete the rendition of a deleted track or ad with everything recorded about it: its
+    link to a shared rendition, which goes too once no other track links to it, its size
+    and recency for the sweeper, and its cached manifest and status.
+    """
+    return DeleteRenditionResponse(success=True, data=DeletedRendition(deleted=delete_rendition(str(audio_id), is_add)))
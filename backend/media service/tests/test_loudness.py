@@ -0,0 +1,117 @@
+"""
+The streaming loudness meter must agree with `pyloudnorm.Meter.integrated_loudness`. It reuses
+pyloudnorm's private K-weighting filters, so these tests are also what catches a pyloudnorm
+upgrade changing them.
+"""
+import numpy as np
+import pyloudnorm as pyln
+import pytest
+from utils.pyloudnorm import StreamingLoudnessMeter, _measure_array
+
+TOLERANCE_LU = 0.1
+SECONDS = 20
+# odd sizes, so filter state and gating blocks straddle the chunk boundaries
+CHUNK_FRAMES = (7, 997, 4410, 12345, 65536)
+
+
+def _tone(rate: int, frequency: float, amplitude: float, channels: int = None):
+    tone = amplitude * np.sin(2 * np.pi * frequency * np.arange(int(rate * SECONDS)) / rate)
+    return tone if channels is None else np.repeat(tone[:, None], channels, axis=1)
+
+
+def _noise(rate: int, channels: int, seed: int = 7):
+    return np.random.default_rng(seed).standard_normal((int(rate * SECONDS), channels)) * 0.1
+
+
+def _quiet_intro(rate: int):
+    audio = _noise(rate, 2)
+    audio[: len(audio) // 3] *= 0.01
+    return audio
+
+
+def _silence_gaps(rate: int):
+    audio = _noise(rate, 2)
+    for start in range(0, len(audio), 5 * rate):
+        audio[start:start + 2 * rate] = 0.0
+    return audio
+
+
+def _near_absolute_gate(rate: int):
+    # mostly below -70 LUFS, so the absolute gate decides which blocks count
+    audio = _noise(rate, 2) * 10 ** (-62 / 20)
+    audio[rate * 5:rate * 7] *= 100
+    return audio
+
+
+def _surround(rate: int):
+    audio = _noise(rate, 5)
+    audio[:, 2] *= 0.5
+    audio[:, 3:] *= 0.3
+    return audio
+
+
+SIGNALS = {
+    "tone_997hz_mono": lambda rate: _tone(rate, 997, 0.5),
+    "tone_997hz_stereo": lambda rate: _tone(rate, 997, 0.1, channels=2),
+    "tone_60hz_stereo": lambda rate: _tone(rate, 60, 0.5, channels=2),
+    "tone_10khz_stereo": lambda rate: _tone(rate, 10000, 0.2, channels=2),
+    "noise_stereo": lambda rate: _noise(rate, 2),
+    "quiet_intro": _quiet_intro,
+    "silence_gaps": _silence_gaps,
+    "near_absolute_gate": _near_absolute_gate,
+    "noise_3ch": lambda rate: _noise(rate, 3),
+    "surround_5ch": _surround,
+}
+
+
+def _reference(audio, rate: int) -> float:
+    return pyln.Meter(rate).integrated_loudness(audio)
+
+
+def _streamed(audio, rate: int, chunk_frames: int) -> float:
+    meter = StreamingLoudnessMeter(rate, channels=1 if audio.ndim == 1 else audio.shape[1])
+    for start in range(0, len(audio), chunk_frames):
+        meter.process(audio[start:start + chunk_frames])
+    return meter.integrated_loudness()
+
+
+@pytest.mark.parametrize("rate", [44100, 48000])
+@pytest.mark.parametrize("name", SIGNALS)
+def test_matches_pyloudnorm(name, rate):
+    audio = SIGNALS[name](rate)
+
+    assert _measure_array(audio, rate) == pytest.approx(_reference(audio, rate), abs=TOLERANCE_LU)
+
+
+@pytest.mark.parametrize("chunk_frames", CHUNK_FRAMES)
+def test_chunk_size_does_not_change_the_result(chunk_frames):
+    rate = 48000
+    # tiny chunks make the meter slow, a few gating blocks are enough for them
+    audio = _silence_gaps(rate)[rate:rate * (4 if chunk_frames < 100 else 9)]
+
+    assert _streamed(audio, rate, chunk_frames) == pytest.approx(_reference(audio, rate), abs=TOLERANCE_LU)
+
+
+def test_other_sample_rates():
+    for rate in (22050, 32000, 96000):
+        audio = _quiet_intro(rate)[: rate * 8]
+        assert _measure_array(audio, rate) == pytest.approx(_reference(audio, rate), abs=TOLERANCE_LU)
+
+
+def test_full_scale_tone_calibration():
+    # BS.1770: a 0 dBFS 997 Hz sine on one channel reads -3.01 LUFS
+    rate = 48000
+    assert _measure_array(_tone(rate, 997, 1.0), rate) == pytest.approx(-3.01, abs=TOLERANCE_LU)
+
+
+def test_silence_and_short_audio_are_minus_infinity():
+    rate = 48000
+    assert _measure_array(np.zeros((rate * 5, 2)), rate) == float("-inf")
+    assert _measure_array(_noise(rate, 2)[: int(rate * 0.3)], rate) == float("-inf")
+
+
+def test_rejects_unsupported_channel_counts():
+    with pytest.raises(ValueError):
+        StreamingLoudnessMeter(48000, channels=6)
+    with pytest.raises(ValueError):
+        StreamingLoudnessMeter(48000, channels=2).process(np.zeros((100, 3)))
@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+from utils import track_analysis
+from utils.track_analysis import waveform_peaks
+
+
+def _naive_peaks(samples, count: int) -> list:
+    count = min(count, len(samples))
+    peaks = []
+    for index in range(count):
+        window = samples[len(samples) * index // count:len(samples) * (index + 1) // count]
+        peaks.append(round(max(max(window), -min(window)) / 32768, 3))
+    return peaks
+
+
+def _pcm(tmp_path, samples):
+    path = tmp_path / "peaks.pcm"
+    np.asarray(samples, dtype="<i2").tofile(path)
+    return str(path)
+
+
+@pytest.mark.parametrize("chunk_samples", [7, 1000, 1 << 20])
+@pytest.mark.parametrize("total, count", [(48000, 800), (12345, 800), (500, 800), (1, 800), (100003, 1)])
+def test_matches_slice_by_slice_peaks(tmp_path, monkeypatch, chunk_samples, total, count):
+    monkeypatch.setattr(track_analysis, "PEAKS_CHUNK_SAMPLES", chunk_samples)
+    samples = np.random.default_rng(total).integers(-32768, 32768, total, dtype=np.int16)
+
+    assert waveform_peaks(_pcm(tmp_path, samples), count) == _naive_peaks(samples.tolist(), count)
+
+
+def test_full_scale_negative_samples(tmp_path):
+    assert waveform_peaks(_pcm(tmp_path, [0, -32768, 0, 0]), 2) == [1.0, 0.0]
+
+
+def test_empty_pcm(tmp_path):
+    assert waveform_peaks(_pcm(tmp_path, []), 800) == []
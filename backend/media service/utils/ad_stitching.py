@@ -0,0 +1,131 @@
+import asyncio
+import time
+import zlib
+from config.config import settings
+from libs.redis import async_redis_connection
+from libs.logger import logger
+from utils.generate_signed_url import sign_rendition_async
+from utils.hls_manifest import window_manifest
+from utils.hls_playlist import render_stitched_playlist
+from utils.signed_url_cache import ExpiryWindow
+
+
+# audio ids of the ads in rotation, a Redis set kept in sync with the active ads by the API
+AD_ROTATION_KEY = "hls_ad_rotation"
+
+
+class AdRotation:
+    """
+    The ads in rotation, read from Redis at most every `hls_ad_rotation_ttl` seconds.
+    """
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self._ads = []
+        self._expires_at = 0
+
+    async def ads(self) -> list:
+        if time.monotonic() < self._expires_at:
+            return self._ads
+
+        try:
+            members = await async_redis_connection.smembers(AD_ROTATION_KEY)
+            self._ads = sorted(member.decode() for member in members)
+        except Exception as e:
+            # keep serving the last known rotation
+            logger.error(f"Error reading the ad rotation: {e}")
+        self._expires_at = time.monotonic() + self.ttl
+        return self._ads
+
+    async def pick(self, audio_id: str, window: ExpiryWindow, ad_break: int):
+        """
+        Choose the ad of a break. The choice only depends on the track, the break and the expiry
+        window, so a player reloading the playlist during the window gets the same ads.
+        """
+        ads = await self.ads()
+        if not ads:
+            return None
+        return ads[zlib.crc32(f"{audio_id}:{window.bucket}:{ad_break}".encode()) % len(ads)]
+
+
+ad_rotation = AdRotation(settings.hls.hls_ad_rotation_ttl)
+
+
+def ad_break_positions(manifest: dict, interval: int) -> list:
+    """
+    Return the indexes of the segments an ad break plays before: a pre-roll, then the first
+    segment boundary after every `interval` seconds of the track. There is no post-roll.
+    """
+    positions = [0]
+    if interval <= 0:
+        return positions
+
+    elapsed = 0.0
+    next_break = interval
+    segments = manifest.get("segments", [])
+    for index, segment in enumerate(segments[:-1]):
+        elapsed += segment["duration"] or 0
+        if elapsed >= next_break:
+            positions.append(index + 1)
+            while next_break <= elapsed:
+                next_break += interval
+
+    return positions
+
+
+async def _sign_ad(ad_id: str, expiration: int, variant: str = None):
+    manifest, signed_urls = await sign_rendition_async(ad_id, expiration=expiration, is_add=True, variant=variant)
+    if manifest is None and variant:
+        # an ad without the track's bitrate plays at its default one
+        manifest, signed_urls = await sign_rendition_async(ad_id, expiration=expiration, is_add=True)
+    return manifest, signed_urls
+
+
+async def stitch_ads(manifest: dict, signed_urls: dict, audio_id: str, expiration: int, variant: str = None, interval: int = None):
+    """
+    Render the signed playlist of a track with ad breaks stitched in.
+
+    Ads are regular renditions, transcoded once with the tracks' encoder settings and signed
+    through the same cache as tracks, so a listener's ads cost nothing but playlist assembly.
+    Ads that are not fully transcoded yet (or in another output mode) are left out; the attempt to
+    sign them queues their transcode.
+    Args:
+        manifest (dict): The signed (variant) manifest of the track.
+        signed_urls (dict): The signed URLs of the track.
+        audio_id (str): The ID of the track.
+        expiration (int): Minimum URL lifetime in seconds.
+        variant (str): The bitrate variant being played, also used for the ads.
+        interval (int): Seconds between ad breaks, defaults to `hls_ad_interval`.
+    Returns:
+        tuple: The m3u8 playlist and the audio ids of the ads it plays, in order.
+    """
+    interval = settings.hls.hls_ad_interval if interval is None else interval
+    window = ExpiryWindow(expiration)
+    positions = ad_break_positions(manifest, interval)
+
+    chosen = [await ad_rotation.pick(audio_id, window, index) for index in range(len(positions))]
+    distinct = [ad_id for ad_id in dict.fromkeys(chosen) if ad_id]
+    signed = dict(zip(distinct, await asyncio.gather(*(_sign_ad(ad_id, expiration, variant) for ad_id in distinct))))
+
+    pieces = []
+    played = []
+    # the track is only cut where an ad actually plays: across a skipped break it plays on
+    # without a discontinuity
+    track_start = 0
+    for position, ad_id in zip(positions, chosen):
+        ad_manifest, ad_urls = signed.get(ad_id) or (None, {})
+        playable = ad_urls and ad_manifest.get("complete", True)
+        if not playable or bool(ad_manifest.get("init")) != bool(manifest.get("init")):
+            continue
+
+        if position > track_start:
+            pieces.append((window_manifest(manifest, start=track_start, count=position - track_start), signed_urls))
+            track_start = position
+        pieces.append((ad_manifest, ad_urls))
+        played.append(ad_id)
+
+    end = len(manifest.get("segments", []))
+    if end > track_start:
+        pieces.append((window_manifest(manifest, start=track_start, count=end - track_start), signed_urls))
+
+    return render_stitched_playlist(pieces, complete=manifest.get("complete", True)), played
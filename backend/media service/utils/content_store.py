@@ -0,0 +1,256 @@
+import base64
+import binascii
+import hashlib
+import json
+import uuid
+from config.config import settings
+from libs.redis import redis_connection
+from libs.s3_client import client
+from libs.logger import logger
+from utils.hls_manifest import HLS_BUCKET_NAME, MANIFEST_FILE_NAME, save_manifest
+
+
+# renditions shared by every upload of the same content live under cas/<content key>/
+CONTENT_ROOT = "cas/"
+# the content key every linked track plays, also once its manifest is gone
+CONTENT_LINKS_KEY = "hls_content_links"
+
+# Delete the lock only if it is still held by the given owner token
+RELEASE_CONTENT_LOCK_SCRIPT = redis_connection.register_script("""
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+""")
+
+
+def content_prefix(content_key: str) -> str:
+    return f"{CONTENT_ROOT}{content_key}/"
+
+
+def new_generation_prefix(content_key: str) -> str:
+    """
+    A fresh prefix under the content key for one encode. Tracks keep playing the generation
+    of the content manifest until the encode succeeds and replaces it, so a failed or
+    concurrent encode never touches the objects they play.
+    """
+    return f"{content_prefix(content_key)}{uuid.uuid4().hex[:12]}/"
+
+
+def content_lock_key(content_key: str) -> str:
+    return f"hls_content_lock:{content_key}"
+
+
+def acquire_content_lock(content_key: str):
+    """
+    Take the lock of a content key, held while a rendition of it is encoded, since the
+    transcode lock only covers one upload.
+    Returns:
+        str | None: The owner token, or None when another encode of the content holds it.
+    """
+    token = uuid.uuid4().hex
+    acquired = redis_connection.set(content_lock_key(content_key), token, nx=True, ex=settings.hls.hls_transcode_lock_ttl)
+    return token if acquired else None
+
+
+def release_content_lock(content_key: str, token: str) -> bool:
+    return bool(RELEASE_CONTENT_LOCK_SCRIPT(keys=[content_lock_key(content_key)], args=[token]))
+
+
+def content_manifest_key(content_key: str) -> str:
+    return f"hls_content_manifest:{content_key}"
+
+
+def content_refs_key(content_key: str) -> str:
+    return f"hls_content_refs:{content_key}"
+
+
+def _ref(audio_id: str, is_add: bool = False) -> str:
+    # same member format as the sizes and access times of utils.rendition_storage
+    return f"{'add' if is_add else 'music'}:{audio_id}"
+
+
+def source_digest(bucket_name: str, object_key: str):
+    """
+    Identify the content of a source object from its metadata, without reading it: the
+    SHA-256 checksum S3 stored on upload or, when enabled, the ETag and size.
+    Returns:
+        str | None: The digest, or None when the object carries no usable checksum.
+    """
+    head = client.head_object(Bucket=bucket_name, Key=object_key, ChecksumMode="ENABLED")
+
+    checksum = head.get("ChecksumSHA256")
+    if checksum:
+        # multipart uploads carry a checksum of the part checksums, suffixed with the part count
+        value, _, parts = checksum.partition("-")
+        try:
+            value = base64.b64decode(value).hex()
+        except (binascii.Error, ValueError):
+            pass
+        return f"sha256:{value}{f'-{parts}' if parts else ''}"
+
+    etag = (head.get("ETag") or "").strip('"')
+    if etag and settings.hls.hls_content_key_etag_fallback:
+        return f"etag:{etag}:{head.get('ContentLength')}"
+
+    return None
+
+
+def content_key(digest: str, profile: dict) -> str:
+    """
+    Key of the rendition of a source content encoded with a profile (outputs, segmenting), so
+    a change of encoder settings never links to renditions made with the old ones.
+    """
+    identity = json.dumps({"source": digest, "profile": profile}, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(identity.encode("utf-8")).hexdigest()[:40]
+
+
+def save_content_manifest(manifest: dict, bucket_name: str = HLS_BUCKET_NAME):
+    """
+    Persist the manifest of a complete shared rendition in Redis and next to its objects.
+    """
+    key = manifest["content_key"]
+    body = json.dumps(manifest, separators=(",", ":"))
+    client.put_object(
+        Bucket=bucket_name,
+        Key=f"{content_prefix(key)}{MANIFEST_FILE_NAME}",
+        Body=body.encode("utf-8"),
+        ContentType="application/json"
+    )
+
+    try:
+        redis_connection.set(content_manifest_key(key), body, ex=settings.hls.hls_manifest_ttl)
+    except Exception as e:
+        logger.error(f"Error caching content manifest {key}: {e}")
+
+
+def load_content_manifest(key: str, bucket_name: str = HLS_BUCKET_NAME):
+    """
+    Return the manifest of the complete shared rendition of a content key, or None.
+    """
+    try:
+        cached = redis_connection.get(content_manifest_key(key))
+        if cached:
+            return json.loads(cached)
+    except Exception as e:
+        logger.error(f"Error reading cached content manifest {key}: {e}")
+
+    try:
+        response = client.get_object(Bucket=bucket_name, Key=f"{content_prefix(key)}{MANIFEST_FILE_NAME}")
+    except client.exceptions.NoSuchKey:
+        return None
+
+    body = response["Body"].read()
+    try:
+        redis_connection.set(content_manifest_key(key), body, ex=settings.hls.hls_manifest_ttl)
+    except Exception as e:
+        logger.error(f"Error caching content manifest {key}: {e}")
+    return json.loads(body)
+
+
+def add_content_ref(key: str, audio_id: str, is_add: bool = False):
+    ref = _ref(audio_id, is_add)
+    pipeline = redis_connection.pipeline()
+    pipeline.sadd(content_refs_key(key), ref)
+    pipeline.hset(CONTENT_LINKS_KEY, ref, key)
+    pipeline.execute()
+
+
+def linked_content(audio_id: str, is_add: bool = False):
+    """
+    Return the key of the shared rendition a track plays, or None.
+    """
+    key = redis_connection.hget(CONTENT_LINKS_KEY, _ref(audio_id, is_add))
+    return key.decode() if isinstance(key, bytes) else key
+
+
+def remove_content_ref(key: str, audio_id: str, is_add: bool = False) -> list:
+    """
+    Drop the reference of a rendition to a shared one. Returns the references left.
+    """
+    ref = _ref(audio_id, is_add)
+    pipeline = redis_connection.pipeline()
+    pipeline.srem(content_refs_key(key), ref)
+    # only forget the link when it still is to this key, not to the one replacing it
+    pipeline.hget(CONTENT_LINKS_KEY, ref)
+    pipeline.smembers(content_refs_key(key))
+    _, linked, refs = pipeline.execute()
+    if linked is not None and (linked.decode() if isinstance(linked, bytes) else linked) == key:
+        redis_connection.hdel(CONTENT_LINKS_KEY, ref)
+    return sorted(ref.decode() if isinstance(ref, bytes) else ref for ref in refs)
+
+
+def content_refs(key: str) -> list:
+    return sorted(ref.decode() if isinstance(ref, bytes) else ref for ref in redis_connection.smembers(content_refs_key(key)))
+
+
+def link_rendition(audio_id: str, is_add: bool, manifest: dict, bucket_name: str = HLS_BUCKET_NAME) -> dict:
+    """
+    Make a track play a shared rendition: its manifest becomes a copy of the shared one, still
+    pointing at the objects under cas/. No segment is written.
+    Returns:
+        dict: The manifest of the track.
+    """
+    linked = dict(manifest, audio_id=audio_id, is_add=is_add)
+    add_content_ref(manifest["content_key"], audio_id, is_add)
+    save_manifest(linked, bucket_name)
+    return linked
+
+
+def relink_content(manifest: dict, bucket_name: str = HLS_BUCKET_NAME, skip: tuple = None):
+    """
+    Point every track linked to a shared rendition at its current manifest, e.g. after a new
+    generation replaced the one they play.
+    Args:
+        manifest (dict): The new content manifest.
+        skip (tuple): The (audio_id, is_add) whose manifest is already saved.
+    """
+    for ref in content_refs(manifest["content_key"]):
+        kind, _, audio_id = ref.partition(":")
+        if (audio_id, kind == "add") == skip:
+            continue
+        try:
+            save_manifest(dict(manifest, audio_id=audio_id, is_add=kind == "add"), bucket_name)
+        except Exception as e:
+            logger.error(f"Error relinking {ref} to {manifest['prefix']}: {e}")
+
+
+def _in_use(key: str) -> bool:
+    content, _, generation = key.partition("/")
+    if generation:
+        # a generation is in use while the content manifest points at it
+        current = load_content_manifest(content)
+        return current is not None and current.get("prefix") == content_prefix(key)
+    return bool(content_refs(key))
+
+
+def delete_content(key: str, bucket_name: str = HLS_BUCKET_NAME) -> int:
+    """
+    Delete every object of a shared rendition, or of one generation of it as `<key>/<generation>`,
+    and forget it. Nothing is deleted while tracks still link to the rendition or while the
+    generation is the one they play.
+    Returns the number of objects deleted.
+    """
+    if _in_use(key):
+        logger.info(f"Keeping the shared rendition {key}, it is still linked")
+        return 0
+
+    prefix = content_prefix(key)
+    deleted = 0
+    paginator = client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        keys = [{"Key": obj["Key"]} for obj in page.get("Contents", [])]
+        if keys:
+            client.delete_objects(Bucket=bucket_name, Delete={"Objects": keys, "Quiet": True})
+            deleted += len(keys)
+
+    redis_connection.delete(content_manifest_key(key), content_refs_key(key))
+    return deleted
+
+
+def content_size(key: str, bucket_name: str = HLS_BUCKET_NAME) -> int:
+    size = 0
+    paginator = client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=content_prefix(key)):
+        size += sum(obj["Size"] for obj in page.get("Contents", []))
+    return size
@@ -1,96 +1,956 @@
+import functools
+import json
 import subprocess
 import os
+import re
+import threading
+import time
 from libs.s3_client import client
-import datetime
+from libs.logger import logger
 import tempfile
 from config.config import settings
 import shutil
+from utils.segment_uploader import SegmentUploader
+from utils.transcode_scheduler import ffmpeg_threads
+from utils.hls_playlist import compile_playlist, render_master_playlist
+from utils.rendition_storage import release_content, retire_generation
+from utils.metrics import ffmpeg_cpu_seconds, ffmpeg_wall_seconds
+from utils.track_analysis import ANALYSIS_FILE_NAME, EXCERPT_FILE_NAME, analysis_ffmpeg_args, write_track_analysis
+from utils.content_store import (
+    acquire_content_lock,
+    add_content_ref,
+    content_key,
+    link_rendition,
+    linked_content,
+    load_content_manifest,
+    new_generation_prefix,
+    relink_content,
+    release_content_lock,
+    save_content_manifest,
+    source_digest,
+)
+from utils.track_loudness import (
+    EBUR128_FILTER,
+    load_track_loudness,
+    loudness_metadata,
+    normalization_gain,
+    parse_ebur128_summary,
+    save_track_loudness,
+)
+from utils.hls_manifest import (
+    PLAYLIST_FILE_NAME,
+    VARIANT_PLAYLIST_FILE_NAME,
+    build_manifest,
+    build_variant,
+    discard_manifest,
+    parse_m3u8,
+    parse_m3u8_map,
+    rendition_prefix,
+    save_manifest,
+)
 
 HLS_BUCKET_NAME = settings.s3_storage.hls_bucket_name or "hls-playlist"
 SOURCE_BUCKET = settings.s3_storage.s3_bucket_name
 
+OUTPUT_MODE_TS = "ts"
+OUTPUT_MODE_CMAF = "cmaf"
+CMAF_MEDIA_FILE_NAME = "audio.mp4"
+# ffmpeg writes chunks, which are grouped into the segments of the rendition
+CHUNK_FILE_NAME = "chunk_%04d.ts"
+SEGMENT_FILE_NAME = "segment_{:03d}.ts"
 
-def generate_hls(audio_id: str, is_add: bool = False):
+DEFAULT_BITRATE = "128k"
+AAC_LC_CODECS = "mp4a.40.2"
+HE_AAC_CODECS = "mp4a.40.5"
+# below this bitrate HE-AAC sounds noticeably better than AAC-LC
+HE_AAC_MAX_BITRATE = 64000
+# AAC profiles, as reported by ffprobe, that can be segmented as they are
+AAC_PROFILE_CODECS = {"LC": AAC_LC_CODECS, "HE-AAC": HE_AAC_CODECS, "HE-AACv2": "mp4a.40.29"}
+REMUX_SAMPLE_RATES = (22050, 24000, 32000, 44100, 48000)
+
+
+@functools.lru_cache(maxsize=1)
+def _ffmpeg_encoders() -> str:
+    try:
+        return subprocess.run(
+            ["ffmpeg", "-hide_banner", "-encoders"],
+            capture_output=True,
+            text=True,
+            check=True
+        ).stdout
+    except Exception as e:
+        logger.error(f"Error listing ffmpeg encoders: {e}")
+        return ""
+
+
+def _bitrate(value: str) -> int:
+    value = value.strip().lower()
+    if value.endswith("k"):
+        return int(float(value[:-1]) * 1000)
+    return int(value)
+
+
+def _encoder(bitrate: str):
     """
-    Generate HLS for the given audio file from the MinIO source bucket and upload to the target bucket.
+    Return the codec arguments and RFC 6381 codec string of one AAC output. Low bitrates use
+    HE-AAC when ffmpeg is built with libfdk_aac, the native encoder only does AAC-LC.
+    """
+    if _bitrate(bitrate) <= HE_AAC_MAX_BITRATE and " libfdk_aac " in _ffmpeg_encoders():
+        return ["-c:a", "libfdk_aac", "-profile:a", "aac_he", "-b:a", bitrate], HE_AAC_CODECS
+    return ["-c:a", "aac", "-b:a", bitrate], AAC_LC_CODECS
+
+
+def _int(value):
+    return int(value) if value and str(value).isdigit() else None
+
+
+def probe_source(input_file: str):
+    """
+    Describe the first audio stream of a source with ffprobe.
     Args:
-        audio_id (str): The ID of the audio file (used to form the file names and directories).
+        input_file (str): A local path or an (presigned) URL ffprobe can read.
     Returns:
-        dict: Status message.
+        dict | None: The `codec`, `profile`, `bitrate`, `sample_rate`, `channels`, container
+            `format` and `duration` of the source, or None when it could not be probed.
+    """
+    try:
+        result = subprocess.run(
+            [
+                "ffprobe", "-v", "error",
+                "-select_streams", "a:0",
+                "-show_entries", "stream=codec_name,profile,bit_rate,sample_rate,channels:format=format_name,bit_rate,duration",
+                "-of", "json",
+                input_file
+            ],
+            capture_output=True,
+            text=True,
+            check=True,
+            timeout=settings.hls.hls_probe_timeout
+        )
+        info = json.loads(result.stdout)
+    except Exception as e:
+        logger.error(f"Error probing audio source: {e}")
+        return None
+
+    streams = info.get("streams") or []
+    if not streams:
+        return None
+
+    stream = streams[0]
+    container = info.get("format") or {}
+    duration = container.get("duration")
+    return {
+        "codec": stream.get("codec_name"),
+        "profile": stream.get("profile"),
+        # MP4 reports the stream bitrate, raw ADTS only the overall one
+        "bitrate": _int(stream.get("bit_rate")) or _int(container.get("bit_rate")),
+        "sample_rate": _int(stream.get("sample_rate")),
+        "channels": stream.get("channels"),
+        "format": container.get("format_name"),
+        "duration": float(duration) if duration and duration != "N/A" else None,
+    }
+
+
+def can_remux(source: dict) -> bool:
+    """
+    Whether a probed source can be segmented with `-c:a copy`: AAC that players decode, at or
+    below the bitrate it would be re-encoded to. Sources of unknown bitrate are re-encoded.
     """
+    return bool(
+        settings.hls.hls_remux_enabled
+        and source
+        and source["codec"] == "aac"
+        and source["profile"] in AAC_PROFILE_CODECS
+        and source["bitrate"]
+        and source["bitrate"] <= settings.hls.hls_remux_max_bitrate
+        and source["sample_rate"] in REMUX_SAMPLE_RATES
+        and source["channels"] in (1, 2)
+    )
 
+
+def rendition_outputs(output_dir: str, abr: bool = False, source: dict = None, gain: float = None) -> list:
+    """
+    Describe the outputs of one transcode: a single 128k rendition, or one output per bitrate
+    of the configured ladder, each in its own directory.
+    Args:
+        output_dir (str): The local directory of the rendition.
+        abr (bool): Whether to encode the whole bitrate ladder.
+        source (dict): The probed source. A single rendition of a compatible AAC source copies
+            the audio instead of re-encoding it.
+        gain (float): Gain in dB applied before encoding; copied audio is left as it is.
+    Returns:
+        list: Output dicts with the variant `name`, local `dir`, `playlist` file name, the
+            `uri_prefix` of its files in the rendition and its encoder settings.
+    """
+    if not abr:
+        remux = can_remux(source)
+        if remux:
+            bitrate, codec_args, codecs = str(source["bitrate"]), ["-c:a", "copy"], AAC_PROFILE_CODECS[source["profile"]]
+        else:
+            bitrate = DEFAULT_BITRATE
+            codec_args, codecs = _encoder(bitrate)
+        return [{
+            "name": None,
+            "dir": output_dir,
+            "playlist": PLAYLIST_FILE_NAME,
+            "uri_prefix": "",
+            "bitrate": bitrate,
+            "codec_args": codec_args,
+            "codecs": codecs,
+            "remux": remux,
+            "gain": None if remux else gain,
+        }]
+
+    outputs = []
+    for bitrate in settings.hls.hls_abr_ladder.split(","):
+        bitrate = bitrate.strip()
+        codec_args, codecs = _encoder(bitrate)
+        outputs.append({
+            "name": bitrate,
+            "dir": os.path.join(output_dir, bitrate),
+            "playlist": VARIANT_PLAYLIST_FILE_NAME,
+            "uri_prefix": f"{bitrate}/",
+            "bitrate": bitrate,
+            "codec_args": codec_args,
+            "codecs": codecs,
+            "remux": False,
+            "gain": gain,
+        })
+    return outputs
+
+
+def _chunk_duration() -> int:
+    """
+    The segment length ffmpeg cuts at: the fast start length, or the full segment length.
+    """
+    if settings.hls.hls_fast_start_enabled:
+        return settings.hls.hls_fast_start_segment_duration
+    return settings.hls.hls_segment_duration
+
+
+def intro_segment_count() -> int:
+    return settings.hls.hls_fast_start_segments if settings.hls.hls_fast_start_enabled else 0
+
+
+def _chunks_per_segment(index: int) -> int:
+    """
+    Number of ffmpeg chunks making up segment `index`: one for the fast start segments, enough
+    for about `hls_segment_duration` seconds after them.
+    """
+    if index < intro_segment_count():
+        return 1
+    return max(1, round(settings.hls.hls_segment_duration / _chunk_duration()))
+
+
+def build_ffmpeg_command(input_file: str, outputs: list, output_mode: str = OUTPUT_MODE_TS, measure_loudness: bool = True, analysis_dir: str = None) -> list:
+    """
+    Build the ffmpeg command that segments `input_file` into every output in one pass, so the
+    source is decoded once however many bitrates are encoded.
+    Args:
+        input_file (str): The source path, or `pipe:0` to read from stdin.
+        outputs (list): The outputs returned by `rendition_outputs`.
+        output_mode (str): `ts` for one MPEG-TS file per segment, `cmaf` for a single
+            fragmented MP4 file addressed with `#EXT-X-BYTERANGE`.
+        measure_loudness (bool): Also meter the decoded source with ebur128; the result is
+            logged when ffmpeg exits, see `parse_ebur128_summary`.
+        analysis_dir (str): Also write the raw outputs of the track analysis there, see
+            `utils.track_analysis`.
+    Returns:
+        list: The command line.
+    """
+    # pinned thread counts keep every busy scheduler slot from oversubscribing the cores
+    threads = str(ffmpeg_threads())
+    # -benchmark logs the user, system and real time of the run when ffmpeg exits
+    cmd = ["ffmpeg", "-nostats", "-benchmark", "-threads", threads, "-i", input_file]
+
+    for output in outputs:
+        if output_mode == OUTPUT_MODE_CMAF:
+            segment_args = [
+                "-hls_segment_type", "fmp4",
+                "-hls_flags", "independent_segments+single_file",
+                "-hls_segment_filename", f"{output['dir']}/{CMAF_MEDIA_FILE_NAME}",
+            ]
+        else:
+            segment_args = [
+                # temp_file makes ffmpeg rename each chunk into place once it is complete
+                "-hls_flags", "independent_segments+temp_file",
+                "-hls_segment_filename", f"{output['dir']}/{CHUNK_FILE_NAME}",
+            ]
+
+        filter_args = ["-af", f"volume={output['gain']:.2f}dB"] if output.get("gain") else []
+        cmd += [
+            "-map", "0:a:0",
+            "-vn",
+            *filter_args,
+            *output["codec_args"],
+            "-threads", threads,
+            "-f", "hls",
+            "-hls_time", str(_chunk_duration()),
+            "-hls_list_size", "0",
+            *segment_args,
+            f"{output['dir']}/{output['playlist']}"
+        ]
+
+    if analysis_dir:
+        cmd += analysis_ffmpeg_args(analysis_dir)
+
+    if measure_loudness:
+        # shares the decode of the encoded outputs, only the metering itself is extra work
+        cmd += ["-map", "0:a:0", "-af", EBUR128_FILTER, "-f", "null", "-"]
+
+    return cmd
+
+
+def build_rendition_manifest(audio_id: str, is_add: bool, outputs: list, complete: bool = True, loudness: dict = None, prefix: str = None, content_key: str = None, analysis: str = None) -> dict:
+    """
+    Build the manifest of a rendition from the segments each output has published so far,
+    stored under `prefix` (the track's own by default).
+    """
+    if len(outputs) == 1 and outputs[0]["name"] is None:
+        output = outputs[0]
+        return build_manifest(
+            audio_id,
+            output["segments"],
+            is_add=is_add,
+            complete=complete,
+            init=output.get("init"),
+            loudness=loudness,
+            intro_segments=intro_segment_count(),
+            prefix=prefix,
+            content_key=content_key,
+            analysis=analysis
+        )
+
+    variants = [
+        build_variant(
+            output["name"],
+            output["codecs"],
+            output["segments"],
+            init=output.get("init"),
+            nominal_bandwidth=_bitrate(output["bitrate"])
+        )
+        for output in outputs
+    ]
+    return build_manifest(
+        audio_id,
+        [],
+        is_add=is_add,
+        complete=complete,
+        variants=variants,
+        default_variant=settings.hls.hls_abr_default_variant,
+        loudness=loudness,
+        intro_segments=intro_segment_count(),
+        prefix=prefix,
+        content_key=content_key,
+        analysis=analysis
+    )
+
+
+def _delete_uploaded(object_names: list):
+    """
+    Remove the segments of a failed transcode so a half rendition is never served.
+    """
+    for start in range(0, len(object_names), 1000):
+        batch = object_names[start:start + 1000]
+        try:
+            client.delete_objects(
+                Bucket=HLS_BUCKET_NAME,
+                Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True}
+            )
+        except Exception as e:
+            logger.error(f"Error removing partial HLS segments: {e}")
+
+
+def _read_playlist(playlist_path: str) -> str:
+    try:
+        with open(playlist_path, "r") as playlist_file:
+            return playlist_file.read()
+    except FileNotFoundError:
+        return ""
+
+
+def _read_output_playlist(output: dict, start: int = 0):
+    """
+    Parse the playlist ffmpeg wrote for an output.
+    Args:
+        output (dict): The output.
+        start (int): Skip the segments before this index, e.g. those already uploaded.
+    Returns:
+        tuple: The segments from `start` on, with uris relative to the rendition prefix and
+            their `size` in bytes, and the init section of CMAF outputs.
+    """
+    playlist = _read_playlist(os.path.join(output["dir"], output["playlist"]))
+    init = parse_m3u8_map(playlist)
+    if init:
+        init["uri"] = output["uri_prefix"] + init["uri"]
+
+    segments = []
+    for segment in parse_m3u8(playlist)[start:]:
+        if segment.get("byterange"):
+            size = segment["byterange"][0]
+        else:
+            size = os.path.getsize(os.path.join(output["dir"], segment["uri"]))
+        segments.append(dict(segment, uri=output["uri_prefix"] + segment["uri"], size=size))
+
+    return segments, init
+
+
+def _merge_chunks(output: dict, chunks: list, index: int) -> dict:
+    """
+    Turn consecutive ffmpeg chunks into segment `index`. MPEG-TS chunks of one muxer run are
+    a continuous stream, so they are joined byte for byte; CMAF chunks are adjacent byte
+    ranges of the media file and only their ranges are merged.
+    """
+    duration = sum(chunk["duration"] or 0 for chunk in chunks)
+    size = sum(chunk["size"] for chunk in chunks)
+    if chunks[0].get("byterange"):
+        return dict(chunks[0], duration=duration, size=size, byterange=[size, chunks[0]["byterange"][1]])
+
+    name = SEGMENT_FILE_NAME.format(index)
+    segment_path = os.path.join(output["dir"], name)
+    chunk_paths = [os.path.join(output["dir"], chunk["uri"][len(output["uri_prefix"]):]) for chunk in chunks]
+    if len(chunk_paths) == 1:
+        os.replace(chunk_paths[0], segment_path)
+    else:
+        with open(segment_path, "wb") as segment_file:
+            for chunk_path in chunk_paths:
+                with open(chunk_path, "rb") as chunk_file:
+                    shutil.copyfileobj(chunk_file, segment_file)
+                os.remove(chunk_path)
+
+    return {"uri": output["uri_prefix"] + name, "duration": duration, "size": size}
+
+
+def _collect_segments(output: dict, finished: bool = True) -> list:
+    """
+    Read the chunks ffmpeg listed since the last call and group them into segments, see
+    `_chunks_per_segment`. Also stores the init section of CMAF outputs in `output["init"]`.
+    Args:
+        output (dict): The output.
+        finished (bool): Whether ffmpeg is done, so a last incomplete group is a segment too.
+    Returns:
+        list: The new segments, in playlist order.
+    """
+    output.setdefault("chunks", [])
+    output.setdefault("chunks_listed", 0)
+    output.setdefault("segment_count", 0)
+
+    chunks, output["init"] = _read_output_playlist(output, start=output["chunks_listed"])
+    output["chunks_listed"] += len(chunks)
+    output["chunks"].extend(chunks)
+
+    segments = []
+    while output["chunks"]:
+        size = _chunks_per_segment(output["segment_count"])
+        if len(output["chunks"]) < size and not finished:
+            break
+        group, output["chunks"] = output["chunks"][:size], output["chunks"][size:]
+        segments.append(_merge_chunks(output, group, output["segment_count"]))
+        output["segment_count"] += 1
+
+    return segments
+
+
+def _write_output_playlist(output: dict, segments: list):
+    """
+    Replace ffmpeg's playlist of the chunks with the playlist of the segments.
+    """
+    relative = len(output["uri_prefix"])
+    items = segments + ([output["init"]] if output.get("init") else [])
+    playlist = {
+        "prefix": "",
+        "init": output.get("init"),
+        "segments": segments,
+        "complete": True,
+        "target_duration": max((segment["duration"] for segment in segments), default=None),
+    }
+    with open(os.path.join(output["dir"], output["playlist"]), "w") as playlist_file:
+        playlist_file.write(compile_playlist(playlist).render({item["uri"]: item["uri"][relative:] for item in items}))
+
+
+_BENCHMARK = re.compile(r"bench: utime=([\d.]+)s stime=([\d.]+)s rtime=([\d.]+)s")
+
+
+def _record_ffmpeg_times(ffmpeg_log):
+    """
+    Observe the CPU and wall time of a finished ffmpeg run from the -benchmark line of its log.
+    """
+    ffmpeg_log.seek(0)
+    match = _BENCHMARK.search(ffmpeg_log.read())
+    if match is None:
+        return
+    utime, stime, rtime = (float(value) for value in match.groups())
+    ffmpeg_cpu_seconds.observe(utime + stime)
+    ffmpeg_wall_seconds.observe(rtime)
+
+
+def _rendition_loudness(audio_id: str, is_add: bool, outputs: list, ffmpeg_log):
+    """
+    Read the loudness ffmpeg measured from its log, remember it for the track and describe it
+    for the manifest, with the gain the encoded outputs already carry.
+    """
+    ffmpeg_log.seek(0)
+    measurement = parse_ebur128_summary(ffmpeg_log.read())
+    if measurement is None:
+        logger.info(f"No loudness measured for {audio_id}")
+        return None
+
+    save_track_loudness(audio_id, is_add, measurement)
+    loudness = loudness_metadata(measurement, outputs[0].get("gain"))
+    logger.info(f"Loudness of {audio_id}: {loudness}")
+    return loudness
+
+
+def _analysis_dir(output_dir: str):
+    # beside the output directories, so it is never uploaded as part of an output
+    return os.path.join(output_dir, "analysis") if settings.hls.hls_analysis_enabled else None
+
+
+def _upload_analysis(audio_id: str, analysis_dir: str, source: dict, loudness: dict, prefix: str, uploader: SegmentUploader):
+    """
+    Write the analysis sidecar from the analysis outputs of ffmpeg and queue its upload next
+    to the rendition. A failed analysis is logged and leaves the rendition without one.
+    Returns:
+        list: The object names queued, empty without an analysis.
+    """
+    if not analysis_dir:
+        return []
+
+    try:
+        analysis = write_track_analysis(analysis_dir, source, loudness)
+    except Exception as e:
+        logger.error(f"Error analysing {audio_id}: {e}")
+        return []
+
+    logger.info(f"Analysis of {audio_id}: {analysis['duration']}s, {analysis['lufs']} LUFS")
+    object_names = []
+    for name in (ANALYSIS_FILE_NAME, EXCERPT_FILE_NAME):
+        uploader.submit(os.path.join(analysis_dir, name), f"{prefix}{name}", delete_after=True)
+        object_names.append(f"{prefix}{name}")
+    return object_names
+
+
+def _print_ffmpeg_log(ffmpeg_log, lines: int = 20):
+    ffmpeg_log.seek(0)
+    logger.error("".join(ffmpeg_log.readlines()[-lines:]))
+
+
+def _upload_master_playlist(manifest: dict, output_dir: str, prefix: str, uploader: SegmentUploader):
+    """
+    Write the static master playlist of an adaptive rendition next to its variants.
+    Returns:
+        str: The object name queued.
+    """
+    master_path = os.path.join(output_dir, PLAYLIST_FILE_NAME)
+    with open(master_path, "w") as master_file:
+        master_file.write(render_master_playlist(manifest, lambda variant: variant["playlist"]))
+    uploader.submit(master_path, f"{prefix}{PLAYLIST_FILE_NAME}")
+    return f"{prefix}{PLAYLIST_FILE_NAME}"
+
+
+def _feed_source(source_body, process: subprocess.Popen, errors: list):
+    """
+    Copy the S3 object body into ffmpeg's stdin.
+    """
+    try:
+        for chunk in source_body.iter_chunks(chunk_size=settings.hls.hls_stream_chunk_size):
+            process.stdin.write(chunk)
+    except BrokenPipeError:
+        # ffmpeg exited early; its exit code tells why
+        pass
+    except Exception as e:
+        errors.append(e)
+        process.kill()
+    finally:
+        try:
+            process.stdin.close()
+        except Exception:
+            pass
+        source_body.close()
+
+
+def _source_url(object_key: str) -> str:
+    return client.generate_presigned_url(
+        "get_object",
+        Params={"Bucket": SOURCE_BUCKET, "Key": object_key},
+        ExpiresIn=settings.hls.hls_transcode_lock_ttl
+    )
+
+
+def _needs_random_access(source: dict, outputs: list) -> bool:
+    """
+    MP4/M4A sources may keep their index (moov) after the media, which ffmpeg cannot reach
+    through a pipe; copied streams need the container's timestamps as they are.
+    """
+    return bool(
+        (source and "mp4" in (source["format"] or ""))
+        or any(output["remux"] for output in outputs)
+    )
+
+
+def _generate_hls_streaming(audio_id: str, is_add: bool, object_key: str, output_dir: str, outputs: list, output_mode: str, on_progress=None, source: dict = None, prefix: str = None, content_key: str = None):
+    """
+    Pipe the source object into ffmpeg and upload every segment as soon as ffmpeg lists it in
+    the playlist, publishing a partial manifest after each one so playback can start early.
+    A CMAF rendition is a single growing file, so it is uploaded once ffmpeg is done.
+    MP4 sources and remuxed ones are read by ffmpeg from a presigned URL instead of the pipe.
+    """
+    progressive = output_mode == OUTPUT_MODE_TS
+    prefix = prefix or rendition_prefix(audio_id, is_add)
+    analysis_dir = _analysis_dir(output_dir)
+    uploader = SegmentUploader(HLS_BUCKET_NAME)
+    uploaded = []
+
+    for output in outputs:
+        # (segment, upload future) of listed segments not yet published, in playlist order
+        output["pending"] = []
+        output["segments"] = []
+
+    feed_errors = []
+    feeder = None
+    # ffmpeg's log carries the loudness summary, it is read once ffmpeg exits
+    ffmpeg_log = tempfile.TemporaryFile(mode="w+")
+    try:
+        if _needs_random_access(source, outputs):
+            process = subprocess.Popen(
+                build_ffmpeg_command(_source_url(object_key), outputs, output_mode, analysis_dir=analysis_dir),
+                stderr=ffmpeg_log
+            )
+        else:
+            source_object = client.get_object(Bucket=SOURCE_BUCKET, Key=object_key)
+            process = subprocess.Popen(
+                build_ffmpeg_command("pipe:0", outputs, output_mode, analysis_dir=analysis_dir),
+                stdin=subprocess.PIPE,
+                stderr=ffmpeg_log
+            )
+            feeder = threading.Thread(target=_feed_source, args=(source_object["Body"], process, feed_errors), daemon=True)
+            feeder.start()
+    except Exception as e:
+        logger.error(f"Error opening audio file from MinIO: {e}")
+        ffmpeg_log.close()
+        return {"status": "error", "message": f"Failed to download audio file: {e}"}
+
+    try:
+        while True:
+            finished = process.poll() is not None
+            if not progressive:
+                if finished:
+                    break
+                time.sleep(settings.hls.hls_segment_poll_interval)
+                continue
+
+            progressed = False
+            for output in outputs:
+                for segment in _collect_segments(output, finished):
+                    segment_path = os.path.join(output_dir, segment["uri"])
+                    future = uploader.submit(segment_path, f"{prefix}{segment['uri']}", delete_after=True)
+                    output["pending"].append((segment, future))
+                    uploaded.append(f"{prefix}{segment['uri']}")
+
+                # Segments become playable in order, once every earlier one is uploaded too
+                while output["pending"] and output["pending"][0][1].done():
+                    segment, future = output["pending"].pop(0)
+                    future.result()
+                    output["segments"].append(segment)
+                    progressed = True
+
+            if progressed and not finished:
+                manifest = build_rendition_manifest(audio_id, is_add, outputs, complete=False, prefix=prefix, content_key=content_key)
+                save_manifest(manifest, HLS_BUCKET_NAME)
+                if on_progress:
+                    on_progress(manifest)
+
+            if finished:
+                break
+            time.sleep(settings.hls.hls_segment_poll_interval)
+
+        if feeder:
+            feeder.join()
+        if feed_errors:
+            raise feed_errors[0]
+        if process.returncode != 0:
+            _print_ffmpeg_log(ffmpeg_log)
+            raise subprocess.CalledProcessError(process.returncode, "ffmpeg")
+        logger.info(f"HLS segments for {audio_id} generated successfully.")
+        _record_ffmpeg_times(ffmpeg_log)
+        loudness = _rendition_loudness(audio_id, is_add, outputs, ffmpeg_log)
+        analysis = _upload_analysis(audio_id, analysis_dir, source, loudness, prefix, uploader)
+        uploaded.extend(analysis)
+
+        for output in outputs:
+            if progressive:
+                output["init"] = None
+            else:
+                output["segments"] = _collect_segments(output)
+                # the media file, plus the init section if ffmpeg wrote it separately
+                for file in os.listdir(output["dir"]):
+                    file_path = os.path.join(output["dir"], file)
+                    if file != output["playlist"] and os.path.isfile(file_path) and not file.endswith(".tmp"):
+                        uploader.submit(file_path, f"{prefix}{output['uri_prefix']}{file}", delete_after=True)
+                        uploaded.append(f"{prefix}{output['uri_prefix']}{file}")
+
+            _write_output_playlist(output, output["segments"] + [segment for segment, _ in output["pending"]])
+            uploader.submit(
+                os.path.join(output["dir"], output["playlist"]),
+                f"{prefix}{output['uri_prefix']}{output['playlist']}"
+            )
+            uploaded.append(f"{prefix}{output['uri_prefix']}{output['playlist']}")
+
+        upload_stats = uploader.wait()
+        for output in outputs:
+            output["segments"].extend(segment for segment, _ in output["pending"])
+
+        manifest = build_rendition_manifest(
+            audio_id, is_add, outputs, loudness=loudness, prefix=prefix, content_key=content_key,
+            analysis=ANALYSIS_FILE_NAME if analysis else None
+        )
+        if manifest["variants"]:
+            uploaded.append(_upload_master_playlist(manifest, output_dir, prefix, uploader))
+            upload_stats = uploader.wait()
+        save_manifest(manifest, HLS_BUCKET_NAME)
+    except Exception as e:
+        logger.error(f"Error generating HLS: {e}")
+        if process.poll() is None:
+            process.kill()
+        uploader.cancel()
+        discard_manifest(audio_id, is_add)
+        _delete_uploaded(uploaded)
+        return {"status": "error", "message": f"Failed to generate HLS: {e}"}
+    finally:
+        ffmpeg_log.close()
+
+    return {"status": "success", "message": "HLS segments uploaded", "manifest": manifest, "upload": upload_stats}
+
+
+def _generate_hls_from_file(audio_id: str, is_add: bool, object_key: str, output_dir: str, outputs: list, output_mode: str, source: dict = None, prefix: str = None, content_key: str = None):
+    """
+    Download the whole source, segment it, then upload the finished rendition.
+    """
     # Create a temporary file to store the downloaded audio
     with tempfile.NamedTemporaryFile(delete=False) as temp_audio_file:
         input_file = temp_audio_file.name
 
         try:
-            object_key = f"{'add' if is_add else 'music'}/{audio_id}"
-
             # Open the temp file for writing
             with open(input_file, "wb") as f:
                 client.download_fileobj(SOURCE_BUCKET, object_key, f)
 
-            print(f"Downloaded {object_key} from MinIO to {input_file}")
+            logger.info(f"Downloaded {object_key} from MinIO to {input_file}")
 
         except Exception as e:
-            print(f"Error downloading audio file from MinIO: {e}")
+            logger.error(f"Error downloading audio file from MinIO: {e}")
             return {"status": "error", "message": f"Failed to download audio file: {e}"}
 
-    output_dir = f"/tmp/hls/{audio_id}"
-    os.makedirs(output_dir, exist_ok=True)
-
     # Generate HLS with FFmpeg
-    cmd = [
-        "ffmpeg",
-        "-i", input_file,
-        "-vn",
-        "-c:a", "aac", "-b:a", "128k",
-        "-f", "hls",
-        "-hls_time", "10",  # Use smaller segment size for testing
-        "-hls_flags", "independent_segments",
-        "-hls_list_size", "0",
-        "-hls_segment_filename", f"{output_dir}/segment_%03d.ts",
-        f"{output_dir}/master.m3u8"
-    ]
+    analysis_dir = _analysis_dir(output_dir)
+    with tempfile.TemporaryFile(mode="w+") as ffmpeg_log:
+        try:
+            subprocess.run(build_ffmpeg_command(input_file, outputs, output_mode, analysis_dir=analysis_dir), stderr=ffmpeg_log, check=True)
+            logger.info(f"HLS segments for {audio_id} generated successfully.")
+        except subprocess.CalledProcessError as e:
+            logger.error(f"Error generating HLS: {e}")
+            _print_ffmpeg_log(ffmpeg_log)
+            return {"status": "error", "message": f"Failed to generate HLS: {e}"}
+        finally:
+            # Clean up the temporary audio file
+            os.remove(input_file)
 
-    try:
-        subprocess.run(cmd, check=True)
-        print(f"HLS segments for {audio_id} generated successfully.")
-    except subprocess.CalledProcessError as e:
-        print(f"Error generating HLS: {e}")
-        return {"status": "error", "message": f"Failed to generate HLS: {e}"}
-    finally:
-        # Clean up the temporary audio file
-        os.remove(input_file)
+        _record_ffmpeg_times(ffmpeg_log)
+        loudness = _rendition_loudness(audio_id, is_add, outputs, ffmpeg_log)
 
-    # Upload segments and playlist to MinIO
+    # Upload segments and playlists to MinIO, then the manifest that makes them playable
+    prefix = prefix or rendition_prefix(audio_id, is_add)
+    uploader = SegmentUploader(HLS_BUCKET_NAME)
+    uploaded = []
     try:
-        for file in os.listdir(output_dir):
-            file_path = os.path.join(output_dir, file)
-            object_name = f"{'add' if is_add else 'music'}/{audio_id}/{file}"
+        analysis = _upload_analysis(audio_id, analysis_dir, source, loudness, prefix, uploader)
+        uploaded.extend(analysis)
 
-            client.upload_file(
-                Filename=file_path,
-                Bucket=HLS_BUCKET_NAME,
-                Key=object_name,
-                ExtraArgs={
-                    "Metadata": {
-                        "last-access": datetime.datetime.utcnow().isoformat()
-                    }
-                }
-            )
-            print(f"Uploaded {file} to {HLS_BUCKET_NAME}/{object_name}")
+        for output in outputs:
+            output["segments"] = _collect_segments(output)
+            _write_output_playlist(output, output["segments"])
+            for file in os.listdir(output["dir"]):
+                file_path = os.path.join(output["dir"], file)
+                if os.path.isfile(file_path):
+                    uploader.submit(file_path, f"{prefix}{output['uri_prefix']}{file}")
+                    uploaded.append(f"{prefix}{output['uri_prefix']}{file}")
+
+        manifest = build_rendition_manifest(
+            audio_id, is_add, outputs, loudness=loudness, prefix=prefix, content_key=content_key,
+            analysis=ANALYSIS_FILE_NAME if analysis else None
+        )
+        if manifest["variants"]:
+            uploaded.append(_upload_master_playlist(manifest, output_dir, prefix, uploader))
+        upload_stats = uploader.wait()
+
+        save_manifest(manifest, HLS_BUCKET_NAME)
     except Exception as e:
-        print(f"Error uploading HLS segments to MinIO: {e}")
+        logger.error(f"Error uploading HLS segments to MinIO: {e}")
+        uploader.cancel()
+        discard_manifest(audio_id, is_add)
+        _delete_uploaded(uploaded)
         return {"status": "error", "message": f"Failed to upload HLS segments: {e}"}
+
+    return {"status": "success", "message": "HLS segments uploaded", "manifest": manifest, "upload": upload_stats}
+
+
+def _rendition_profile(outputs: list, output_mode: str) -> dict:
+    """
+    Everything besides the source that shapes the objects of a rendition.
+    """
+    return {
+        "mode": output_mode,
+        "outputs": [
+            [output["name"], output["bitrate"], output["codecs"], output["remux"], output["gain"]]
+            for output in outputs
+        ],
+        "segments": [_chunk_duration(), settings.hls.hls_segment_duration, intro_segment_count()],
+    }
+
+
+def _rendition_content_key(object_key: str, outputs: list, output_mode: str):
+    if not settings.hls.hls_content_addressing:
+        return None
+    try:
+        digest = source_digest(SOURCE_BUCKET, object_key)
+    except Exception as e:
+        logger.error(f"Error reading checksum of {object_key}: {e}")
+        return None
+    return content_key(digest, _rendition_profile(outputs, output_mode)) if digest else None
+
+
+def _link_shared_rendition(audio_id: str, is_add: bool, manifest: dict) -> dict:
+    """
+    Point a track at the complete rendition of an identical upload instead of transcoding it.
+    """
+    manifest = link_rendition(audio_id, is_add, manifest, HLS_BUCKET_NAME)
+    loudness = manifest.get("loudness")
+    if loudness:
+        save_track_loudness(audio_id, is_add, {name: loudness.get(name) for name in ("integrated", "range", "true_peak")})
+    logger.info(f"Linked {audio_id} to the rendition {manifest['content_key']}")
+    return {
+        "status": "success",
+        "message": "Linked to the rendition of an identical upload",
+        "linked": True,
+        "manifest": manifest,
+        "upload": {"files": 0, "bytes": 0, "seconds": 0.0},
+    }
+
+
+def _lock_content(key: str):
+    """
+    Wait for the lock of a content key, while an identical upload is being encoded.
+    Returns:
+        str | None: The owner token, or None when the lock was not freed within the lock TTL.
+    """
+    deadline = time.monotonic() + settings.hls.hls_transcode_lock_ttl
+    while True:
+        token = acquire_content_lock(key)
+        if token is not None or time.monotonic() > deadline:
+            return token
+        time.sleep(1)
+
+
+def _publish_content(audio_id: str, is_add: bool, manifest: dict):
+    """
+    Make a freshly encoded generation the shared rendition of its content key: switch the
+    content manifest, move the tracks linked to the content over and retire the generation
+    they played before.
+    """
+    key = manifest["content_key"]
+    replaced = load_content_manifest(key, HLS_BUCKET_NAME)
+    save_content_manifest(manifest, HLS_BUCKET_NAME)
+    add_content_ref(key, audio_id, is_add)
+    if replaced is not None and replaced.get("prefix") != manifest["prefix"]:
+        relink_content(manifest, HLS_BUCKET_NAME, skip=(audio_id, is_add))
+        retire_generation(replaced, HLS_BUCKET_NAME)
+
+
+def generate_hls(audio_id: str, is_add: bool = False, on_progress=None, output_mode: str = None, abr: bool = None, reuse: bool = True):
+    """
+    Generate HLS for the given audio file from the MinIO source bucket and upload to the target bucket.
+    Args:
+        audio_id (str): The ID of the audio file (used to form the file names and directories).
+        is_add (bool): Whether the audio is an advertisement.
+        on_progress (callable): Called with the partial manifest each time a segment becomes
+            playable while a streaming transcode is still running.
+        output_mode (str): `ts` or `cmaf`, defaults to the configured `hls_output_mode`.
+        abr (bool): Encode the whole bitrate ladder, defaults to the configured `hls_abr_enabled`.
+        reuse (bool): Link to the rendition of an identical upload when one exists, see
+            `hls_content_addressing`; False transcodes into it again.
+    Returns:
+        dict: Status message and the probed `source`, with the rendition manifest and upload
+            statistics on success. `remux` tells whether the audio was copied as it is.
+    """
+    object_key = f"{'add' if is_add else 'music'}/{audio_id}"
+    output_mode = output_mode or settings.hls.hls_output_mode
+    abr = settings.hls.hls_abr_enabled if abr is None else abr
+    output_dir = f"/tmp/hls/{audio_id}"
+
+    # ffprobe only reads the headers (and the index of MP4 files) through range requests
+    try:
+        source = probe_source(_source_url(object_key))
+    except Exception as e:
+        logger.error(f"Error probing audio file {object_key}: {e}")
+        source = None
+
+    # A single pass cannot know the loudness before the end of the track: the first transcode
+    # measures it and queues a re-encode that applies the gain to the target, see
+    # `utils.transcode_jobs._needs_normalization`
+    gain = None
+    if settings.hls.hls_loudness_normalize:
+        gain = normalization_gain(load_track_loudness(audio_id, is_add))
+
+    # ads are stitched into track playlists: always encode them with the tracks' encoder
+    # settings rather than copying whatever codec profile the advertiser uploaded
+    outputs = rendition_outputs(output_dir, abr=abr, source=None if is_add else source, gain=gain)
+    remux = any(output["remux"] for output in outputs)
+    logger.info(f"Source of {audio_id}: {source}, {'remuxing' if remux else 're-encoding'}, gain {gain} dB")
+
+    # identical uploads share one rendition under cas/, keyed by source checksum and profile
+    key = _rendition_content_key(object_key, outputs, output_mode)
+    previous_key = linked_content(audio_id, is_add)
+
+    # one encode per content at a time: a concurrent transcode of an identical upload is
+    # waited for and linked to
+    content_lock = _lock_content(key) if key else None
+    if key and content_lock is None:
+        logger.warning(f"Content {key} stayed locked, transcoding {audio_id} unshared")
+        key = None
+
+    try:
+        if key and reuse:
+            shared = load_content_manifest(key, HLS_BUCKET_NAME)
+            if shared is not None:
+                result = _link_shared_rendition(audio_id, is_add, shared)
+                if previous_key and previous_key != key:
+                    release_content(previous_key, audio_id, is_add, HLS_BUCKET_NAME, delete_unused=False)
+                return dict(result, source=source, remux=remux)
+
+        prefix = new_generation_prefix(key) if key else rendition_prefix(audio_id, is_add)
+        for output in outputs:
+            os.makedirs(output["dir"], exist_ok=True)
+        if _analysis_dir(output_dir):
+            os.makedirs(_analysis_dir(output_dir), exist_ok=True)
+
+        if settings.hls.hls_streaming_transcode:
+            result = _generate_hls_streaming(audio_id, is_add, object_key, output_dir, outputs, output_mode, on_progress, source, prefix, key)
+        else:
+            result = _generate_hls_from_file(audio_id, is_add, object_key, output_dir, outputs, output_mode, source, prefix, key)
+
+        if result["status"] == "success":
+            if key:
+                _publish_content(audio_id, is_add, result["manifest"])
+            if previous_key and previous_key != key:
+                # the old rendition may still be playing from signed URLs; the sweeper removes it
+                release_content(previous_key, audio_id, is_add, HLS_BUCKET_NAME, delete_unused=False)
+        return dict(result, source=source, remux=remux)
     finally:
+        if content_lock:
+            release_content_lock(key, content_lock)
         # delete output_dir directory and its contents
         try:
             shutil.rmtree(output_dir, ignore_errors=True)
-            print(f"Removed temporary HLS directory {output_dir}")
+            logger.info(f"Removed temporary HLS directory {output_dir}")
         except Exception as e:
-            print(f"Error removing output directory {output_dir}: {e}")
-        
-
-
-    return {"status": "success", "message": "HLS segments uploaded"}
+            logger.error(f"Error removing output directory {output_dir}: {e}")
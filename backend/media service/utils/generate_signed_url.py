@@ -1,11 +1,46 @@
+import asyncio
+import datetime
+import hashlib
+import hmac
+import threading
+import time
+from urllib.parse import parse_qsl, quote, urlsplit
 from libs.s3_client import client
-from utils.generate_hls import generate_hls
+from libs.logger import logger
 from config.config import settings
-from libs.redis import redis_connection
+from utils.hls_manifest import (
+    discard_manifest,
+    discard_manifest_async,
+    load_manifest,
+    load_manifest_async,
+    segment_keys,
+    variant_manifest,
+    window_manifest,
+)
+from utils.metrics import sign_seconds, signed_urls as signed_url_count
+from utils.rendition_storage import touch_rendition, touch_rendition_async
+from utils.signed_url_cache import ExpiryWindow, signed_url_cache, signed_url_cache_key
+from utils.transcode_jobs import (
+    PLAYABLE_STATUSES,
+    request_transcode,
+    transcode_in_progress,
+    transcode_in_progress_async,
+    wait_for_transcode,
+    wait_for_transcode_async,
+)
+from utils.transcode_scheduler import PRIORITY_INTERACTIVE
 
 
 HLS_BUCKET_NAME = settings.s3_storage.hls_bucket_name or "hls-playlist"
 
+SIGV4_ALGORITHM = "AWS4-HMAC-SHA256"
+SIGV4_TIMESTAMP_FORMAT = "%Y%m%dT%H%M%SZ"
+UNSIGNED_PAYLOAD = "UNSIGNED-PAYLOAD"
+# characters botocore leaves unescaped in query strings and object keys
+QUERY_SAFE_CHARS = "-_.~"
+KEY_SAFE_CHARS = "/~"
+PROBE_OBJECT_KEY = "presign-probe/segment_000.ts"
+
 def generate_signed_url(bucket_name, object_key, expiration=300):
     """
     Generate a signed URL for an object stored in an S3 bucket.
@@ -24,68 +59,414 @@ def generate_signed_url(bucket_name, object_key, expiration=300):
         )
         return signed_url
     except Exception as e:
-        print(f"Error generating signed URL for {object_key}: {e}")
+        logger.error(f"Error generating signed URL for {object_key}: {e}")
         return None
 
 
-def generate_signed_urls_for_folder(audio_id, bucket_name = HLS_BUCKET_NAME,  expiration=300, is_add: bool = False):
+class BatchPresigner:
+    """
+    Presign many GET URLs at once with a precomputed SigV4 signing key.
+
+    `client.generate_presigned_url` resolves the endpoint, serializes parameters and runs
+    event hooks on every call. The presigner asks boto3 for one reference URL per bucket,
+    learns the endpoint, region and credential scope from it, and from then on only does the
+    SigV4 hashing per key. The reference URL is re-signed at its own timestamp on resolution:
+    unless the output is byte-identical to boto3's, the bucket falls back to boto3 signing.
     """
-    Generate signed URLs for all objects within a specific folder (prefix) in an S3 bucket.
+
+    def __init__(self, s3_client, access_key_id: str, secret_access_key: str):
+        self._client = s3_client
+        self._access_key_id = access_key_id
+        self._secret_access_key = secret_access_key
+        self._endpoints = {}
+        self._signing_keys = {}
+        self._lock = threading.Lock()
+
+    def _signing_key(self, date_stamp: str, region: str, service: str) -> bytes:
+        """
+        Derive (once per day, region and service) the SigV4 signing key.
+        """
+        cache_key = (date_stamp, region, service)
+        signing_key = self._signing_keys.get(cache_key)
+        if signing_key is None:
+            signing_key = f"AWS4{self._secret_access_key}".encode("utf-8")
+            for part in (date_stamp, region, service, "aws4_request"):
+                signing_key = hmac.new(signing_key, part.encode("utf-8"), hashlib.sha256).digest()
+
+            with self._lock:
+                # keys of previous days are never needed again
+                if len(self._signing_keys) > 16:
+                    self._signing_keys.clear()
+                self._signing_keys[cache_key] = signing_key
+
+        return signing_key
+
+    def _resolve_endpoint(self, bucket_name: str):
+        """
+        Learn how boto3 addresses and scopes presigned URLs for a bucket.
+        Returns None when the bucket cannot be signed byte-identically to boto3.
+        """
+        if self._client is None or not self._secret_access_key:
+            return None
+
+        reference_url = self._client.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': bucket_name, 'Key': PROBE_OBJECT_KEY},
+            ExpiresIn=60
+        )
+
+        parts = urlsplit(reference_url)
+        quoted_key = quote(PROBE_OBJECT_KEY, safe=KEY_SAFE_CHARS)
+        if not parts.path.endswith(quoted_key):
+            return None
+
+        params = parse_qsl(parts.query, keep_blank_values=True)
+        auth_params = dict(params)
+        if (auth_params.get("X-Amz-Algorithm") != SIGV4_ALGORITHM
+                or auth_params.get("X-Amz-SignedHeaders") != "host"):
+            return None
+
+        access_key_id, _, region, service, _ = auth_params["X-Amz-Credential"].split("/")
+        if access_key_id != self._access_key_id:
+            return None
+
+        # botocore signs the hostname alone when the port is the scheme's default
+        default_port = {"http": 80, "https": 443}.get(parts.scheme)
+        host = parts.hostname if parts.port == default_port else parts.netloc
+
+        endpoint = {
+            "base_url": f"{parts.scheme}://{parts.netloc}",
+            "path_prefix": parts.path[:-len(quoted_key)],
+            "host": host,
+            "region": region,
+            "service": service,
+            "security_token": auth_params.get("X-Amz-Security-Token"),
+            # non auth parameters boto3 puts in front of the auth parameters
+            "operation_params": [(k, v) for k, v in params if not k.startswith("X-Amz-")],
+        }
+
+        signed_at = datetime.datetime.strptime(auth_params["X-Amz-Date"], SIGV4_TIMESTAMP_FORMAT)
+        expected_url = self._sign(endpoint, [PROBE_OBJECT_KEY], int(auth_params["X-Amz-Expires"]), signed_at)[0]
+        if expected_url != reference_url:
+            logger.info(f"Batch presigner disabled for bucket {bucket_name}: output differs from boto3")
+            return None
+
+        return endpoint
+
+    def _endpoint(self, bucket_name: str):
+        if bucket_name not in self._endpoints:
+            try:
+                endpoint = self._resolve_endpoint(bucket_name)
+            except Exception as e:
+                logger.error(f"Error resolving presign endpoint for bucket {bucket_name}: {e}")
+                endpoint = None
+
+            with self._lock:
+                self._endpoints[bucket_name] = endpoint
+
+        return self._endpoints[bucket_name]
+
+    def _sign(self, endpoint: dict, object_keys, expires_in: int, signed_at: datetime.datetime) -> list:
+        amz_date = signed_at.strftime(SIGV4_TIMESTAMP_FORMAT)
+        date_stamp = amz_date[:8]
+        scope = f"{date_stamp}/{endpoint['region']}/{endpoint['service']}/aws4_request"
+
+        query_params = list(endpoint["operation_params"]) + [
+            ("X-Amz-Algorithm", SIGV4_ALGORITHM),
+            ("X-Amz-Credential", f"{self._access_key_id}/{scope}"),
+            ("X-Amz-Date", amz_date),
+            ("X-Amz-Expires", str(int(expires_in))),
+            ("X-Amz-SignedHeaders", "host"),
+        ]
+        if endpoint["security_token"] is not None:
+            query_params.append(("X-Amz-Security-Token", endpoint["security_token"]))
+
+        encoded_params = [
+            (quote(k, safe=QUERY_SAFE_CHARS), quote(v, safe=QUERY_SAFE_CHARS))
+            for k, v in query_params
+        ]
+        query_string = "&".join(f"{k}={v}" for k, v in encoded_params)
+        canonical_query = "&".join(f"{k}={v}" for k, v in sorted(encoded_params))
+
+        # everything but the path is the same for every key of the batch
+        request_head = "GET\n"
+        request_tail = f"\n{canonical_query}\nhost:{endpoint['host']}\n\nhost\n{UNSIGNED_PAYLOAD}"
+        string_to_sign_head = f"{SIGV4_ALGORITHM}\n{amz_date}\n{scope}\n"
+        signing_key = self._signing_key(date_stamp, endpoint["region"], endpoint["service"])
+        url_head = endpoint["base_url"]
+        path_prefix = endpoint["path_prefix"]
+        url_tail = f"?{query_string}&X-Amz-Signature="
+
+        signed_urls = []
+        for object_key in object_keys:
+            path = path_prefix + quote(object_key, safe=KEY_SAFE_CHARS)
+            canonical_request = f"{request_head}{path}{request_tail}"
+            string_to_sign = string_to_sign_head + hashlib.sha256(canonical_request.encode("utf-8")).hexdigest()
+            signature = hmac.new(signing_key, string_to_sign.encode("utf-8"), hashlib.sha256).hexdigest()
+            signed_urls.append(f"{url_head}{path}{url_tail}{signature}")
+
+        return signed_urls
+
+    def sign(self, bucket_name: str, object_keys, expires_in: int, signed_at: datetime.datetime = None):
+        """
+        Presign GET URLs for a list of keys of one bucket.
+        Args:
+            :param bucket_name: The name of the S3 bucket.
+            :param object_keys: The keys to sign, in the order the URLs are returned.
+            :param expires_in: URL lifetime in seconds, counted from `signed_at`.
+            :param signed_at: Signing time (UTC, default now).
+        :return: List of signed URLs, or None when the bucket must be signed through boto3.
+        """
+        endpoint = self._endpoint(bucket_name)
+        if endpoint is None:
+            return None
+
+        if signed_at is None:
+            signed_at = datetime.datetime.now(datetime.timezone.utc)
+
+        return self._sign(endpoint, object_keys, expires_in, signed_at)
+
+
+batch_presigner = BatchPresigner(
+    client,
+    settings.s3_storage.s3_access_key_id,
+    settings.s3_storage.s3_secret_access_key
+)
+
+
+def generate_signed_urls(bucket_name, object_keys, window: ExpiryWindow):
+    """
+    Sign a list of objects so that every URL expires with the given window.
     Args:
         :param bucket_name: The name of the S3 bucket.
-        :param audio_id: The folder prefix (path) within the S3 bucket. This should be the audio ID.
-        :param expiration: URL expiration time in seconds (default 5 minutes).
-        :param is_add: Boolean flag to indicate whether to add new HLS content if no objects are found.
+        :param object_keys: The keys (paths) of the objects to sign.
+        :param window: The expiry window shared by the URLs.
     :return: A dictionary of object keys and their corresponding signed URLs.
     """
+    object_keys = list(object_keys)
+
+    # Signing at the start of the window makes the URLs identical for the whole window
+    signed_at = datetime.datetime.fromtimestamp(window.start, datetime.timezone.utc)
+    batch_urls = batch_presigner.sign(bucket_name, object_keys, window.expires_in(window.start), signed_at)
+    if batch_urls is not None:
+        return dict(zip(object_keys, batch_urls))
+
     signed_urls = {}
+    for object_key in object_keys:
+        signed_url = generate_signed_url(bucket_name, object_key, window.expires_in())
+        if signed_url:
+            signed_urls[object_key] = signed_url
+
+    return signed_urls
+
+
+def _sign_manifest(manifest: dict, audio_id: str, bucket_name: str, window: ExpiryWindow, variant: str = None, segments: dict = None):
+    manifest = variant_manifest(manifest, variant)
+    if manifest is None:
+        logger.info(f"No HLS variant {variant} for audio_id: {audio_id}")
+        return None, {}
+
+    if segments:
+        manifest = window_manifest(manifest, **segments)
+
+    # Sign every segment (of the window) in playlist order
+    started = time.perf_counter()
+    object_keys = segment_keys(manifest)
+    intro_keys = _intro_keys(manifest)
+    signed_urls = generate_signed_urls(bucket_name, [key for key in object_keys if key not in intro_keys], window)
+    if intro_keys:
+        intro_window = ExpiryWindow(window.expiration, length=settings.hls.hls_intro_url_window)
+        signed_urls.update(generate_signed_urls(bucket_name, [key for key in object_keys if key in intro_keys], intro_window))
+
+    sign_seconds.observe(time.perf_counter() - started)
+    signed_url_count.observe(len(signed_urls))
+    return manifest, {key: signed_urls[key] for key in object_keys if key in signed_urls}
+
+
+def _intro_keys(manifest: dict) -> set:
+    """
+    The object keys of the fast start segments in a (windowed) manifest. They are what every
+    play fetches first, so they are signed on a long window: the same URL is handed out for a
+    day and a browser or CDN cache keyed by URL keeps serving it. A CMAF rendition is one
+    object and is signed as a whole.
+    """
+    intro = manifest.get("intro_segments") or 0
+    if not intro or manifest.get("init") or settings.hls.hls_intro_url_window <= 0:
+        return set()
+
+    intro -= manifest.get("media_sequence", 0)
+    return {f"{manifest['prefix']}{segment['uri']}" for segment in manifest.get("segments", [])[:max(0, intro)]}
+
+
+def _window_cached(cached: dict, segments: dict = None):
+    """
+    Serve a segment window from the cached URLs of the whole rendition.
+    """
+    if not segments:
+        return cached["manifest"], cached["urls"]
+
+    manifest = window_manifest(cached["manifest"], **segments)
+    return manifest, {key: cached["urls"][key] for key in segment_keys(manifest)}
+
+
+def _segment_window(start: int = None, offset: float = None, count: int = None):
+    if start is None and offset is None and count is None:
+        return None
+    return {"start": start, "offset": offset, "count": count}
+
+
+def sign_rendition(
+    audio_id,
+    bucket_name = HLS_BUCKET_NAME,
+    expiration=300,
+    is_add: bool = False,
+    wait: float = 0,
+    variant: str = None,
+    start: int = None,
+    offset: float = None,
+    count: int = None,
+    priority: int = PRIORITY_INTERACTIVE
+):
+    """
+    Sign every segment of the HLS rendition of an audio file, in playlist order.
+    Args:
+        :param audio_id: The audio ID whose rendition manifest lists the segments to sign.
+        :param bucket_name: The name of the S3 bucket.
+        :param expiration: Minimum URL lifetime in seconds.
+        :param is_add: Boolean flag to indicate whether the audio is an advertisement.
+        :param wait: Seconds to wait for a background transcode when the rendition does not exist yet.
+        :param variant: The bitrate variant of an adaptive rendition, None for the default one.
+        :param start: Index of the first segment to sign, see `window_manifest`.
+        :param offset: Playback position in seconds to start signing at, when `start` is not given.
+        :param count: Number of segments to sign. Without `start`, `offset` and `count` every
+            segment is signed.
+        :param priority: The scheduler lane of the transcode started for a missing rendition.
+    :return: (manifest, signed_urls) where manifest is None while the rendition is being generated
+        or when it has no such variant.
+        The manifest is marked incomplete while a streaming transcode is still adding segments.
+        For a segment window it lists the window's segments, see `window_manifest`.
 
-    folder_prefix = f"{'add' if is_add else 'music'}/{audio_id}/"
+    Signed URL sets of complete renditions are cached per (audio_id, is_add, expiry window):
+    every URL of a window expires at the same aligned instant, at least `expiration` seconds
+    after the request. Segment windows are signed on their own, or sliced from a cached set.
+    """
+    window = ExpiryWindow(expiration)
+    cache_key = signed_url_cache_key(audio_id, is_add, window, variant)
+    segments = _segment_window(start, offset, count)
+
+    cached = signed_url_cache.get(cache_key)
+    if cached:
+        touch_rendition(audio_id, is_add)
+        return _window_cached(cached, segments)
 
     try:
-        # List objects within the folder (prefix)
-        response = client.list_objects_v2(
-            Bucket=bucket_name,
-            Prefix=folder_prefix
-        )
+        manifest = load_manifest(audio_id, is_add=is_add, bucket_name=bucket_name)
 
-        # Check if the folder has any content
-        if 'Contents' not in response or not response['Contents']:
-
-            # mark process in redis to avoid multiple HLS generations
-            redis_key = f"hls_generation_in_progress:{audio_id}"
-            if redis_connection.get(redis_key):
-                print(f"HLS generation already in progress for audio_id: {audio_id}")
-                return signed_urls  # Return empty if generation is in progress
-            
-            redis_connection.set(redis_key, "1", ex=300)  # Set key with 5 minutes expiration
-            print(f"No objects found in the folder: {folder_prefix}")
-            print(f"Generating HLS for folder: {folder_prefix}")
-            generate_hls(audio_id=audio_id, is_add=is_add)
-            redis_connection.delete(redis_key)  # Remove the key after generation
-            # List objects again after HLS generation
-            response = client.list_objects_v2(
-                Bucket=bucket_name,
-                Prefix=folder_prefix
-            )
-            if 'Contents' not in response or not response['Contents']:
-                # If no objects are found return an empty dict
-                return signed_urls
-
-        # Iterate over the objects in the folder if they exist
-        if 'Contents' in response:
-            for obj in response['Contents']:
-                object_key = obj['Key']
-
-                # Skip master.m3u8
-                if object_key.endswith("master.m3u8") or object_key.endswith(".m3u8"):
-                    continue
-
-                signed_url = generate_signed_url(bucket_name, object_key, expiration)
-                if signed_url:
-                    signed_urls[object_key] = signed_url
+        # a partial manifest without a transcode behind it is what a killed transcode left
+        if manifest is not None and not manifest.get("complete", True) and not transcode_in_progress(audio_id, is_add):
+            logger.info(f"Discarding the partial HLS manifest of a dead transcode for audio_id: {audio_id}")
+            discard_manifest(audio_id, is_add)
+            manifest = load_manifest(audio_id, is_add=is_add, bucket_name=bucket_name)
+
+        # Check if the rendition has been generated yet
+        if manifest is None:
+            # Only the first request starts a transcode, every other one waits for the same job
+            logger.info(f"No HLS manifest found for audio_id: {audio_id}")
+            request_transcode(audio_id, is_add=is_add, priority=priority)
+            if wait_for_transcode(audio_id, is_add=is_add, timeout=wait) not in PLAYABLE_STATUSES:
+                return None, {}
+
+            manifest = load_manifest(audio_id, is_add=is_add, bucket_name=bucket_name)
+            if manifest is None:
+                return None, {}
+
+        manifest, signed_urls = _sign_manifest(manifest, audio_id, bucket_name, window, variant, segments)
 
     except Exception as e:
-        print(f"Error listing objects in folder {folder_prefix}: {e}")
-    
+        logger.error(f"Error signing HLS segments for {audio_id}: {e}")
+        return None, {}
+
+    # Partial renditions grow with every segment, so only finished ones are cached
+    if signed_urls and not segments and manifest.get("complete", True):
+        signed_url_cache.set(cache_key, {"manifest": manifest, "urls": signed_urls}, window.cache_ttl())
+
+    if signed_urls:
+        # recency for the storage sweeper, see utils.rendition_storage
+        touch_rendition(audio_id, is_add)
+
+    return manifest, signed_urls
+
+
+async def sign_rendition_async(
+    audio_id,
+    bucket_name = HLS_BUCKET_NAME,
+    expiration=300,
+    is_add: bool = False,
+    wait: float = 0,
+    variant: str = None,
+    start: int = None,
+    offset: float = None,
+    count: int = None,
+    priority: int = PRIORITY_INTERACTIVE
+):
+    """
+    Async version of `sign_rendition` for the async request handlers. Cache, manifest and
+    status reads go through the async Redis and S3 clients and a wait for a transcode holds no
+    thread; signing itself is local hashing and runs inline.
+    """
+    window = ExpiryWindow(expiration)
+    cache_key = signed_url_cache_key(audio_id, is_add, window, variant)
+    segments = _segment_window(start, offset, count)
+
+    cached = await signed_url_cache.get_async(cache_key)
+    if cached:
+        await touch_rendition_async(audio_id, is_add)
+        return _window_cached(cached, segments)
+
+    try:
+        manifest = await load_manifest_async(audio_id, is_add=is_add, bucket_name=bucket_name)
+
+        if manifest is not None and not manifest.get("complete", True) and not await transcode_in_progress_async(audio_id, is_add):
+            logger.info(f"Discarding the partial HLS manifest of a dead transcode for audio_id: {audio_id}")
+            await discard_manifest_async(audio_id, is_add)
+            manifest = await load_manifest_async(audio_id, is_add=is_add, bucket_name=bucket_name)
+
+        if manifest is None:
+            logger.info(f"No HLS manifest found for audio_id: {audio_id}")
+            # rare, and may queue a BullMQ job through its own loop: kept off this one
+            await asyncio.to_thread(request_transcode, audio_id, is_add, priority)
+            if await wait_for_transcode_async(audio_id, is_add=is_add, timeout=wait) not in PLAYABLE_STATUSES:
+                return None, {}
+
+            manifest = await load_manifest_async(audio_id, is_add=is_add, bucket_name=bucket_name)
+            if manifest is None:
+                return None, {}
+
+        manifest, signed_urls = _sign_manifest(manifest, audio_id, bucket_name, window, variant, segments)
+
+    except Exception as e:
+        logger.error(f"Error signing HLS segments for {audio_id}: {e}")
+        return None, {}
+
+    if signed_urls and not segments and manifest.get("complete", True):
+        await signed_url_cache.set_async(cache_key, {"manifest": manifest, "urls": signed_urls}, window.cache_ttl())
+
+    if signed_urls:
+        await touch_rendition_async(audio_id, is_add)
+
+    return manifest, signed_urls
+
+
+def generate_signed_urls_for_folder(audio_id, bucket_name = HLS_BUCKET_NAME,  expiration=300, is_add: bool = False, wait: float = 0):
+    """
+    Generate signed URLs for every segment of the HLS rendition of an audio file, in playlist order.
+    Args:
+        :param bucket_name: The name of the S3 bucket.
+        :param audio_id: The audio ID whose rendition manifest lists the segments to sign.
+        :param expiration: URL expiration time in seconds (default 5 minutes).
+        :param is_add: Boolean flag to indicate whether the audio is an advertisement.
+        :param wait: Seconds to wait for a background transcode when the rendition does not exist yet.
+    :return: A dictionary of object keys and their corresponding signed URLs, empty while the rendition is being generated.
+    """
+    _, signed_urls = sign_rendition(audio_id, bucket_name, expiration=expiration, is_add=is_add, wait=wait)
     return signed_urls
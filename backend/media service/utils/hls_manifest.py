@@ -0,0 +1,478 @@
+import bisect
+import hashlib
+import itertools
+import json
+import math
+from libs.s3_client import async_client, client
+from libs.redis import async_redis_connection, redis_connection
+from libs.logger import logger
+from config.config import settings
+from utils.metrics import cache_requests, s3_request_seconds
+
+
+HLS_BUCKET_NAME = settings.s3_storage.hls_bucket_name or "hls-playlist"
+MANIFEST_FILE_NAME = "manifest.json"
+PLAYLIST_FILE_NAME = "master.m3u8"
+VARIANT_PLAYLIST_FILE_NAME = "index.m3u8"
+MANIFEST_VERSION = 1
+
+
+def rendition_prefix(audio_id: str, is_add: bool = False) -> str:
+    return f"{'add' if is_add else 'music'}/{audio_id}/"
+
+
+def manifest_cache_key(audio_id: str, is_add: bool = False) -> str:
+    return f"hls_manifest:{'add' if is_add else 'music'}:{audio_id}"
+
+
+def manifest_missing_key(audio_id: str, is_add: bool = False) -> str:
+    return f"hls_manifest_missing:{'add' if is_add else 'music'}:{audio_id}"
+
+
+def _parse_byterange(value: str, next_offset: int):
+    length, _, offset = value.strip('"').partition("@")
+    return [int(length), int(offset) if offset else next_offset]
+
+
+def parse_m3u8(playlist: str):
+    """
+    Parse a media playlist written by ffmpeg.
+    Args:
+        playlist (str): The m3u8 playlist content.
+    Returns:
+        list: Ordered segments as dicts with `uri`, `duration` and, for byte-range
+            playlists, `byterange` as [length, offset].
+    """
+    segments = []
+    duration = None
+    byterange = None
+    next_offset = 0
+
+    for line in playlist.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+
+        if line.startswith("#EXTINF:"):
+            duration = float(line[len("#EXTINF:"):].split(",", 1)[0])
+        elif line.startswith("#EXT-X-BYTERANGE:"):
+            byterange = _parse_byterange(line[len("#EXT-X-BYTERANGE:"):], next_offset)
+            next_offset = byterange[0] + byterange[1]
+        elif not line.startswith("#"):
+            segment = {"uri": line, "duration": duration}
+            if byterange is not None:
+                segment["byterange"] = byterange
+            segments.append(segment)
+            duration = None
+            byterange = None
+
+    return segments
+
+
+def parse_m3u8_map(playlist: str):
+    """
+    Return the init section (`#EXT-X-MAP`) of a fragmented MP4 playlist as a dict with
+    `uri` and optional `byterange`, or None for MPEG-TS playlists.
+    """
+    for line in playlist.splitlines():
+        line = line.strip()
+        if not line.startswith("#EXT-X-MAP:"):
+            continue
+
+        init = {}
+        for attribute in line[len("#EXT-X-MAP:"):].split(","):
+            name, _, value = attribute.partition("=")
+            if name == "URI":
+                init["uri"] = value.strip('"')
+            elif name == "BYTERANGE":
+                init["byterange"] = _parse_byterange(value, 0)
+        return init
+
+    return None
+
+
+def _round_segments(segments) -> list:
+    return [
+        dict(segment, duration=round(segment["duration"], 6) if segment["duration"] is not None else None)
+        for segment in segments
+    ]
+
+
+def _durations(segments) -> list:
+    return [segment["duration"] for segment in segments if segment["duration"] is not None]
+
+
+def manifest_fingerprint(segments, init: dict = None, variants: list = None) -> str:
+    """
+    Hash of what the playlists of a rendition are made of: its segments with their byte
+    ranges, the init sections and the variants. A re-encode in place gets a new one as soon as
+    any segment differs.
+    """
+    body = json.dumps([init, segments, variants], sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(body.encode("utf-8")).hexdigest()[:16]
+
+
+def build_variant(name: str, codecs: str, segments, init: dict = None, nominal_bandwidth: int = None) -> dict:
+    """
+    Describe one bitrate of an adaptive rendition.
+    Args:
+        name (str): The variant name, also its directory in the rendition (e.g. `96k`).
+        codecs (str): The RFC 6381 codec string (e.g. `mp4a.40.2`).
+        segments (list): Ordered segment dicts, uri relative to the rendition prefix, with
+            `size` in bytes when known.
+        init (dict): The fMP4 init section of CMAF variants.
+        nominal_bandwidth (int): Encoder bitrate in bits/s, used when segment sizes are unknown.
+    Returns:
+        dict: The variant, with its peak and average `BANDWIDTH` measured from the segments.
+    """
+    segments = _round_segments(segments)
+    durations = _durations(segments)
+    rates = [
+        segment["size"] * 8 / segment["duration"]
+        for segment in segments
+        if segment.get("size") and segment["duration"]
+    ]
+    total_size = sum(segment.get("size") or 0 for segment in segments)
+
+    return {
+        "name": name,
+        "codecs": codecs,
+        "playlist": f"{name}/{VARIANT_PLAYLIST_FILE_NAME}",
+        "bandwidth": math.ceil(max(rates)) if rates else nominal_bandwidth,
+        "average_bandwidth": math.ceil(total_size * 8 / sum(durations)) if rates and durations else nominal_bandwidth,
+        "init": init,
+        "segments": segments,
+        "total_duration": round(sum(durations), 6),
+        "target_duration": max(durations) if durations else None,
+    }
+
+
+def build_manifest(
+    audio_id: str,
+    segments,
+    is_add: bool = False,
+    complete: bool = True,
+    init: dict = None,
+    variants: list = None,
+    default_variant: str = None,
+    loudness: dict = None,
+    intro_segments: int = 0,
+    prefix: str = None,
+    content_key: str = None,
+    analysis: str = None
+) -> dict:
+    """
+    Build the compact manifest describing a rendition.
+    Args:
+        audio_id (str): The ID of the audio file.
+        segments (list): Ordered segment dicts as returned by `parse_m3u8`, uri relative to the rendition prefix.
+        is_add (bool): Whether the rendition belongs to an advertisement.
+        complete (bool): False while the transcode is still producing segments.
+        init (dict): The fMP4 init section, present for CMAF renditions.
+        variants (list): For adaptive renditions, the variants built with `build_variant`.
+            `segments` and `init` are then taken from `default_variant`.
+        default_variant (str): The variant served when a client does not pick one.
+        loudness (dict): The loudness measured during the transcode, see `loudness_metadata`.
+        intro_segments (int): How many leading segments are the short fast start ones.
+        prefix (str): Where the objects are stored, defaults to the `rendition_prefix` of the track.
+        content_key (str): For renditions shared by identical uploads, their key in
+            `utils.content_store`.
+        analysis (str): The analysis sidecar stored with the rendition, see `utils.track_analysis`.
+    Returns:
+        dict: The manifest.
+    """
+    if variants:
+        default = next((v for v in variants if v["name"] == default_variant), variants[0])
+        segments, init = default["segments"], default["init"]
+
+    segments = _round_segments(segments)
+    durations = _durations(segments)
+
+    return {
+        "version": MANIFEST_VERSION,
+        "fingerprint": manifest_fingerprint(segments, init, variants),
+        "audio_id": audio_id,
+        "is_add": is_add,
+        "mode": "cmaf" if init else "ts",
+        "prefix": prefix or rendition_prefix(audio_id, is_add),
+        "content_key": content_key,
+        "playlist": PLAYLIST_FILE_NAME,
+        "init": init,
+        "segments": segments,
+        "total_duration": round(sum(durations), 6),
+        "target_duration": max(durations) if durations else None,
+        "variants": variants or None,
+        "default_variant": default["name"] if variants else None,
+        "loudness": loudness,
+        "intro_segments": intro_segments,
+        "analysis": analysis,
+        "complete": complete,
+    }
+
+
+def variant_manifest(manifest: dict, name: str = None):
+    """
+    Return a manifest for a single variant of an adaptive rendition, shaped like a
+    single-bitrate manifest so it can be signed and rendered the same way.
+    Args:
+        manifest (dict): The rendition manifest.
+        name (str): The variant, or None for the default one.
+    Returns:
+        dict | None: The variant manifest, or None when the variant does not exist.
+    """
+    if not name or name == manifest.get("default_variant"):
+        return manifest
+
+    for variant in manifest.get("variants") or []:
+        if variant["name"] == name:
+            return dict(
+                manifest,
+                init=variant["init"],
+                segments=variant["segments"],
+                total_duration=variant["total_duration"],
+                target_duration=variant["target_duration"],
+                default_variant=name,
+            )
+
+    return None
+
+
+def window_manifest(manifest: dict, start: int = None, offset: float = None, count: int = None) -> dict:
+    """
+    Narrow a manifest to a window of consecutive segments, so only those are signed.
+    Args:
+        manifest (dict): The (variant) manifest.
+        start (int): Index of the first segment of the window.
+        offset (float): Playback position in seconds, used when `start` is not given: the
+            window starts with the segment playing at that time.
+        count (int): Number of segments, None for every segment from the start on.
+    Returns:
+        dict: The manifest with the window's `segments`, the index of its first segment as
+            `media_sequence`, and `segment_count` and `durations` of the whole rendition so a
+            player can lay out the timeline and ask for other windows.
+    """
+    segments = manifest.get("segments", [])
+    fallback = manifest.get("target_duration") or 0
+    durations = [segment["duration"] if segment["duration"] is not None else fallback for segment in segments]
+
+    if start is None:
+        # start times of the segments, the window begins with the last one starting at or before offset
+        starts = list(itertools.accumulate(durations, initial=0))[:-1]
+        start = max(0, bisect.bisect_right(starts, offset or 0) - 1)
+
+    start = min(start, len(segments))
+    end = len(segments) if count is None else min(len(segments), start + count)
+    return dict(
+        manifest,
+        segments=segments[start:end],
+        media_sequence=start,
+        segment_count=len(segments),
+        durations=durations,
+    )
+
+
+def segment_keys(manifest: dict) -> list:
+    """
+    Return the ordered, distinct object keys a player needs signed URLs for. A CMAF rendition
+    stores every fragment in one object, so it needs a single URL.
+    """
+    uris = [segment["uri"] for segment in manifest.get("segments", [])]
+    if manifest.get("init"):
+        uris.insert(0, manifest["init"]["uri"])
+
+    return [f"{manifest['prefix']}{uri}" for uri in dict.fromkeys(uris)]
+
+
+def save_manifest(manifest: dict, bucket_name: str = HLS_BUCKET_NAME):
+    """
+    Persist the manifest in Redis and, once the rendition is complete, as a sidecar object
+    under the track's prefix, also when its objects are shared under another one. Partial
+    manifests of a running transcode only live in Redis, and no longer than the transcode's
+    lock, so one left by a killed transcode does not outlive it.
+    """
+    audio_id = manifest["audio_id"]
+    is_add = manifest["is_add"]
+    body = json.dumps(manifest, separators=(",", ":"))
+    complete = manifest.get("complete", True)
+
+    if complete:
+        client.put_object(
+            Bucket=bucket_name,
+            Key=f"{rendition_prefix(audio_id, is_add)}{MANIFEST_FILE_NAME}",
+            Body=body.encode("utf-8"),
+            ContentType="application/json"
+        )
+
+    ttl = settings.hls.hls_manifest_ttl if complete else settings.hls.hls_transcode_lock_ttl
+    try:
+        redis_connection.set(manifest_cache_key(audio_id, is_add), body, ex=ttl)
+        redis_connection.delete(manifest_missing_key(audio_id, is_add))
+    except Exception as e:
+        logger.error(f"Error caching HLS manifest for {audio_id}: {e}")
+
+
+def discard_manifest(audio_id: str, is_add: bool = False):
+    """
+    Forget the cached manifest of a rendition, e.g. the partial one of a failed transcode.
+    """
+    try:
+        redis_connection.delete(manifest_cache_key(audio_id, is_add))
+    except Exception as e:
+        logger.error(f"Error discarding HLS manifest for {audio_id}: {e}")
+
+
+async def discard_manifest_async(audio_id: str, is_add: bool = False):
+    """
+    Async version of `discard_manifest`.
+    """
+    try:
+        await async_redis_connection.delete(manifest_cache_key(audio_id, is_add))
+    except Exception as e:
+        logger.error(f"Error discarding HLS manifest for {audio_id}: {e}")
+
+
+def _read_sidecar_manifest(audio_id: str, is_add: bool, bucket_name: str):
+    key = f"{rendition_prefix(audio_id, is_add)}{MANIFEST_FILE_NAME}"
+    with s3_request_seconds.labels("get_manifest").time():
+        try:
+            response = client.get_object(Bucket=bucket_name, Key=key)
+        except client.exceptions.NoSuchKey:
+            return None
+
+        return json.loads(response["Body"].read())
+
+
+def _manifest_from_listing(audio_id: str, is_add: bool, bucket_name: str):
+    """
+    Rebuild the manifest of a rendition generated before manifests existed.
+    """
+    prefix = rendition_prefix(audio_id, is_add)
+    segment_names = []
+    has_playlist = False
+
+    paginator = client.get_paginator("list_objects_v2")
+    with s3_request_seconds.labels("list").time():
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                name = obj["Key"][len(prefix):]
+                if name == PLAYLIST_FILE_NAME:
+                    has_playlist = True
+                elif name.endswith(".ts"):
+                    segment_names.append(name)
+
+    if not segment_names:
+        return None
+
+    segments = [{"uri": name, "duration": None} for name in sorted(segment_names)]
+    if has_playlist:
+        response = client.get_object(Bucket=bucket_name, Key=f"{prefix}{PLAYLIST_FILE_NAME}")
+        parsed = parse_m3u8(response["Body"].read().decode("utf-8"))
+        if parsed:
+            segments = parsed
+
+    return build_manifest(audio_id, segments, is_add=is_add)
+
+
+def migrate_legacy_manifest(audio_id: str, is_add: bool = False, bucket_name: str = HLS_BUCKET_NAME):
+    """
+    Write the sidecar manifest of a rendition generated before manifests existed, rebuilt
+    from a listing of its objects. Renditions that already have a manifest are left alone.
+    Args:
+        audio_id (str): The ID of the audio file.
+        is_add (bool): Whether the rendition belongs to an advertisement.
+        bucket_name (str): The HLS bucket.
+    Returns:
+        dict | None: The migrated manifest, or None when there was nothing to migrate.
+    """
+    if _read_sidecar_manifest(audio_id, is_add, bucket_name) is not None:
+        return None
+
+    manifest = _manifest_from_listing(audio_id, is_add, bucket_name)
+    if manifest is not None:
+        save_manifest(manifest, bucket_name)
+    return manifest
+
+
+def load_manifest(audio_id: str, is_add: bool = False, bucket_name: str = HLS_BUCKET_NAME):
+    """
+    Load the manifest of a rendition from Redis, falling back to the sidecar object.
+    A rendition without a sidecar manifest counts as not transcoded: renditions generated
+    before manifests existed are migrated once by `migrate_legacy_manifest`.
+    Args:
+        audio_id (str): The ID of the audio file.
+        is_add (bool): Whether the rendition belongs to an advertisement.
+        bucket_name (str): The HLS bucket.
+    Returns:
+        dict | None: The manifest, or None when the rendition has not been generated yet.
+    """
+    cache_key = manifest_cache_key(audio_id, is_add)
+    missing_key = manifest_missing_key(audio_id, is_add)
+
+    try:
+        cached, missing = redis_connection.mget(cache_key, missing_key)
+        if cached:
+            cache_requests.labels("manifest", "hit").inc()
+            return json.loads(cached)
+        if missing:
+            cache_requests.labels("manifest", "missing").inc()
+            return None
+    except Exception as e:
+        logger.error(f"Error reading cached HLS manifest for {audio_id}: {e}")
+
+    cache_requests.labels("manifest", "miss").inc()
+    manifest = _read_sidecar_manifest(audio_id, is_add, bucket_name)
+
+    try:
+        if manifest is None:
+            redis_connection.set(missing_key, "1", ex=settings.hls.hls_manifest_missing_ttl)
+        else:
+            redis_connection.set(cache_key, json.dumps(manifest, separators=(",", ":")), ex=settings.hls.hls_manifest_ttl)
+    except Exception as e:
+        logger.error(f"Error caching HLS manifest for {audio_id}: {e}")
+
+    return manifest
+
+
+async def _read_sidecar_manifest_async(audio_id: str, is_add: bool, bucket_name: str):
+    s3 = await async_client.get()
+    key = f"{rendition_prefix(audio_id, is_add)}{MANIFEST_FILE_NAME}"
+    with s3_request_seconds.labels("get_manifest").time():
+        try:
+            response = await s3.get_object(Bucket=bucket_name, Key=key)
+        except s3.exceptions.NoSuchKey:
+            return None
+
+        async with response["Body"] as body:
+            return json.loads(await body.read())
+
+
+async def load_manifest_async(audio_id: str, is_add: bool = False, bucket_name: str = HLS_BUCKET_NAME):
+    """
+    Async version of `load_manifest` for the async request handlers.
+    """
+    cache_key = manifest_cache_key(audio_id, is_add)
+    missing_key = manifest_missing_key(audio_id, is_add)
+
+    try:
+        cached, missing = await async_redis_connection.mget(cache_key, missing_key)
+        if cached:
+            cache_requests.labels("manifest", "hit").inc()
+            return json.loads(cached)
+        if missing:
+            cache_requests.labels("manifest", "missing").inc()
+            return None
+    except Exception as e:
+        logger.error(f"Error reading cached HLS manifest for {audio_id}: {e}")
+
+    cache_requests.labels("manifest", "miss").inc()
+    manifest = await _read_sidecar_manifest_async(audio_id, is_add, bucket_name)
+
+    try:
+        if manifest is None:
+            await async_redis_connection.set(missing_key, "1", ex=settings.hls.hls_manifest_missing_ttl)
+        else:
+            await async_redis_connection.set(cache_key, json.dumps(manifest, separators=(",", ":")), ex=settings.hls.hls_manifest_ttl)
+    except Exception as e:
+        logger.error(f"Error caching HLS manifest for {audio_id}: {e}")
+
+    return manifest
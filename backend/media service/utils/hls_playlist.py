@@ -0,0 +1,222 @@
+import math
+import threading
+from collections import OrderedDict
+from config.config import settings
+from utils.hls_manifest import manifest_fingerprint
+from utils.metrics import cache_requests
+
+
+PLAYLIST_MEDIA_TYPE = "application/vnd.apple.mpegurl"
+
+
+def _byterange(byterange) -> str:
+    length, offset = byterange
+    return f"{length}@{offset}"
+
+
+class PlaylistTemplate:
+    """
+    A media playlist rendered once per rendition with its URLs left as slots. Serving a
+    request only joins the static text with that request's signed URLs.
+    """
+
+    def __init__(self, parts: list, keys: list):
+        # text before, between and after the URLs, one more than `keys`
+        self.parts = parts
+        self.keys = keys
+
+    def render(self, signed_urls: dict) -> str:
+        """
+        Fill the slots with the signed URLs of their object keys.
+        """
+        output = [self.parts[0]]
+        for key, part in zip(self.keys, self.parts[1:]):
+            output.append(signed_urls[key])
+            output.append(part)
+        return "".join(output)
+
+
+def _header(target_duration: int, fmp4: bool, complete: bool) -> str:
+    return "\n".join([
+        "#EXTM3U",
+        # EXT-X-MAP outside of I-frame playlists needs version 6
+        f"#EXT-X-VERSION:{6 if fmp4 else 3}",
+        f"#EXT-X-TARGETDURATION:{target_duration}",
+        "#EXT-X-MEDIA-SEQUENCE:0",
+        f"#EXT-X-PLAYLIST-TYPE:{'VOD' if complete else 'EVENT'}",
+        "#EXT-X-INDEPENDENT-SEGMENTS",
+    ]) + "\n"
+
+
+def _compile_segments(manifest: dict, parts: list, keys: list, text: str, target_duration: int) -> str:
+    """
+    Add the init section and the segments of a manifest to a template being built.
+    Returns:
+        str: The text following the last slot, still to be added to `parts`.
+    """
+    prefix = manifest["prefix"]
+    init = manifest.get("init")
+
+    if init:
+        parts.append(text + '#EXT-X-MAP:URI="')
+        keys.append(prefix + init["uri"])
+        text = '"'
+        if init.get("byterange"):
+            text += f',BYTERANGE="{_byterange(init["byterange"])}"'
+        text += "\n"
+
+    for segment in manifest.get("segments", []):
+        duration = segment["duration"] if segment["duration"] is not None else target_duration
+        text += f"#EXTINF:{duration:.6f},\n"
+        if segment.get("byterange"):
+            text += f"#EXT-X-BYTERANGE:{_byterange(segment['byterange'])}\n"
+        parts.append(text)
+        keys.append(prefix + segment["uri"])
+        text = "\n"
+
+    return text
+
+
+def compile_playlist(manifest: dict) -> PlaylistTemplate:
+    """
+    Build the playlist template of a rendition from its manifest, with the real segment
+    durations (and byte ranges for CMAF renditions) ffmpeg wrote.
+    Args:
+        manifest (dict): The rendition manifest.
+    Returns:
+        PlaylistTemplate: Slots are keyed by object key; byte-range (CMAF) renditions
+            reference one object.
+    """
+    complete = manifest.get("complete", True)
+    target_duration = math.ceil(manifest.get("target_duration") or 10)
+
+    parts, keys = [], []
+    text = _header(target_duration, bool(manifest.get("init")), complete)
+    text = _compile_segments(manifest, parts, keys, text, target_duration)
+    if complete:
+        text += "#EXT-X-ENDLIST\n"
+
+    parts.append(text)
+    return PlaylistTemplate(parts, keys)
+
+
+def render_stitched_playlist(pieces: list, complete: bool = True) -> str:
+    """
+    Render one media playlist that plays several renditions back to back, e.g. a track with
+    ad breaks, separated by `#EXT-X-DISCONTINUITY`.
+    Args:
+        pieces (list): (manifest, signed_urls) pairs in play order. Manifests may be windows of
+            a rendition, see `window_manifest`; all must share the output mode.
+        complete (bool): False while the main rendition is still being transcoded.
+    Returns:
+        str: The m3u8 playlist.
+    """
+    target_duration = math.ceil(max((manifest.get("target_duration") or 10 for manifest, _ in pieces), default=10))
+    signed_urls = {}
+
+    parts, keys = [], []
+    text = _header(target_duration, any(manifest.get("init") for manifest, _ in pieces), complete)
+    for index, (manifest, urls) in enumerate(pieces):
+        if index:
+            text += "#EXT-X-DISCONTINUITY\n"
+        text = _compile_segments(manifest, parts, keys, text, target_duration)
+        signed_urls.update(urls)
+    if complete:
+        text += "#EXT-X-ENDLIST\n"
+
+    parts.append(text)
+    return PlaylistTemplate(parts, keys).render(signed_urls)
+
+
+class PlaylistTemplateCache:
+    """
+    In process LRU of the playlist templates of complete renditions.
+    """
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self._templates = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(manifest: dict):
+        # what the template is made of; a re-encode to the same segments reuses it, one that
+        # changes any duration or byte range does not
+        segments = manifest.get("segments", [])
+        fingerprint = manifest.get("fingerprint") or manifest_fingerprint(segments, manifest.get("init"))
+        return (
+            manifest["prefix"],
+            manifest.get("default_variant"),
+            manifest.get("media_sequence", 0),
+            len(segments),
+            fingerprint,
+        )
+
+    def get(self, manifest: dict) -> PlaylistTemplate:
+        """
+        Return the template of a manifest, compiling it on first use. Playlists of running
+        transcodes grow with every segment and are compiled on every request.
+        """
+        if not manifest.get("complete", True):
+            return compile_playlist(manifest)
+
+        key = self._key(manifest)
+        with self._lock:
+            template = self._templates.get(key)
+            if template is not None:
+                self._templates.move_to_end(key)
+                cache_requests.labels("playlist_template", "hit").inc()
+                return template
+
+        cache_requests.labels("playlist_template", "miss").inc()
+        template = compile_playlist(manifest)
+        with self._lock:
+            self._templates[key] = template
+            while len(self._templates) > self.max_entries:
+                self._templates.popitem(last=False)
+        return template
+
+
+playlist_templates = PlaylistTemplateCache(settings.hls.hls_playlist_template_cache_size)
+
+
+def render_playlist(manifest: dict, signed_urls: dict) -> str:
+    """
+    Render a playable media playlist for a rendition from its manifest.
+    Args:
+        manifest (dict): The rendition manifest.
+        signed_urls (dict): Object keys mapped to their signed URLs.
+    Returns:
+        str: The m3u8 playlist. Byte-range (CMAF) renditions reference one signed URL.
+    """
+    return playlist_templates.get(manifest).render(signed_urls)
+
+
+def render_master_playlist(manifest: dict, variant_uri) -> str:
+    """
+    Render the master playlist of an adaptive rendition.
+    Args:
+        manifest (dict): The rendition manifest, with `variants`.
+        variant_uri (callable): Maps a variant dict to the URI of its media playlist.
+    Returns:
+        str: The m3u8 master playlist, default variant first so players start with it.
+    """
+    variants = sorted(
+        manifest["variants"],
+        key=lambda variant: (variant["name"] != manifest.get("default_variant"), variant["bandwidth"] or 0)
+    )
+
+    lines = [
+        "#EXTM3U",
+        f"#EXT-X-VERSION:{6 if manifest.get('init') else 3}",
+        "#EXT-X-INDEPENDENT-SEGMENTS",
+    ]
+    for variant in variants:
+        attributes = f"BANDWIDTH={variant['bandwidth']}"
+        if variant.get("average_bandwidth"):
+            attributes += f",AVERAGE-BANDWIDTH={variant['average_bandwidth']}"
+        attributes += f',CODECS="{variant["codecs"]}"'
+        lines.append(f"#EXT-X-STREAM-INF:{attributes}")
+        lines.append(variant_uri(variant))
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,103 @@
+import os
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+
+# Request path timings, from a local cache hit to a cold S3 read
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Transcode timings, from an ad to a long live set
+TRANSCODE_BUCKETS = (0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+http_request_seconds = Histogram(
+    "media_http_request_seconds",
+    "Latency of HTTP requests by route",
+    ["method", "route", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+s3_request_seconds = Histogram(
+    "media_s3_request_seconds",
+    "Latency of S3 reads on the serving path (manifest sidecars)",
+    ["operation"],
+    buckets=LATENCY_BUCKETS,
+)
+sign_seconds = Histogram(
+    "media_sign_seconds",
+    "Time to sign the segments of one rendition request, cache misses only",
+    buckets=LATENCY_BUCKETS,
+)
+signed_urls = Histogram(
+    "media_signed_urls",
+    "URLs signed for one rendition request, cache misses only",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000),
+)
+cache_requests = Counter(
+    "media_cache_requests_total",
+    "Lookups of the manifest, signed URL and playlist template caches",
+    ["cache", "result"],
+)
+transcode_locks = Counter(
+    "media_transcode_locks_total",
+    "Attempts to take the single-flight lock of a transcode",
+    ["result"],
+)
+transcode_wait_seconds = Histogram(
+    "media_transcode_wait_seconds",
+    "Time requests waited for a running transcode",
+    buckets=TRANSCODE_BUCKETS,
+)
+transcodes = Counter(
+    "media_transcodes_total",
+    "Finished transcodes; linked ones reused the rendition of an identical upload",
+    ["result"],
+)
+transcode_seconds = Histogram(
+    "media_transcode_seconds",
+    "Wall time of a transcode, probe to manifest",
+    buckets=TRANSCODE_BUCKETS,
+)
+transcodes_running = Gauge(
+    "media_transcodes_running",
+    "Transcodes on a scheduler slot",
+    multiprocess_mode="livesum",
+)
+transcodes_queued = Gauge(
+    "media_transcodes_queued",
+    "Transcodes waiting for a scheduler slot",
+    multiprocess_mode="livesum",
+)
+ffmpeg_wall_seconds = Histogram(
+    "media_ffmpeg_wall_seconds",
+    "Real time of an ffmpeg run, as reported by -benchmark",
+    buckets=TRANSCODE_BUCKETS,
+)
+ffmpeg_cpu_seconds = Histogram(
+    "media_ffmpeg_cpu_seconds",
+    "User and system CPU time of an ffmpeg run, as reported by -benchmark",
+    buckets=TRANSCODE_BUCKETS,
+)
+upload_bytes = Counter("media_upload_bytes_total", "Bytes of rendition objects uploaded")
+upload_objects = Counter("media_upload_objects_total", "Rendition objects uploaded")
+upload_seconds = Histogram(
+    "media_upload_seconds",
+    "Time to upload one rendition object, retries included",
+    buckets=LATENCY_BUCKETS,
+)
+
+
+def render_metrics():
+    """
+    Return the exposition of every metric and its content type. With several uvicorn workers
+    set PROMETHEUS_MULTIPROC_DIR, the metrics of every worker are then merged.
+    """
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
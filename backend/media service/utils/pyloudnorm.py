@@ -1,4 +1,190 @@
+import asyncio
+import math
+import subprocess
+import numpy as np
 import pyloudnorm as pyln
+from scipy import signal
+from libs.logger import logger
+
+
+BLOCK_SIZE = 0.400  # 400 ms gating block
+BLOCK_OVERLAP = 0.75
+ABSOLUTE_GATE = -70.0
+RELATIVE_GATE = -10.0
+# BS.1770 channel weights, in L, R, C, Ls, Rs order
+CHANNEL_GAINS = (1.0, 1.0, 1.0, 1.41, 1.41)
+
+# Gating blocks are accumulated in a loudness histogram instead of being kept, so memory does
+# not grow with the length of the track. 0.01 LU bins bound the gating error far below 0.1 LU.
+HISTOGRAM_MIN = ABSOLUTE_GATE
+HISTOGRAM_MAX = 10.0
+HISTOGRAM_STEP = 0.01
+
+DECODE_CHUNK_FRAMES = 65536
+
+
+class StreamingLoudnessMeter:
+    """
+    Block-wise BS.1770 integrated loudness meter.
+
+    Audio is fed in chunks of any size with `process`. The K-weighting filter state is carried
+    from one chunk to the next and the energy of every 100 ms step is folded into 400 ms
+    gating blocks as they complete, so a multi-hour mix is measured in constant memory.
+    """
+
+    def __init__(self, rate: int, channels: int = 2, filter_class: str = "K-weighting"):
+        if not 1 <= channels <= len(CHANNEL_GAINS):
+            raise ValueError(f"Unsupported channel count: {channels}")
+
+        self.rate = rate
+        self.channels = channels
+        self.frames = 0
+
+        # same filter coefficients as pyloudnorm, cascaded as second-order sections
+        filters = pyln.Meter(rate, filter_class=filter_class, block_size=BLOCK_SIZE)._filters.values()
+        self._sos = np.array([np.concatenate([f.b, f.a]) for f in filters])
+        self._gain = np.prod([f.passband_gain for f in filters])
+        self._zi = np.zeros((len(self._sos), 2, channels))
+        self._weights = np.array(CHANNEL_GAINS[:channels])
+
+        self._step_frames = int(round(BLOCK_SIZE * (1 - BLOCK_OVERLAP) * rate))
+        self._steps_per_block = int(round(1 / (1 - BLOCK_OVERLAP)))
+        self._block_frames = BLOCK_SIZE * rate
+        # energy of the step being filled, and of the last completed steps
+        self._partial_energy = 0.0
+        self._partial_frames = 0
+        self._steps = []
+
+        bins = int(round((HISTOGRAM_MAX - HISTOGRAM_MIN) / HISTOGRAM_STEP))
+        self._counts = np.zeros(bins, dtype=np.int64)
+        self._energies = np.zeros(bins)
+
+    def process(self, samples):
+        """
+        Feed the next chunk of audio.
+        Args:
+            samples (numpy.ndarray): Float samples shaped (frames, channels), or (frames,) for mono.
+        """
+        samples = np.asarray(samples, dtype=np.float64)
+        if samples.ndim == 1:
+            samples = samples.reshape(-1, 1)
+        if samples.shape[1] != self.channels:
+            raise ValueError(f"Expected {self.channels} channels, got {samples.shape[1]}")
+        if not len(samples):
+            return
+
+        filtered, self._zi = signal.sosfilt(self._sos, samples, axis=0, zi=self._zi)
+        # channel-weighted energy of every frame
+        energy = np.square(filtered * self._gain) @ self._weights
+        self.frames += len(energy)
+
+        # complete the step left open by the previous chunk
+        missing = self._step_frames - self._partial_frames
+        self._partial_energy += energy[:missing].sum()
+        self._partial_frames += min(missing, len(energy))
+        energy = energy[missing:]
+        if self._partial_frames < self._step_frames:
+            return
+        self._add_step(self._partial_energy)
+
+        full = len(energy) // self._step_frames
+        for step_energy in energy[:full * self._step_frames].reshape(full, self._step_frames).sum(axis=1):
+            self._add_step(step_energy)
+
+        remainder = energy[full * self._step_frames:]
+        self._partial_energy = remainder.sum()
+        self._partial_frames = len(remainder)
+
+    def _add_step(self, step_energy: float):
+        self._steps.append(step_energy)
+        if len(self._steps) < self._steps_per_block:
+            return
+        if len(self._steps) > self._steps_per_block:
+            self._steps.pop(0)
+
+        block_energy = sum(self._steps) / self._block_frames
+        if block_energy <= 0:
+            return
+        loudness = -0.691 + 10.0 * math.log10(block_energy)
+        if loudness < ABSOLUTE_GATE:
+            return
+
+        index = min(int((loudness - HISTOGRAM_MIN) / HISTOGRAM_STEP), len(self._counts) - 1)
+        self._counts[index] += 1
+        self._energies[index] += block_energy
+
+    def integrated_loudness(self) -> float:
+        """
+        Return the gated integrated loudness of everything fed so far, in LUFS
+        (-inf for silence or audio shorter than one gating block).
+        """
+        count = self._counts.sum()
+        if not count:
+            return float("-inf")
+
+        relative_gate = -0.691 + 10.0 * math.log10(self._energies.sum() / count) + RELATIVE_GATE
+        first = max(0, int((relative_gate - HISTOGRAM_MIN) / HISTOGRAM_STEP) + 1)
+        count = self._counts[first:].sum()
+        if not count:
+            return float("-inf")
+
+        return -0.691 + 10.0 * math.log10(self._energies[first:].sum() / count)
+
+    @property
+    def duration(self) -> float:
+        return self.frames / self.rate
+
+
+def _measure_array(audio_data, sample_rate: int) -> float:
+    audio_data = np.asarray(audio_data)
+    meter = StreamingLoudnessMeter(sample_rate, channels=1 if audio_data.ndim == 1 else audio_data.shape[1])
+    for start in range(0, len(audio_data), DECODE_CHUNK_FRAMES):
+        meter.process(audio_data[start:start + DECODE_CHUNK_FRAMES])
+    return meter.integrated_loudness()
+
+
+def measure_file(input_file: str, sample_rate: int = 48000, channels: int = 2) -> float:
+    """
+    Decode an audio file (path or URL) with ffmpeg and meter it chunk by chunk.
+    Args:
+        input_file (str): Anything ffmpeg can read.
+        sample_rate (int): The rate the audio is decoded at.
+        channels (int): The channel count the audio is decoded to.
+    Returns:
+        float: The integrated loudness in LUFS.
+    """
+    meter = StreamingLoudnessMeter(sample_rate, channels=channels)
+    chunk_bytes = DECODE_CHUNK_FRAMES * channels * 4
+
+    process = subprocess.Popen(
+        [
+            "ffmpeg", "-v", "error",
+            "-i", input_file,
+            "-vn",
+            "-ac", str(channels),
+            "-ar", str(sample_rate),
+            "-f", "f32le",
+            "pipe:1"
+        ],
+        stdout=subprocess.PIPE
+    )
+    try:
+        pending = b""
+        while True:
+            data = process.stdout.read(chunk_bytes)
+            if not data:
+                break
+            data = pending + data
+            usable = len(data) - len(data) % (channels * 4)
+            pending = data[usable:]
+            meter.process(np.frombuffer(data[:usable], dtype="<f4").reshape(-1, channels))
+    finally:
+        process.stdout.close()
+        if process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, "ffmpeg")
+
+    return meter.integrated_loudness()
+
 
 async def measure_loudness(audio_data, sample_rate):
     """
@@ -9,9 +195,31 @@ async def measure_loudness(audio_data, sample_rate):
     Returns:
         float: The measured loudness in LUFS.
     """
-    meter = pyln.Meter(sample_rate)  # create BS.1770 meter
-    loudness = meter.integrated_loudness(audio_data)
-    return loudness
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, _measure_array, audio_data, sample_rate)
+
+
+async def measure_file_loudness(input_file: str, sample_rate: int = 48000, channels: int = 2):
+    """
+    Measure the loudness of an audio file without loading it in memory.
+    Args:
+        input_file (str): Path or URL of the audio file.
+        sample_rate (int): The rate the audio is decoded at.
+        channels (int): The channel count the audio is decoded to.
+    Returns:
+        float: The measured loudness in LUFS.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, measure_file, input_file, sample_rate, channels)
+
+
+def _normalize(audio, sr, target_lufs):
+    loudness = _measure_array(audio, sr)
+    normalized_audio = pyln.normalize.loudness(audio, loudness, target_lufs)
+    # a pure gain shifts the loudness by exactly the gain, no need to measure again
+    logger.info(f"Loudness: {loudness:.2f} LUFS -> {target_lufs:.2f} LUFS")
+    return normalized_audio
+
 
 async def normalize_loudness(audio, sr, target_lufs=-14):
     """
@@ -23,11 +231,5 @@ async def normalize_loudness(audio, sr, target_lufs=-14):
     Returns:
         numpy.ndarray: The normalized audio data.
     """
-    meter = pyln.Meter(sr)
-    loudness = meter.integrated_loudness(audio)
-    print("Before:", loudness)
-
-    normalized_audio = pyln.normalize.loudness(audio, loudness, target_lufs)
-    print("After:", meter.integrated_loudness(normalized_audio))
-
-    return normalized_audio
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, _normalize, audio, sr, target_lufs)
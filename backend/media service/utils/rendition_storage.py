@@ -0,0 +1,260 @@
+import time
+from collections import defaultdict
+from config.config import settings
+from libs.redis import async_redis_connection, redis_connection
+from libs.s3_client import client
+from libs.logger import logger
+from utils.content_store import CONTENT_ROOT, content_refs, content_size, delete_content, linked_content, remove_content_ref
+from utils.hls_manifest import HLS_BUCKET_NAME, discard_manifest, manifest_missing_key, rendition_prefix
+
+
+# last play (or transcode) time of every rendition, oldest first
+ACCESS_KEY = "hls_access"
+# stored bytes of every rendition
+SIZES_KEY = "hls_sizes"
+# shared renditions no track links to any more are swept like renditions nobody plays
+UNUSED_CONTENT_MEMBER = "cas:"
+# renditions the sweeper deleted, which the backfill leaves to be transcoded on demand
+EVICTED_KEY = "hls_evicted"
+
+
+def _member(audio_id: str, is_add: bool = False) -> str:
+    return f"{'add' if is_add else 'music'}:{audio_id}"
+
+
+def _parse_member(member) -> tuple:
+    kind, _, audio_id = (member.decode() if isinstance(member, bytes) else member).partition(":")
+    return audio_id, kind == "add"
+
+
+def touch_rendition(audio_id: str, is_add: bool = False):
+    """
+    Record that a rendition was just requested. One ZADD, S3 metadata is left alone.
+    """
+    try:
+        redis_connection.zadd(ACCESS_KEY, {_member(audio_id, is_add): time.time()}, gt=True)
+    except Exception as e:
+        logger.error(f"Error recording access of {audio_id}: {e}")
+
+
+async def touch_rendition_async(audio_id: str, is_add: bool = False):
+    """
+    Async version of `touch_rendition`.
+    """
+    try:
+        await async_redis_connection.zadd(ACCESS_KEY, {_member(audio_id, is_add): time.time()}, gt=True)
+    except Exception as e:
+        logger.error(f"Error recording access of {audio_id}: {e}")
+
+
+def record_rendition(audio_id: str, is_add: bool, size: int):
+    """
+    Record the size of a freshly transcoded rendition. A rendition nobody has played yet counts
+    as accessed when it was transcoded, so ingest does not feed the sweeper.
+    """
+    member = _member(audio_id, is_add)
+    try:
+        pipeline = redis_connection.pipeline()
+        pipeline.hset(SIZES_KEY, member, int(size))
+        pipeline.zadd(ACCESS_KEY, {member: time.time()}, gt=True)
+        pipeline.srem(EVICTED_KEY, member)
+        pipeline.execute()
+    except Exception as e:
+        logger.error(f"Error recording size of {audio_id}: {e}")
+
+
+def evicted_renditions(kind: str = "music") -> set:
+    """
+    Return the audio IDs of the given kind (`music` or `add`) whose rendition was evicted by
+    the sweeper and not transcoded again since.
+    """
+    return {
+        audio_id
+        for audio_id, is_add in map(_parse_member, redis_connection.smembers(EVICTED_KEY))
+        if is_add == (kind == "add")
+    }
+
+
+def rescan_sizes(bucket_name: str = HLS_BUCKET_NAME) -> int:
+    """
+    Rebuild the rendition sizes from a listing of the HLS bucket, e.g. for renditions
+    generated before sizes were tracked. Returns the total bytes.
+    """
+    sizes = defaultdict(int)
+    content_sizes = defaultdict(int)
+    paginator = client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket_name):
+        for obj in page.get("Contents", []):
+            kind, _, rest = obj["Key"].partition("/")
+            audio_id = rest.split("/", 1)[0]
+            if kind in ("music", "add") and audio_id and "/" in rest:
+                sizes[f"{kind}:{audio_id}"] += obj["Size"]
+            elif f"{kind}/" == CONTENT_ROOT and audio_id and "/" in rest:
+                content_sizes[audio_id] += obj["Size"]
+
+    # a shared rendition counts for one of the tracks linking to it
+    for key, size in content_sizes.items():
+        refs = content_refs(key)
+        sizes[refs[0] if refs else f"{UNUSED_CONTENT_MEMBER}{key}"] += size
+
+    pipeline = redis_connection.pipeline()
+    pipeline.delete(SIZES_KEY)
+    if sizes:
+        pipeline.hset(SIZES_KEY, mapping=sizes)
+        # never played since recency was tracked: oldest possible
+        pipeline.zadd(ACCESS_KEY, {member: 0 for member in sizes}, nx=True)
+    pipeline.execute()
+    return sum(sizes.values())
+
+
+def storage_usage() -> int:
+    return sum(int(size) for size in redis_connection.hvals(SIZES_KEY))
+
+
+def release_content(content_key: str, audio_id: str, is_add: bool = False, bucket_name: str = HLS_BUCKET_NAME, delete_unused: bool = True) -> int:
+    """
+    Drop the link of a track to a shared rendition. The bytes counted for the track move to a
+    track still linking to it. The last link deletes the shared rendition, or with
+    `delete_unused` False leaves it to the sweeper, e.g. when the track was just transcoded
+    again and signed URLs of the old rendition may still be played.
+    Returns the number of objects deleted.
+    """
+    remaining = remove_content_ref(content_key, audio_id, is_add)
+    if remaining:
+        size = redis_connection.hget(SIZES_KEY, _member(audio_id, is_add))
+        if size and int(size):
+            redis_connection.hincrby(SIZES_KEY, remaining[0], int(size))
+        return 0
+
+    if delete_unused:
+        return delete_content(content_key, bucket_name)
+
+    member = f"{UNUSED_CONTENT_MEMBER}{content_key}"
+    pipeline = redis_connection.pipeline()
+    pipeline.hset(SIZES_KEY, member, content_size(content_key, bucket_name))
+    pipeline.zadd(ACCESS_KEY, {member: time.time()})
+    pipeline.execute()
+    return 0
+
+
+def retire_generation(manifest: dict, bucket_name: str = HLS_BUCKET_NAME):
+    """
+    Leave a generation of a shared rendition that a new one replaced to the sweeper, signed
+    URLs of it may still be played. Renditions stored before generations existed sit directly
+    under their content key and are deleted with it.
+    """
+    key = manifest.get("prefix", "")[len(CONTENT_ROOT):].rstrip("/")
+    if "/" not in key:
+        return
+
+    member = f"{UNUSED_CONTENT_MEMBER}{key}"
+    pipeline = redis_connection.pipeline()
+    pipeline.hset(SIZES_KEY, member, content_size(key, bucket_name))
+    pipeline.zadd(ACCESS_KEY, {member: time.time()})
+    pipeline.execute()
+
+
+def _delete_unused_content(member: str, bucket_name: str) -> int:
+    deleted = delete_content(member[len(UNUSED_CONTENT_MEMBER):], bucket_name)
+    pipeline = redis_connection.pipeline()
+    pipeline.hdel(SIZES_KEY, member)
+    pipeline.zrem(ACCESS_KEY, member)
+    pipeline.execute()
+    return deleted
+
+
+def delete_rendition(audio_id: str, is_add: bool = False, bucket_name: str = HLS_BUCKET_NAME, evicted: bool = False) -> int:
+    """
+    Delete every object of a rendition and forget it. The next play regenerates it on demand.
+    A shared rendition is only deleted with the last track linking to it.
+    An `evicted` rendition is remembered as such, so the backfill does not transcode it again.
+    Returns the number of objects deleted.
+    """
+    # imported here: transcode_jobs records sizes through this module
+    from utils.transcode_jobs import transcode_status_key
+
+    content_key = linked_content(audio_id, is_add)
+    deleted = release_content(content_key, audio_id, is_add, bucket_name) if content_key else 0
+
+    prefix = rendition_prefix(audio_id, is_add)
+    paginator = client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        keys = [{"Key": obj["Key"]} for obj in page.get("Contents", [])]
+        if keys:
+            client.delete_objects(Bucket=bucket_name, Delete={"Objects": keys, "Quiet": True})
+            deleted += len(keys)
+
+    member = _member(audio_id, is_add)
+    pipeline = redis_connection.pipeline()
+    pipeline.hdel(SIZES_KEY, member)
+    pipeline.zrem(ACCESS_KEY, member)
+    pipeline.delete(transcode_status_key(audio_id, is_add), manifest_missing_key(audio_id, is_add))
+    if evicted:
+        pipeline.sadd(EVICTED_KEY, member)
+    else:
+        pipeline.srem(EVICTED_KEY, member)
+    pipeline.execute()
+    discard_manifest(audio_id, is_add)
+    return deleted
+
+
+def sweep(budget_bytes: int = None, dry_run: bool = False, bucket_name: str = HLS_BUCKET_NAME) -> dict:
+    """
+    Delete the renditions of the least recently played tracks until the HLS bucket fits the
+    storage budget. Renditions played within `hls_eviction_min_idle` seconds are never deleted,
+    which also guarantees no cached signed URL still points at them.
+    Args:
+        budget_bytes (int): The storage budget, defaults to `hls_storage_budget_bytes`.
+        dry_run (bool): Only report what would be deleted.
+        bucket_name (str): The HLS bucket.
+    Returns:
+        dict: Usage before and after, and the renditions evicted.
+    """
+    from utils.transcode_jobs import transcode_lock_key
+
+    budget_bytes = settings.hls.hls_storage_budget_bytes if budget_bytes is None else budget_bytes
+    if not budget_bytes:
+        return {"budget": budget_bytes, "before": None, "after": None, "evicted": []}
+
+    if not redis_connection.exists(SIZES_KEY):
+        logger.info("No rendition sizes recorded yet, scanning the HLS bucket")
+        rescan_sizes(bucket_name)
+
+    sizes = {member.decode(): int(size) for member, size in redis_connection.hgetall(SIZES_KEY).items()}
+    usage = sum(sizes.values())
+    result = {"budget": budget_bytes, "before": usage, "after": usage, "evicted": []}
+    if usage <= budget_bytes:
+        return result
+
+    idle_before = time.time() - settings.hls.hls_eviction_min_idle
+    start = 0
+    while usage > budget_bytes:
+        batch = redis_connection.zrangebyscore(ACCESS_KEY, "-inf", idle_before, start=start, num=100, withscores=True)
+        if not batch:
+            break
+        start += len(batch)
+
+        for member, last_access in batch:
+            member = member.decode()
+            if member not in sizes:
+                continue
+            audio_id, is_add = _parse_member(member)
+            unused_content = member.startswith(UNUSED_CONTENT_MEMBER)
+            if not unused_content and redis_connection.exists(transcode_lock_key(audio_id, is_add)):
+                continue
+
+            if not dry_run:
+                if unused_content:
+                    _delete_unused_content(member, bucket_name)
+                else:
+                    delete_rendition(audio_id, is_add, bucket_name, evicted=True)
+                # the member left the sorted set, the next page starts one earlier
+                start -= 1
+            usage -= sizes[member]
+            result["evicted"].append({"audio_id": audio_id, "is_add": is_add, "bytes": sizes[member], "last_access": last_access})
+            logger.info(f"{'Would evict' if dry_run else 'Evicted'} {member} ({sizes[member]} bytes, last access {last_access:.0f})")
+            if usage <= budget_bytes:
+                break
+
+    result["after"] = usage
+    return result
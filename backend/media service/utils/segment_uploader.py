@@ -0,0 +1,158 @@
+import contextvars
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
+from boto3.s3.transfer import TransferConfig
+from libs.s3_client import client
+from libs.logger import logger
+from utils.metrics import upload_bytes, upload_objects, upload_seconds
+from config.config import settings
+
+
+CONTENT_TYPES = {
+    ".ts": "video/mp2t",
+    ".m3u8": "application/vnd.apple.mpegurl",
+    ".m4s": "audio/mp4",
+    ".mp4": "audio/mp4",
+    ".json": "application/json",
+    ".wav": "audio/wav",
+}
+
+# Segments are tiny, so they go up in one PUT; large single-file renditions use multipart
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=16 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=4,
+)
+
+# Shared by every transcode so the total number of in-flight PUTs stays bounded
+_executor = ThreadPoolExecutor(
+    max_workers=max(1, settings.hls.hls_upload_concurrency),
+    thread_name_prefix="hls-upload"
+)
+
+
+def upload_extra_args(file_name: str) -> dict:
+    """
+    Return the Content-Type and Cache-Control headers an HLS object is stored with.
+    """
+    extension = os.path.splitext(file_name)[1]
+    cache_control = (
+        settings.hls.hls_playlist_cache_control
+        if extension in (".m3u8", ".json")
+        else settings.hls.hls_segment_cache_control
+    )
+    return {
+        "ContentType": CONTENT_TYPES.get(extension, "application/octet-stream"),
+        "CacheControl": cache_control,
+    }
+
+
+class SegmentUploader:
+    """
+    Upload the files of one rendition concurrently, retrying each with exponential backoff.
+
+    Every upload is submitted to the shared upload pool and returns a future; `wait` blocks
+    until all of them are done and reports how long the rendition took to upload: the time
+    any of its uploads was running, so a streaming transcode's encode time between segments
+    is not counted.
+    """
+
+    def __init__(self, bucket_name: str):
+        self.bucket_name = bucket_name
+        self.files = 0
+        self.bytes = 0
+        self._futures = []
+        self._lock = threading.Lock()
+        self._active = 0
+        self._busy_since = None
+        self._busy_seconds = 0.0
+
+    def _upload(self, file_path: str, object_name: str, delete_after: bool):
+        size = os.path.getsize(file_path)
+        started = time.monotonic()
+        with self._lock:
+            if self._active == 0:
+                self._busy_since = started
+            self._active += 1
+        try:
+            self._put(file_path, object_name)
+        finally:
+            with self._lock:
+                self._active -= 1
+                if self._active == 0:
+                    self._busy_seconds += time.monotonic() - self._busy_since
+
+        with self._lock:
+            self.files += 1
+            self.bytes += size
+        upload_seconds.observe(time.monotonic() - started)
+        upload_objects.inc()
+        upload_bytes.inc(size)
+
+        if delete_after:
+            os.remove(file_path)
+
+        logger.debug(f"Uploaded {os.path.basename(file_path)} to {self.bucket_name}/{object_name}")
+        return object_name
+
+    def _put(self, file_path: str, object_name: str):
+        attempts = max(1, settings.hls.hls_upload_retries)
+        for attempt in range(attempts):
+            try:
+                client.upload_file(
+                    Filename=file_path,
+                    Bucket=self.bucket_name,
+                    Key=object_name,
+                    ExtraArgs=upload_extra_args(file_path),
+                    Config=TRANSFER_CONFIG
+                )
+                break
+            except Exception as e:
+                if attempt == attempts - 1:
+                    raise
+                delay = min(10.0, 0.25 * 2 ** attempt) * (0.5 + random.random())
+                logger.warning(f"Retrying upload of {object_name} in {delay:.2f}s: {e}")
+                time.sleep(delay)
+
+    def submit(self, file_path: str, object_name: str, delete_after: bool = False):
+        """
+        Queue an upload. Returns a future resolving to the object name.
+        """
+        # in the context of the transcode, so its log lines keep the request and audio id
+        future = _executor.submit(
+            contextvars.copy_context().run, self._upload, file_path, object_name, delete_after
+        )
+        self._futures.append(future)
+        return future
+
+    def wait(self) -> dict:
+        """
+        Wait for every submitted upload; raise the first failure.
+        Returns:
+            dict: Upload statistics (files, bytes, seconds) of the rendition.
+        """
+        for future in self._futures:
+            future.result()
+
+        stats = {
+            "files": self.files,
+            "bytes": self.bytes,
+            "seconds": round(self._busy_seconds, 3),
+        }
+        logger.info(
+            f"Uploaded {stats['files']} files ({stats['bytes']} bytes) "
+            f"to {self.bucket_name} in {stats['seconds']}s"
+        )
+        return stats
+
+    def cancel(self):
+        """
+        Drop the queued uploads and wait for the running ones, so that no object of the
+        rendition lands after its uploaded objects were cleaned up.
+        """
+        for future in self._futures:
+            future.cancel()
+        wait_futures(self._futures)
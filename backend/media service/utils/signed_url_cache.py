@@ -0,0 +1,177 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from config.config import settings
+from libs.redis import async_redis_connection, redis_connection
+from libs.logger import logger
+from utils.metrics import cache_requests
+
+
+SIGNED_URL_WINDOW = max(60, settings.signed_url_cache.signed_url_window)
+SIGNED_URL_CACHE_MARGIN = max(0, settings.signed_url_cache.signed_url_cache_margin)
+
+# S3 rejects presigned URLs that are valid for more than 7 days
+MAX_PRESIGN_EXPIRATION = 7 * 24 * 3600
+
+
+class ExpiryWindow:
+    """
+    Fixed time window that every signed URL issued inside it shares an expiry with.
+
+    A URL handed out at any moment of the window stays valid for at least the requested
+    expiration, and every URL of the window expires at the same instant, so the same set
+    of URLs can be served (and cached by browsers or a CDN) for the whole window.
+    Windows last `signed_url_window` seconds unless another `length` is given.
+
+    A URL signed at the start of the window is valid for `length + expiration` seconds, which S3
+    caps at `MAX_PRESIGN_EXPIRATION`: a longer expiration is lowered to fit (and logged), so the
+    window's `expiration` and `expires_at` always are the lifetime the URLs are actually signed for.
+    """
+
+    def __init__(self, expiration: int, now: float = None, length: int = None):
+        now = time.time() if now is None else now
+        length = min(length or SIGNED_URL_WINDOW, MAX_PRESIGN_EXPIRATION)
+        self.expiration = int(expiration)
+        if self.expiration > MAX_PRESIGN_EXPIRATION - length:
+            logger.warning(
+                f"Signed URL expiration {self.expiration}s exceeds the presign limit, "
+                f"lowered to {MAX_PRESIGN_EXPIRATION - length}s"
+            )
+            self.expiration = MAX_PRESIGN_EXPIRATION - length
+        self.bucket = int(now // length)
+        self.start = self.bucket * length
+        self.end = self.start + length
+        self.expires_at = self.end + self.expiration
+
+    def expires_in(self, signed_at: float = None) -> int:
+        """
+        Seconds a URL signed at `signed_at` (default: now) must stay valid to expire with the window.
+        """
+        signed_at = time.time() if signed_at is None else signed_at
+        return int(self.expires_at - int(max(signed_at, self.start)))
+
+    def cache_ttl(self) -> int:
+        """
+        Seconds a URL set of this window may still be cached, kept safely below the URL expiry.
+        """
+        return int(self.end - time.time()) - SIGNED_URL_CACHE_MARGIN
+
+
+def signed_url_cache_key(audio_id: str, is_add: bool, window: ExpiryWindow, variant: str = None) -> str:
+    return (
+        f"signed_urls:{'add' if is_add else 'music'}:{audio_id}"
+        f":{window.expiration}:{window.bucket}"
+        + (f":{variant}" if variant else "")
+    )
+
+
+class SignedUrlCache:
+    """
+    Two level cache (in process LRU in front of Redis) for the signed URL set of a rendition.
+    """
+
+    def __init__(self, max_local_entries: int = 1024):
+        self.max_local_entries = max_local_entries
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_local(self, key: str):
+        with self._lock:
+            entry = self._local.get(key)
+            if entry is None:
+                return None
+
+            expires_at, value = entry
+            if expires_at <= time.time():
+                del self._local[key]
+                return None
+
+            self._local.move_to_end(key)
+            return value
+
+    def _set_local(self, key: str, value: dict, ttl: int):
+        with self._lock:
+            self._local[key] = (time.time() + ttl, value)
+            self._local.move_to_end(key)
+            while len(self._local) > self.max_local_entries:
+                self._local.popitem(last=False)
+
+    def get(self, key: str):
+        """
+        Return the cached signed URL set for `key`, or None.
+        """
+        value = self._get_local(key)
+        if value is not None:
+            cache_requests.labels("signed_url", "local_hit").inc()
+            return value
+
+        try:
+            cached = redis_connection.get(key)
+            if not cached:
+                cache_requests.labels("signed_url", "miss").inc()
+                return None
+
+            ttl = redis_connection.ttl(key)
+            cache_requests.labels("signed_url", "hit").inc()
+            value = json.loads(cached)
+            if ttl and ttl > 0:
+                self._set_local(key, value, ttl)
+            return value
+        except Exception as e:
+            logger.error(f"Error reading signed URL cache {key}: {e}")
+            return None
+
+    def set(self, key: str, value: dict, ttl: int):
+        """
+        Store a signed URL set for `ttl` seconds. Empty sets and expired windows are ignored.
+        """
+        if not value or ttl <= 0:
+            return
+
+        self._set_local(key, value, ttl)
+        try:
+            redis_connection.set(key, json.dumps(value), ex=ttl)
+        except Exception as e:
+            logger.error(f"Error writing signed URL cache {key}: {e}")
+
+    async def get_async(self, key: str):
+        """
+        Async version of `get`.
+        """
+        value = self._get_local(key)
+        if value is not None:
+            cache_requests.labels("signed_url", "local_hit").inc()
+            return value
+
+        try:
+            async with async_redis_connection.pipeline(transaction=False) as pipeline:
+                cached, ttl = await pipeline.get(key).ttl(key).execute()
+            if not cached:
+                cache_requests.labels("signed_url", "miss").inc()
+                return None
+
+            cache_requests.labels("signed_url", "hit").inc()
+            value = json.loads(cached)
+            if ttl and ttl > 0:
+                self._set_local(key, value, ttl)
+            return value
+        except Exception as e:
+            logger.error(f"Error reading signed URL cache {key}: {e}")
+            return None
+
+    async def set_async(self, key: str, value: dict, ttl: int):
+        """
+        Async version of `set`.
+        """
+        if not value or ttl <= 0:
+            return
+
+        self._set_local(key, value, ttl)
+        try:
+            await async_redis_connection.set(key, json.dumps(value), ex=ttl)
+        except Exception as e:
+            logger.error(f"Error writing signed URL cache {key}: {e}")
+
+
+signed_url_cache = SignedUrlCache(settings.signed_url_cache.signed_url_local_cache_size)
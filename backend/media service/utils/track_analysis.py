@@ -0,0 +1,132 @@
+import json
+import os
+import wave
+import numpy as np
+from config.config import settings
+
+
+# the analysis is written next to the rendition; consumers find it through the manifest
+ANALYSIS_FILE_NAME = "analysis.json"
+EXCERPT_FILE_NAME = "excerpt.wav"
+# ffmpeg's raw outputs, turned into the files above once it exits
+PEAKS_PCM_FILE_NAME = "peaks.pcm"
+EXCERPT_SOURCE_FILE_NAME = "excerpt_source.wav"
+# the rate of the mono PCM the peaks and the exact duration are read from
+PEAKS_SAMPLE_RATE = 8000
+EXCERPT_SAMPLE_RATE = 48000
+# samples of the peaks PCM read at a time, so a long mix is scanned in constant memory
+PEAKS_CHUNK_SAMPLES = 1 << 20
+
+
+def analysis_ffmpeg_args(analysis_dir: str) -> list:
+    """
+    Extra ffmpeg outputs sharing the decode of the transcode: a low rate mono PCM stream for
+    the waveform peaks and duration, and the start of the track as 48 kHz mono WAV, long
+    enough to cut the excerpt from.
+    """
+    excerpt_end = settings.hls.hls_analysis_excerpt_offset + settings.hls.hls_analysis_excerpt_duration
+    return [
+        "-map", "0:a:0", "-vn", "-ac", "1", "-ar", str(PEAKS_SAMPLE_RATE),
+        "-c:a", "pcm_s16le", "-f", "s16le", os.path.join(analysis_dir, PEAKS_PCM_FILE_NAME),
+        "-map", "0:a:0", "-vn", "-af", f"atrim=end={excerpt_end}", "-ac", "1", "-ar", str(EXCERPT_SAMPLE_RATE),
+        "-c:a", "pcm_s16le", "-f", "wav", os.path.join(analysis_dir, EXCERPT_SOURCE_FILE_NAME),
+    ]
+
+
+def waveform_peaks(pcm_path: str, count: int) -> list:
+    """
+    Downsample a 16 bit little-endian mono PCM file to `count` peak amplitudes between 0 and 1,
+    one per equal slice of the track, for drawing its waveform. The file is read in chunks of
+    `PEAKS_CHUNK_SAMPLES`, each folded into the peaks of the slices it overlaps.
+    """
+    total = os.path.getsize(pcm_path) // 2
+    if not total:
+        return []
+
+    count = min(count, total)
+    # slice `index` covers samples [bounds[index], bounds[index + 1])
+    bounds = total * np.arange(count + 1, dtype=np.int64) // count
+    peaks = np.zeros(count, dtype=np.int32)
+    offset = 0
+    with open(pcm_path, "rb") as pcm_file:
+        while offset < total:
+            chunk = np.fromfile(pcm_file, dtype="<i2", count=min(PEAKS_CHUNK_SAMPLES, total - offset))
+            if not len(chunk):
+                break
+
+            first = np.searchsorted(bounds, offset, side="right") - 1
+            last = np.searchsorted(bounds, offset + len(chunk), side="left")
+            starts = np.maximum(bounds[first:last] - offset, 0)
+            # widened first, the magnitude of -32768 does not fit 16 bits
+            maxima = np.maximum.reduceat(np.abs(chunk.astype(np.int32)), starts)
+            peaks[first:last] = np.maximum(peaks[first:last], maxima)
+            offset += len(chunk)
+
+    return [round(int(peak) / 32768, 3) for peak in peaks]
+
+
+def _cut_excerpt(source_path: str, excerpt_path: str) -> tuple:
+    """
+    Keep `hls_analysis_excerpt_duration` seconds of the decoded start of the track, from
+    `hls_analysis_excerpt_offset` on, or its last seconds when the track is shorter.
+    Returns the excerpt's start and length in seconds.
+    """
+    with wave.open(source_path, "rb") as source:
+        params = source.getparams()
+        frames = source.getnframes()
+        length = min(frames, settings.hls.hls_analysis_excerpt_duration * params.framerate)
+        start = min(settings.hls.hls_analysis_excerpt_offset * params.framerate, frames - length)
+        source.setpos(start)
+        data = source.readframes(length)
+
+    with wave.open(excerpt_path, "wb") as excerpt:
+        excerpt.setparams(params)
+        excerpt.writeframes(data)
+    return round(start / params.framerate, 3), round(length / params.framerate, 3)
+
+
+def write_track_analysis(analysis_dir: str, source: dict = None, loudness: dict = None) -> dict:
+    """
+    Turn the analysis outputs of a finished ffmpeg run into the analysis sidecar and the
+    excerpt, replacing the raw outputs.
+    Args:
+        analysis_dir (str): The directory passed to `analysis_ffmpeg_args`.
+        source (dict): The probed source, for its sample rate and channels.
+        loudness (dict): The loudness measured by the same run, see `loudness_metadata`.
+    Returns:
+        dict: The analysis: exact `duration`, source `sample_rate` and `channels`, integrated
+            loudness `lufs`, loudness range and true peak, the waveform `peaks` and the
+            `excerpt` file with its start, length and sample rate.
+    """
+    peaks_path = os.path.join(analysis_dir, PEAKS_PCM_FILE_NAME)
+    samples = os.path.getsize(peaks_path) // 2
+    peaks = waveform_peaks(peaks_path, settings.hls.hls_analysis_peaks)
+    os.remove(peaks_path)
+
+    excerpt_source = os.path.join(analysis_dir, EXCERPT_SOURCE_FILE_NAME)
+    excerpt_start, excerpt_duration = _cut_excerpt(excerpt_source, os.path.join(analysis_dir, EXCERPT_FILE_NAME))
+    os.remove(excerpt_source)
+
+    source = source or {}
+    loudness = loudness or {}
+    duration = samples / PEAKS_SAMPLE_RATE
+    analysis = {
+        "duration": round(duration, 4),
+        "sample_rate": source.get("sample_rate"),
+        "channels": source.get("channels"),
+        "lufs": loudness.get("integrated"),
+        "loudness_range": loudness.get("range"),
+        "true_peak": loudness.get("true_peak"),
+        "peaks": peaks,
+        "excerpt": {
+            "uri": EXCERPT_FILE_NAME,
+            "start": excerpt_start,
+            "duration": excerpt_duration,
+            "sample_rate": EXCERPT_SAMPLE_RATE,
+            "channels": 1,
+        },
+    }
+
+    with open(os.path.join(analysis_dir, ANALYSIS_FILE_NAME), "w") as analysis_file:
+        json.dump(analysis, analysis_file, separators=(",", ":"))
+    return analysis
@@ -0,0 +1,105 @@
+import json
+import re
+from config.config import settings
+from libs.redis import redis_connection
+from libs.logger import logger
+
+
+# ffmpeg's ebur128 filter, on the decode that feeds the encoder: integrated loudness, loudness
+# range and true peak are logged as a summary when the stream ends
+EBUR128_FILTER = "ebur128=peak=true:framelog=verbose"
+
+_INTEGRATED = re.compile(r"^\s*I:\s+(-?[\d.]+|-?inf) LUFS", re.MULTILINE)
+_RANGE = re.compile(r"^\s*LRA:\s+(-?[\d.]+|-?inf) LU\b", re.MULTILINE)
+_TRUE_PEAK = re.compile(r"True peak:\s+Peak:\s+(-?[\d.]+|-?inf) dBFS")
+
+
+def track_loudness_key(audio_id: str, is_add: bool = False) -> str:
+    return f"track_loudness:{'add' if is_add else 'music'}:{audio_id}"
+
+
+def _number(match):
+    if not match:
+        return None
+    value = float(match.group(1))
+    return value if value not in (float("inf"), float("-inf")) else None
+
+
+def parse_ebur128_summary(log: str):
+    """
+    Extract the measurement of the ebur128 filter from an ffmpeg log.
+    Returns:
+        dict | None: `integrated` (LUFS), `range` (LU) and `true_peak` (dBTP), or None when
+            the log has no summary or the track is silent.
+    """
+    start = log.rfind("Summary:")
+    if start < 0:
+        return None
+
+    summary = log[start:]
+    integrated = _number(_INTEGRATED.search(summary))
+    if integrated is None:
+        return None
+
+    return {
+        "integrated": integrated,
+        "range": _number(_RANGE.search(summary)),
+        "true_peak": _number(_TRUE_PEAK.search(summary)),
+    }
+
+
+def normalization_gain(measurement: dict):
+    """
+    Return the gain in dB that brings a track to the target loudness without pushing its
+    true peak above the ceiling, or None for an unknown measurement.
+    """
+    if not measurement or measurement.get("integrated") is None:
+        return None
+
+    gain = settings.hls.hls_loudness_target - measurement["integrated"]
+    if measurement.get("true_peak") is not None:
+        gain = min(gain, settings.hls.hls_loudness_true_peak_ceiling - measurement["true_peak"])
+
+    max_gain = settings.hls.hls_loudness_max_gain
+    return round(max(-max_gain, min(max_gain, gain)), 2)
+
+
+def loudness_metadata(measurement: dict, applied_gain: float = None):
+    """
+    Describe the loudness of a rendition for players: the measured source, the gain baked into
+    the rendition and the `gain` still to be applied at playback to reach the target.
+    """
+    target_gain = normalization_gain(measurement)
+    if target_gain is None:
+        return None
+
+    applied_gain = applied_gain or 0.0
+    return dict(
+        measurement,
+        target=settings.hls.hls_loudness_target,
+        applied_gain=applied_gain,
+        gain=round(target_gain - applied_gain, 2),
+    )
+
+
+def save_track_loudness(audio_id: str, is_add: bool, measurement: dict):
+    """
+    Remember the loudness measured for a track; it does not change between transcodes.
+    """
+    try:
+        redis_connection.set(track_loudness_key(audio_id, is_add), json.dumps(measurement))
+    except Exception as e:
+        logger.error(f"Error saving loudness of {audio_id}: {e}")
+
+
+def load_track_loudness(audio_id: str, is_add: bool = False):
+    """
+    Return the loudness measured by an earlier transcode of the track, or None.
+    """
+    try:
+        cached = redis_connection.get(track_loudness_key(audio_id, is_add))
+    except Exception as e:
+        logger.error(f"Error reading loudness of {audio_id}: {e}")
+        return None
+
+    return json.loads(cached) if cached else None
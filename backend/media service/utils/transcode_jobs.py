@@ -0,0 +1,392 @@
+import asyncio
+import json
+import time
+import uuid
+from config.config import settings
+from libs.redis import async_redis_connection, redis_connection
+from libs.logger import audio_id_var, logger
+from utils.generate_hls import generate_hls
+from utils.hls_manifest import load_manifest, load_manifest_async
+from utils.metrics import transcode_locks, transcode_seconds, transcode_wait_seconds, transcodes
+from utils.rendition_storage import record_rendition
+from utils.transcode_queue import enqueue_transcode
+from utils.transcode_scheduler import PRIORITY_BACKFILL, PRIORITY_INGEST, PRIORITY_INTERACTIVE, transcode_scheduler
+
+
+STATUS_QUEUED = "queued"
+STATUS_PROCESSING = "processing"
+# the first segments are playable while the rest of the track is still encoding
+STATUS_STREAMING = "streaming"
+STATUS_READY = "ready"
+STATUS_FAILED = "failed"
+STATUS_MISSING = "missing"
+PENDING_STATUSES = (STATUS_QUEUED, STATUS_PROCESSING)
+PLAYABLE_STATUSES = (STATUS_STREAMING, STATUS_READY)
+
+DISPATCH_LOCAL = "local"
+DISPATCH_QUEUE = "queue"
+
+STATUS_TTL = 86400
+# failed transcodes are retried by the next request once this expires
+FAILED_STATUS_TTL = 60
+
+# Delete the lock only if it is still held by the given owner token
+RELEASE_LOCK_SCRIPT = redis_connection.register_script("""
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+""")
+
+# Push the lock expiry back only if it is still held by the given owner token
+EXTEND_LOCK_SCRIPT = redis_connection.register_script("""
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+end
+return 0
+""")
+
+
+def _kind(is_add: bool) -> str:
+    return 'add' if is_add else 'music'
+
+
+def transcode_lock_key(audio_id: str, is_add: bool = False) -> str:
+    return f"hls_lock:{_kind(is_add)}:{audio_id}"
+
+
+def transcode_status_key(audio_id: str, is_add: bool = False) -> str:
+    return f"hls_status:{_kind(is_add)}:{audio_id}"
+
+
+def transcode_channel(audio_id: str, is_add: bool = False) -> str:
+    return f"hls_done:{_kind(is_add)}:{audio_id}"
+
+
+def transcode_dispatch_key(audio_id: str, is_add: bool = False) -> str:
+    """
+    Set while a transcode sits in the audio-tasks queue, before a worker takes its lock.
+    """
+    return f"hls_dispatch:{_kind(is_add)}:{audio_id}"
+
+
+def acquire_transcode_lock(audio_id: str, is_add: bool = False):
+    """
+    Atomically take the single-flight transcode lock of a rendition.
+    Returns:
+        str | None: The owner token, or None when another transcode holds the lock.
+    """
+    token = uuid.uuid4().hex
+    acquired = redis_connection.set(
+        transcode_lock_key(audio_id, is_add),
+        token,
+        nx=True,
+        ex=settings.hls.hls_transcode_lock_ttl
+    )
+    transcode_locks.labels("acquired" if acquired else "contended").inc()
+    return token if acquired else None
+
+
+def release_transcode_lock(audio_id: str, is_add: bool, token: str) -> bool:
+    return bool(RELEASE_LOCK_SCRIPT(keys=[transcode_lock_key(audio_id, is_add)], args=[token]))
+
+
+def extend_transcode_lock(audio_id: str, is_add: bool, token: str) -> bool:
+    return bool(EXTEND_LOCK_SCRIPT(
+        keys=[transcode_lock_key(audio_id, is_add)],
+        args=[token, settings.hls.hls_transcode_lock_ttl]
+    ))
+
+
+def _set_status(audio_id: str, is_add: bool, status: str, message: str = None, **details):
+    """
+    Store the status of a transcode. `details` (e.g. the probed source) are kept with it.
+    """
+    payload = json.dumps({"status": status, "message": message, "updated_at": int(time.time()), **details})
+    ttl = FAILED_STATUS_TTL if status == STATUS_FAILED else STATUS_TTL
+    redis_connection.set(transcode_status_key(audio_id, is_add), payload, ex=ttl)
+    return payload
+
+
+def transcode_in_progress(audio_id: str, is_add: bool = False) -> bool:
+    """
+    Whether a transcode of the rendition holds its lock or waits in the ingest queue.
+    """
+    return bool(redis_connection.exists(transcode_lock_key(audio_id, is_add), transcode_dispatch_key(audio_id, is_add)))
+
+
+async def transcode_in_progress_async(audio_id: str, is_add: bool = False) -> bool:
+    """
+    Async version of `transcode_in_progress`.
+    """
+    return bool(await async_redis_connection.exists(
+        transcode_lock_key(audio_id, is_add), transcode_dispatch_key(audio_id, is_add)
+    ))
+
+
+def get_transcode_status(audio_id: str, is_add: bool = False) -> dict:
+    """
+    Return the transcode status of a rendition: queued, processing, streaming, ready, failed or missing.
+    """
+    cached = redis_connection.get(transcode_status_key(audio_id, is_add))
+    status = json.loads(cached) if cached else None
+    if status and status["status"] not in PENDING_STATUSES + (STATUS_STREAMING,):
+        return status
+
+    # a lock that expired with its owner leaves a stale pending status behind
+    if transcode_in_progress(audio_id, is_add):
+        return status or {"status": STATUS_QUEUED, "message": None, "updated_at": None}
+
+    manifest = load_manifest(audio_id, is_add=is_add)
+    if manifest is not None and manifest.get("complete", True):
+        return {"status": STATUS_READY, "message": None, "updated_at": None}
+
+    return {"status": STATUS_MISSING, "message": None, "updated_at": None}
+
+
+async def get_transcode_status_async(audio_id: str, is_add: bool = False) -> dict:
+    """
+    Async version of `get_transcode_status`.
+    """
+    cached = await async_redis_connection.get(transcode_status_key(audio_id, is_add))
+    status = json.loads(cached) if cached else None
+    if status and status["status"] not in PENDING_STATUSES + (STATUS_STREAMING,):
+        return status
+
+    if await transcode_in_progress_async(audio_id, is_add):
+        return status or {"status": STATUS_QUEUED, "message": None, "updated_at": None}
+
+    manifest = await load_manifest_async(audio_id, is_add=is_add)
+    if manifest is not None and manifest.get("complete", True):
+        return {"status": STATUS_READY, "message": None, "updated_at": None}
+
+    return {"status": STATUS_MISSING, "message": None, "updated_at": None}
+
+
+def _needs_normalization(result: dict) -> bool:
+    """
+    Whether a finished transcode left a loudness gain to bake into the rendition: the first
+    transcode of a track only measures its loudness, and a remuxed rendition never carries one.
+    """
+    loudness = (result.get("manifest") or {}).get("loudness")
+    if not settings.hls.hls_loudness_normalize or not loudness or result.get("remux"):
+        return False
+    return not loudness["applied_gain"] and abs(loudness["gain"]) >= settings.hls.hls_loudness_reencode_min_gain
+
+
+def _queue_normalization(audio_id: str, is_add: bool):
+    """
+    Queue the re-encode that applies the loudness measured by the transcode that just finished.
+    """
+    logger.info(f"Queueing a loudness normalized re-encode of audio_id {audio_id}")
+    try:
+        if settings.hls.hls_transcode_dispatch == DISPATCH_QUEUE:
+            enqueue_transcode(audio_id, is_add, priority=PRIORITY_BACKFILL, force=True)
+            return
+
+        token = acquire_transcode_lock(audio_id, is_add)
+        if token is None:
+            logger.info(f"HLS generation already in progress for audio_id: {audio_id}")
+            return
+        transcode_scheduler.submit(_run_transcode, audio_id, is_add, token, True, priority=PRIORITY_BACKFILL)
+    except Exception as e:
+        logger.error(f"Error queueing the normalized re-encode of audio_id {audio_id}: {e}")
+
+
+def _run_transcode(audio_id: str, is_add: bool, token: str, force: bool = False):
+    streaming = False
+    normalize = False
+
+    def on_progress(manifest):
+        nonlocal streaming
+        # wake the waiters as soon as the first segments can be played
+        if not streaming:
+            streaming = True
+            payload = _set_status(audio_id, is_add, STATUS_STREAMING)
+            redis_connection.publish(transcode_channel(audio_id, is_add), payload)
+
+    # every log line of the transcode names the track, also when no request started it
+    audio_id_var.set(audio_id)
+    started = time.monotonic()
+    try:
+        # the lock may have waited in the scheduler queue; give the encode its full lease, or
+        # give up if the lock expired meanwhile and another transcode may have taken over
+        if not extend_transcode_lock(audio_id, is_add, token):
+            logger.info(f"Transcode lock of audio_id {audio_id} expired while queued, skipping")
+            return
+
+        _set_status(audio_id, is_add, STATUS_PROCESSING)
+        # a forced transcode encodes the shared rendition of identical uploads again too
+        result = generate_hls(audio_id=audio_id, is_add=is_add, on_progress=on_progress, reuse=not force)
+
+        # the probe is kept with the job to explain why a source was remuxed or re-encoded
+        details = {
+            "source": result.get("source"),
+            "remux": result.get("remux"),
+            "loudness": (result.get("manifest") or {}).get("loudness"),
+        }
+        if result.get("status") == "success":
+            record_rendition(audio_id, is_add, result["upload"]["bytes"])
+            payload = _set_status(audio_id, is_add, STATUS_READY, **details)
+            transcodes.labels("linked" if result.get("linked") else "success").inc()
+            normalize = _needs_normalization(result)
+        else:
+            payload = _set_status(audio_id, is_add, STATUS_FAILED, result.get("message"), **details)
+            transcodes.labels("failed").inc()
+    except Exception as e:
+        logger.error(f"Error transcoding audio_id {audio_id}: {e}")
+        payload = _set_status(audio_id, is_add, STATUS_FAILED, str(e))
+        transcodes.labels("failed").inc()
+    finally:
+        release_transcode_lock(audio_id, is_add, token)
+        transcode_seconds.observe(time.monotonic() - started)
+
+    redis_connection.publish(transcode_channel(audio_id, is_add), payload)
+    # the unnormalized rendition is served meanwhile
+    if normalize:
+        _queue_normalization(audio_id, is_add)
+
+
+def run_transcode(audio_id: str, is_add: bool = False, force: bool = False, priority: int = PRIORITY_INGEST) -> str:
+    """
+    Transcode a rendition and block until it is done, e.g. from the ingest worker. Shares the
+    single-flight lock and the scheduler slots with on-demand transcodes, so a rendition is
+    never encoded twice at once and the encodes of this process never exceed the slots.
+    Args:
+        audio_id (str): The ID of the audio file.
+        is_add (bool): Whether the audio is an advertisement.
+        force (bool): Transcode even if a complete rendition already exists.
+        priority (int): The scheduler lane, see `utils.transcode_scheduler`.
+    Returns:
+        str: The resulting status.
+    """
+    try:
+        if not force:
+            manifest = load_manifest(audio_id, is_add=is_add)
+            if manifest is not None and manifest.get("complete", True):
+                logger.info(f"HLS rendition already exists for audio_id: {audio_id}")
+                # requests may be waiting on the queued status a dispatch to this worker set
+                payload = _set_status(audio_id, is_add, STATUS_READY)
+                redis_connection.publish(transcode_channel(audio_id, is_add), payload)
+                return STATUS_READY
+
+        token = acquire_transcode_lock(audio_id, is_add)
+        if token is None:
+            logger.info(f"HLS generation already in progress for audio_id: {audio_id}")
+            return get_transcode_status(audio_id, is_add)["status"]
+
+        _set_status(audio_id, is_add, STATUS_QUEUED)
+        transcode_scheduler.run(_run_transcode, audio_id, is_add, token, force, priority=priority)
+        return get_transcode_status(audio_id, is_add)["status"]
+    finally:
+        redis_connection.delete(transcode_dispatch_key(audio_id, is_add))
+
+
+def _dispatch_to_queue(audio_id: str, is_add: bool, priority: int) -> str:
+    # only the first request queues the job, the others wait for the same one
+    if not redis_connection.set(transcode_dispatch_key(audio_id, is_add), "1", nx=True, ex=settings.hls.hls_transcode_lock_ttl):
+        return get_transcode_status(audio_id, is_add)["status"]
+
+    try:
+        _set_status(audio_id, is_add, STATUS_QUEUED)
+        enqueue_transcode(audio_id, is_add, priority=priority)
+    except Exception as e:
+        logger.error(f"Error queueing HLS generation for audio_id {audio_id}: {e}")
+        redis_connection.delete(transcode_dispatch_key(audio_id, is_add))
+        payload = _set_status(audio_id, is_add, STATUS_FAILED, str(e))
+        redis_connection.publish(transcode_channel(audio_id, is_add), payload)
+        return STATUS_FAILED
+
+    logger.info(f"Queued HLS generation for audio_id {audio_id} on the ingest worker")
+    return STATUS_QUEUED
+
+
+def request_transcode(audio_id: str, is_add: bool = False, priority: int = PRIORITY_INTERACTIVE) -> str:
+    """
+    Start a background transcode unless one is already running for the rendition.
+    Args:
+        audio_id (str): The ID of the audio file.
+        is_add (bool): Whether the audio is an advertisement.
+        priority (int): The scheduler lane, `PRIORITY_PREFETCH` when no listener is waiting yet.
+    Returns:
+        str: The resulting status, `queued` when this call started the job and `failed`
+            while a recent failure is remembered.
+    """
+    cached = redis_connection.get(transcode_status_key(audio_id, is_add))
+    if cached and json.loads(cached)["status"] == STATUS_FAILED:
+        return STATUS_FAILED
+
+    if settings.hls.hls_transcode_dispatch == DISPATCH_QUEUE:
+        return _dispatch_to_queue(audio_id, is_add, priority)
+
+    token = acquire_transcode_lock(audio_id, is_add)
+    if token is None:
+        logger.info(f"HLS generation already in progress for audio_id: {audio_id}")
+        return get_transcode_status(audio_id, is_add)["status"]
+
+    _set_status(audio_id, is_add, STATUS_QUEUED)
+    transcode_scheduler.submit(_run_transcode, audio_id, is_add, token, priority=priority)
+    logger.info(f"Queued HLS generation for audio_id: {audio_id}")
+    return STATUS_QUEUED
+
+
+def wait_for_transcode(audio_id: str, is_add: bool = False, timeout: float = 0) -> str:
+    """
+    Block until the running transcode of a rendition is playable, has failed, or `timeout` seconds pass.
+    Returns:
+        str: The last known status.
+    """
+    timeout = min(max(0, timeout), settings.hls.hls_transcode_max_wait)
+    started = time.monotonic()
+    deadline = started + timeout
+
+    pubsub = redis_connection.pubsub(ignore_subscribe_messages=True)
+    try:
+        # Subscribe before reading the status so a completion in between is not missed
+        pubsub.subscribe(transcode_channel(audio_id, is_add))
+        status = get_transcode_status(audio_id, is_add)["status"]
+
+        while status in PENDING_STATUSES:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+
+            message = pubsub.get_message(timeout=remaining)
+            if message and message["type"] == "message":
+                status = json.loads(message["data"])["status"]
+    finally:
+        pubsub.close()
+
+    transcode_wait_seconds.observe(time.monotonic() - started)
+    return status
+
+
+async def wait_for_transcode_async(audio_id: str, is_add: bool = False, timeout: float = 0) -> str:
+    """
+    Async version of `wait_for_transcode`: the wait holds no thread, only a pooled connection.
+    """
+    timeout = min(max(0, timeout), settings.hls.hls_transcode_max_wait)
+    started = time.monotonic()
+    deadline = started + timeout
+
+    pubsub = async_redis_connection.pubsub(ignore_subscribe_messages=True)
+    try:
+        await pubsub.subscribe(transcode_channel(audio_id, is_add))
+        status = (await get_transcode_status_async(audio_id, is_add))["status"]
+
+        while status in PENDING_STATUSES:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+
+            try:
+                message = await asyncio.wait_for(pubsub.get_message(timeout=remaining), remaining)
+            except asyncio.TimeoutError:
+                break
+            if message and message["type"] == "message":
+                status = json.loads(message["data"])["status"]
+    finally:
+        await pubsub.aclose()
+
+    transcode_wait_seconds.observe(time.monotonic() - started)
+    return status
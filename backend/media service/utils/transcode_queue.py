@@ -0,0 +1,65 @@
+import asyncio
+import threading
+from bullmq import Queue
+from libs.logger import request_id_var
+from libs.redis import connection_url
+from utils.transcode_scheduler import PRIORITY_INTERACTIVE
+
+
+QUEUE_NAME = "audio-tasks"
+JOB_TRANSCODE = "transcode"
+
+_loop = None
+_queue = None
+_lock = threading.Lock()
+
+
+async def _create_queue():
+    return Queue(QUEUE_NAME, {"connection": connection_url})
+
+
+def _audio_tasks_queue():
+    """
+    Return the audio-tasks queue and the event loop it lives on. The queue is async, so it
+    runs on a loop of its own and can be used from the sync request handlers.
+    """
+    global _loop, _queue
+    with _lock:
+        if _queue is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="audio-tasks-queue", daemon=True).start()
+            _queue = asyncio.run_coroutine_threadsafe(_create_queue(), _loop).result()
+    return _queue, _loop
+
+
+def enqueue_transcode(audio_id: str, is_add: bool = False, priority: int = PRIORITY_INTERACTIVE, force: bool = False, timeout: float = 10):
+    """
+    Queue a transcode for the ingest worker.
+    Args:
+        audio_id (str): The ID of the audio file.
+        is_add (bool): Whether the audio is an advertisement.
+        priority (int): One of the PRIORITY_* lanes of `utils.transcode_scheduler`; BullMQ also
+            serves lower numbers first.
+        force (bool): Transcode even if a complete rendition exists, e.g. to apply a known gain.
+        timeout (float): Seconds to wait for Redis to accept the job.
+    Returns:
+        str: The job id.
+    """
+    queue, loop = _audio_tasks_queue()
+    job = asyncio.run_coroutine_threadsafe(
+        queue.add(
+            JOB_TRANSCODE,
+            {
+                "type": JOB_TRANSCODE,
+                "audio_id": audio_id,
+                "is_add": is_add,
+                "force": force,
+                "priority": priority,
+                # the worker logs the transcode under the request that asked for it
+                "request_id": request_id_var.get(),
+            },
+            {"priority": priority, "removeOnComplete": True, "removeOnFail": 1000}
+        ),
+        loop
+    ).result(timeout)
+    return job.id
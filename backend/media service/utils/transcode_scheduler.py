@@ -0,0 +1,157 @@
+import contextvars
+import heapq
+import itertools
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from config.config import settings
+from utils.metrics import transcodes_queued, transcodes_running
+
+
+# Lower runs first, shared with the BullMQ priorities of the audio-tasks queue
+PRIORITY_INTERACTIVE = 1
+PRIORITY_PREFETCH = 3
+PRIORITY_INGEST = 5
+PRIORITY_BACKFILL = 10
+
+PRIORITY_NAMES = {
+    PRIORITY_INTERACTIVE: "interactive",
+    PRIORITY_PREFETCH: "prefetch",
+    PRIORITY_INGEST: "ingest",
+    PRIORITY_BACKFILL: "backfill",
+}
+
+
+def available_cores() -> int:
+    try:
+        # the cores this process may run on, which is what a container is limited to
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def transcode_slots() -> int:
+    """
+    Number of encodes allowed to run at once: `hls_transcode_workers` when set, otherwise
+    the configured share of the cores.
+    """
+    if settings.hls.hls_transcode_workers > 0:
+        return settings.hls.hls_transcode_workers
+    return max(1, int(available_cores() * settings.hls.hls_transcode_cpu_share))
+
+
+def ffmpeg_threads() -> int:
+    """
+    Threads each ffmpeg may use, so that every slot busy never oversubscribes the cores.
+    """
+    if settings.hls.hls_ffmpeg_threads > 0:
+        return settings.hls.hls_ffmpeg_threads
+    return max(1, available_cores() // transcode_slots())
+
+
+class TranscodeScheduler:
+    """
+    Run transcodes on a fixed number of slots, highest priority first.
+
+    Work beyond the slots waits in a priority queue instead of starting another ffmpeg, so a
+    burst of cold tracks is encoded at the machine's steady throughput and a listener waiting
+    for a track is served before prefetch and backfill work. Queue depth and wait times are
+    reported by `stats`.
+    """
+
+    def __init__(self, slots: int):
+        self.slots = slots
+        self._queue = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._running = 0
+        self._completed = 0
+        self._failed = 0
+        self._waits = deque(maxlen=512)
+        self._threads = [
+            threading.Thread(target=self._work, name=f"hls-transcode-{index}", daemon=True)
+            for index in range(slots)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, fn, *args, priority: int = PRIORITY_INTERACTIVE, **kwargs) -> Future:
+        """
+        Queue `fn(*args, **kwargs)`, to run in the context of the caller. Returns a future of
+        its result.
+        """
+        future = Future()
+        context = contextvars.copy_context()
+        with self._condition:
+            heapq.heappush(
+                self._queue,
+                (priority, next(self._sequence), time.monotonic(), future, context, fn, args, kwargs)
+            )
+            transcodes_queued.inc()
+            self._condition.notify()
+        return future
+
+    def run(self, fn, *args, priority: int = PRIORITY_INTERACTIVE, **kwargs):
+        """
+        Queue `fn` and block until it has run on a slot.
+        """
+        return self.submit(fn, *args, priority=priority, **kwargs).result()
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while not self._queue:
+                    self._condition.wait()
+                _, _, queued_at, future, context, fn, args, kwargs = heapq.heappop(self._queue)
+                self._running += 1
+                self._waits.append(time.monotonic() - queued_at)
+                transcodes_queued.dec()
+                transcodes_running.inc()
+
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(context.run(fn, *args, **kwargs))
+                except BaseException as e:
+                    future.set_exception(e)
+
+            with self._condition:
+                self._running -= 1
+                transcodes_running.dec()
+                if future.cancelled():
+                    pass
+                elif future.exception() is None:
+                    self._completed += 1
+                else:
+                    self._failed += 1
+
+    def stats(self) -> dict:
+        """
+        Return the slots, running and queued transcodes per priority and recent wait times.
+        """
+        with self._condition:
+            queued = {name: 0 for name in PRIORITY_NAMES.values()}
+            for priority, *_ in self._queue:
+                name = PRIORITY_NAMES.get(priority, str(priority))
+                queued[name] = queued.get(name, 0) + 1
+            waits = sorted(self._waits)
+            running, completed, failed = self._running, self._completed, self._failed
+
+        return {
+            "slots": self.slots,
+            "ffmpeg_threads": ffmpeg_threads(),
+            "running": running,
+            "queued": sum(queued.values()),
+            "queued_by_priority": queued,
+            "completed": completed,
+            "failed": failed,
+            "wait_seconds": {
+                "avg": round(sum(waits) / len(waits), 3) if waits else 0.0,
+                "p95": round(waits[min(len(waits) - 1, int(len(waits) * 0.95))], 3) if waits else 0.0,
+                "max": round(waits[-1], 3) if waits else 0.0,
+            },
+        }
+
+
+transcode_scheduler = TranscodeScheduler(transcode_slots())
@@ -0,0 +1,45 @@
+"""
+Keep the HLS bucket within its storage budget by deleting the renditions of the least recently
+played tracks. Deleted renditions are transcoded again on their next play.
+
+Usage (from the media service directory):
+    python -m workers.rendition_sweeper --dry-run                  # report once
+    python -m workers.rendition_sweeper --budget-gb 500            # sweep once
+    python -m workers.rendition_sweeper --loop                     # sweep every hls_sweep_interval
+    python -m workers.rendition_sweeper --rescan                   # rebuild sizes from a bucket listing
+"""
+import argparse
+import time
+from config.config import settings
+from utils.rendition_storage import rescan_sizes, sweep
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--budget-gb", type=float, default=None, help="defaults to hls_storage_budget_bytes")
+    parser.add_argument("--dry-run", action="store_true", help="only list what would be deleted")
+    parser.add_argument("--rescan", action="store_true", help="rebuild rendition sizes from the bucket first")
+    parser.add_argument("--loop", action="store_true", help="keep sweeping every hls_sweep_interval seconds")
+    args = parser.parse_args()
+
+    budget = int(args.budget_gb * 1024 ** 3) if args.budget_gb is not None else settings.hls.hls_storage_budget_bytes
+    if not budget:
+        print("No storage budget set (hls_storage_budget_bytes or --budget-gb), nothing to do.")
+        return
+
+    if args.rescan:
+        print(f"HLS bucket holds {rescan_sizes()} bytes")
+
+    while True:
+        result = sweep(budget, dry_run=args.dry_run)
+        print(
+            f"Storage {result['before']} -> {result['after']} bytes "
+            f"of {budget}, {len(result['evicted'])} renditions {'to evict' if args.dry_run else 'evicted'}"
+        )
+        if not args.loop:
+            break
+        time.sleep(settings.hls.hls_sweep_interval)
+
+
+if __name__ == "__main__":
+    main()
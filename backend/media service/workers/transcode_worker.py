@@ -0,0 +1,193 @@
+"""
+Ingest worker for the `audio-tasks` queue: transcodes new uploads into HLS right away instead of
+on first play, through the same code path as on-demand transcodes.
+
+Usage (from the media service directory):
+    python -m workers.transcode_worker                   # consume the queue
+    python -m workers.transcode_worker backfill          # queue every track without a rendition
+    python -m workers.transcode_worker backfill --kind add --limit 100 --dry-run
+    python -m workers.transcode_worker migrate-manifests # write manifests of pre-manifest renditions
+"""
+import argparse
+import asyncio
+from bullmq import Worker
+from config.config import settings
+from libs.logger import audio_id_var, logger, request_id_var
+from libs.redis import connection_url
+from libs.s3_client import client
+from utils.hls_manifest import HLS_BUCKET_NAME, migrate_legacy_manifest
+from utils.rendition_storage import evicted_renditions
+from utils.transcode_jobs import PENDING_STATUSES, STATUS_STREAMING, run_transcode, wait_for_transcode
+from utils.transcode_queue import JOB_TRANSCODE, QUEUE_NAME, enqueue_transcode
+from utils.transcode_scheduler import PRIORITY_BACKFILL, PRIORITY_INGEST
+
+ALLOWED_JOB_TYPES = [JOB_TRANSCODE]
+SOURCE_BUCKET = settings.s3_storage.s3_bucket_name
+
+
+async def process_selector(job, token):
+    """
+    Selects and processes the appropriate audio task based on the job data.
+    Args:
+        job: The job object containing data for processing.
+        token: Authentication token if needed for processing.
+        Returns: A dictionary containing the status of the processing.
+    """
+    job_type = job.data.get("type")
+    # every job runs in a task of its own: its log lines, and those of the transcode it runs,
+    # carry the request that queued it and its track
+    request_id_var.set(job.data.get("request_id") or f"job-{job.id}")
+    audio_id_var.set(job.data.get("audio_id"))
+
+    if job_type not in ALLOWED_JOB_TYPES:
+        logger.error(f"[Job {job.id}] Invalid audio task type: {job_type}")
+        return {"status": "invalid audio task type"}
+    try:
+        if job_type == JOB_TRANSCODE:
+            # transcodes block on ffmpeg and uploads, keep them off the event loop
+            status = await asyncio.to_thread(
+                run_transcode,
+                job.data["audio_id"],
+                bool(job.data.get("is_add")),
+                bool(job.data.get("force")),
+                job.data.get("priority", PRIORITY_INGEST)
+            )
+            if status in PENDING_STATUSES + (STATUS_STREAMING,):
+                # another transcode of the rendition is running; jobs queued after this one (the
+                # sonic embedding reads its analysis) should start once it is done
+                status = await asyncio.to_thread(
+                    wait_for_transcode,
+                    job.data["audio_id"],
+                    bool(job.data.get("is_add")),
+                    settings.hls.hls_transcode_max_wait
+                )
+            return {"status": status}
+
+    except Exception as e:
+        # Log any error and return the error status
+        logger.error(f"[Job {job.id}] Error processing {job_type} task: {e}")
+        return {"status": "error", "message": str(e)}
+
+
+async def transcode_worker():
+    worker = Worker(
+        QUEUE_NAME,
+        process_selector,
+        {
+            "connection": connection_url,
+            "concurrency": settings.hls.hls_ingest_concurrency
+        },
+    )
+
+    # Worker event listeners
+    worker.on("error", lambda e: logger.error(f"Worker error: {e}"))
+    worker.on("failed", lambda job, err: logger.error(f"Job {job.id} ({job.data.get('audio_id')}) failed: {err}"))
+    worker.on("completed", lambda job, return_value: logger.info(f"Job {job.id} ({job.data.get('audio_id')}) completed → {return_value}"))
+
+    logger.info("Transcode worker started and listening for jobs...")
+
+    # Graceful shutdown mechanism
+    shutdown_event = asyncio.Event()
+    try:
+        await shutdown_event.wait()
+    finally:
+        logger.info("Shutting down worker...")
+        await worker.close()
+        logger.info("Worker shut down successfully.")
+
+
+def _list_ids(bucket_name: str, prefix: str, folders: bool) -> set:
+    """
+    List the audio IDs under `prefix`: source objects (`music/{id}`) or rendition folders
+    (`music/{id}/`).
+    """
+    ids = set()
+    paginator = client.get_paginator("list_objects_v2")
+    params = {"Bucket": bucket_name, "Prefix": prefix}
+    if folders:
+        params["Delimiter"] = "/"
+
+    for page in paginator.paginate(**params):
+        if folders:
+            ids.update(p["Prefix"][len(prefix):].rstrip("/") for p in page.get("CommonPrefixes", []))
+        else:
+            ids.update(obj["Key"][len(prefix):] for obj in page.get("Contents", []) if "/" not in obj["Key"][len(prefix):])
+
+    return ids
+
+
+def missing_renditions(kind: str = "music", include_evicted: bool = False) -> list:
+    """
+    Return the IDs of uploaded audio files that have no HLS rendition yet. Renditions the
+    sweeper evicted are left out unless `include_evicted`: they were deleted for being played
+    too rarely, and are transcoded again on demand.
+    """
+    prefix = f"{kind}/"
+    sources = _list_ids(SOURCE_BUCKET, prefix, folders=False)
+    renditions = _list_ids(HLS_BUCKET_NAME, prefix, folders=True)
+    if not include_evicted:
+        renditions |= evicted_renditions(kind)
+    return sorted(sources - renditions)
+
+
+def backfill(kind: str = "music", limit: int = None, dry_run: bool = False, force: bool = False):
+    """
+    Queue a backfill transcode for every upload without a rendition, or for every upload with
+    `force` (e.g. to apply the loudness measured by earlier transcodes), evicted ones included.
+    """
+    audio_ids = sorted(_list_ids(SOURCE_BUCKET, f"{kind}/", folders=False)) if force else missing_renditions(kind)
+    if limit:
+        audio_ids = audio_ids[:limit]
+
+    print(f"{len(audio_ids)} {kind} renditions to backfill")
+    for audio_id in audio_ids:
+        if dry_run:
+            print(audio_id)
+            continue
+        enqueue_transcode(audio_id, is_add=kind == "add", priority=PRIORITY_BACKFILL, force=force)
+
+    if not dry_run:
+        print(f"Queued {len(audio_ids)} backfill transcodes on {QUEUE_NAME}")
+
+
+def migrate_manifests(kind: str = "music", dry_run: bool = False):
+    """
+    One-time migration of the renditions generated before manifests existed: rebuild their
+    manifest from a listing and write the sidecar, without which they count as not transcoded.
+    """
+    audio_ids = sorted(_list_ids(HLS_BUCKET_NAME, f"{kind}/", folders=True))
+    migrated = 0
+    for audio_id in audio_ids:
+        if dry_run:
+            print(audio_id)
+            continue
+        if migrate_legacy_manifest(audio_id, is_add=kind == "add"):
+            migrated += 1
+
+    if not dry_run:
+        print(f"Migrated the manifests of {migrated} of {len(audio_ids)} {kind} renditions")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command")
+    backfill_parser = commands.add_parser("backfill", help="queue transcodes for uploads without a rendition")
+    backfill_parser.add_argument("--kind", choices=["music", "add"], default="music")
+    backfill_parser.add_argument("--limit", type=int, default=None)
+    backfill_parser.add_argument("--dry-run", action="store_true", help="only list the audio IDs")
+    backfill_parser.add_argument("--force", action="store_true", help="re-transcode renditions that exist too")
+    migrate_parser = commands.add_parser("migrate-manifests", help="write the manifests of renditions generated without one")
+    migrate_parser.add_argument("--kind", choices=["music", "add"], default="music")
+    migrate_parser.add_argument("--dry-run", action="store_true", help="only list the audio IDs")
+    args = parser.parse_args()
+
+    if args.command == "backfill":
+        backfill(args.kind, limit=args.limit, dry_run=args.dry_run, force=args.force)
+    elif args.command == "migrate-manifests":
+        migrate_manifests(args.kind, dry_run=args.dry_run)
+    else:
+        asyncio.run(transcode_worker())
+
+
+if __name__ == "__main__":
+    main()
@@ -94,12 +94,47 @@ class S3StorageConfig(BaseSettingClass):
         s3_access_key_id (str): Access key for S3 authentication.
         s3_secret_access_key (str): Secret key for S3 authentication.
         s3_bucket_name (str): Primary bucket used for storing media assets.
+        hls_bucket_name (str): Bucket of the HLS renditions and the analysis sidecars
+            the media service writes next to them.
     """
     s3_region: str = ""
     s3_endpoint: str = ""
     s3_access_key_id: str = ""
     s3_secret_access_key: str = ""
     s3_bucket_name: str = "addis-music"
+    hls_bucket_name: str = "hls-playlist"
+
+
+class EmbeddingConfig(BaseSettingClass):
+    """
+    Settings for the text embedding model.
+
+    Attributes:
+        embedding_batch_size (int): Most texts embedded in one call of the model. Texts of
+            concurrent jobs are gathered into one batch up to this size.
+        embedding_batch_wait_ms (float): How long the first text of a batch waits for the
+            texts of other jobs before the batch is embedded.
+    """
+    embedding_batch_size: int = 32
+    embedding_batch_wait_ms: float = 5.0
+
+
+class AudioEmbeddingConfig(BaseSettingClass):
+    """
+    Settings for the sonic (CLAP) embedding of tracks.
+
+    Every sonic embedding is computed from the same excerpt of the track, 48 kHz mono: the one
+    the media service publishes with its analysis, or the same window cut from the original
+    when the track has no analysis. Keep these equal to the media service's
+    `hls_analysis_excerpt_offset` and `hls_analysis_excerpt_duration`.
+
+    Attributes:
+        audio_embedding_excerpt_offset (int): Seconds into the track the excerpt starts at.
+        audio_embedding_excerpt_duration (int): Length of the excerpt in seconds. Tracks
+            shorter than that are embedded whole.
+    """
+    audio_embedding_excerpt_offset: int = 30
+    audio_embedding_excerpt_duration: int = 30
 
 
 class Settings:
@@ -114,11 +149,15 @@ class Settings:
         redis (RedisConfig): Redis settings instance.
         cloudinary (CloudinaryConfig): Cloudinary credentials.
         s3_storage (S3StorageConfig): S3 storage configuration.
+        embedding (EmbeddingConfig): Text embedding batching.
+        audio_embedding (AudioEmbeddingConfig): The excerpt sonic embeddings are computed from.
     """
     database: DatabaseConfig = DatabaseConfig()
     redis: RedisConfig = RedisConfig()
     cloudinary: CloudinaryConfig = CloudinaryConfig()
     s3_storage: S3StorageConfig = S3StorageConfig()
+    embedding: EmbeddingConfig = EmbeddingConfig()
+    audio_embedding: AudioEmbeddingConfig = AudioEmbeddingConfig()
 
 
 # Global settings instance used across the application
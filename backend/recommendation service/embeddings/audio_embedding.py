@@ -3,6 +3,7 @@ from io import BytesIO
 import torch
 import librosa
 from transformers import ClapProcessor, ClapModel
+from config.config import settings
 from utils.download_audio_from_s3 import download_audio_from_s3
 
 
@@ -61,7 +62,43 @@ def extract_audio_features(audio_stream: BytesIO, sr: int = 48000) -> torch.Tens
 
     # Load audio data using librosa from BytesIO
     audio, _ = librosa.load(audio_stream, sr=sr)
+    return _embed_audio(audio, sr)
 
+
+def track_excerpt(audio, sr: int = 48000):
+    """
+    Cut the excerpt a sonic embedding is computed from out of a whole decoded track: the same
+    window the media service cuts for its analysis, or the last seconds of a shorter track.
+
+    Args:
+        audio (numpy.ndarray): The mono samples of the whole track.
+        sr (int): Sampling rate of the samples.
+
+    Returns:
+        numpy.ndarray: The samples of the excerpt.
+    """
+    length = min(len(audio), settings.audio_embedding.audio_embedding_excerpt_duration * sr)
+    start = min(settings.audio_embedding.audio_embedding_excerpt_offset * sr, len(audio) - length)
+    return audio[start:start + length]
+
+
+def extract_track_features(audio_stream: BytesIO, sr: int = 48000):
+    """
+    Extracts the audio features of a whole track from its excerpt, for tracks without the
+    analysis of the media service, so that their features compare with those of the others.
+
+    Args:
+        audio_stream (BytesIO): Byte stream of the whole audio file.
+        sr (int): Sampling rate for the audio.
+
+    Returns:
+        tuple: The extracted features as a numpy array, and the track duration in seconds.
+    """
+    audio, _ = librosa.load(audio_stream, sr=sr)
+    return _embed_audio(track_excerpt(audio, sr), sr), len(audio) / sr
+
+
+def _embed_audio(audio, sr: int):
     # Process the audio
     inputs = processor(audios=audio, sampling_rate=sr, return_tensors="pt")
 
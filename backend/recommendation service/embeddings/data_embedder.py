@@ -1,6 +1,8 @@
+import asyncio
 import os
 import torch
 from sentence_transformers import SentenceTransformer
+from config.config import settings
 
 def load_model(model_path: str) -> SentenceTransformer:
     """
@@ -45,3 +47,97 @@ def embed_text(text: str) -> torch.Tensor:
     """
     embedding = model.encode([text], convert_to_tensor=True)[0]
     return embedding
+
+
+class EmbeddingBatcher:
+    """
+    Gather the texts of concurrent jobs into one call of the model.
+
+    The first pending text waits `max_wait` seconds for others, or less once `max_batch_size`
+    texts are pending. The batch is encoded in a thread, so the event loop keeps taking jobs,
+    and one batch runs at a time: texts arriving meanwhile form the next batch.
+
+    Args:
+        model (SentenceTransformer): The model to embed with.
+        max_batch_size (int): Most texts encoded in one call.
+        max_wait (float): Seconds the first text of a batch waits for more.
+    """
+
+    def __init__(self, model: SentenceTransformer, max_batch_size: int, max_wait: float):
+        self.model = model
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait
+        self._pending = []
+        self._timer = None
+        self._encoding = asyncio.Lock()
+
+    async def embed(self, text: str) -> torch.Tensor:
+        """
+        Embed a text in the next batch.
+
+        Args:
+            text (str): Text to be embedded.
+
+        Returns:
+            torch.Tensor: Tensor containing the embedding.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((text, future))
+
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            asyncio.get_running_loop().create_task(self._encode(batch))
+
+    async def _encode(self, batch: list):
+        texts = [text for text, _ in batch]
+        try:
+            async with self._encoding:
+                embeddings = await asyncio.to_thread(
+                    self.model.encode, texts, batch_size=len(texts), convert_to_tensor=True
+                )
+        except Exception as e:
+            if len(batch) > 1:
+                # encode the texts one by one, so only the job with the failing text fails
+                for item in batch:
+                    await self._encode([item])
+                return
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), embedding in zip(batch, embeddings):
+            # a job cancelled while waiting no longer wants its embedding
+            if not future.done():
+                future.set_result(embedding)
+
+
+embedding_batcher = EmbeddingBatcher(
+    model,
+    max_batch_size=settings.embedding.embedding_batch_size,
+    max_wait=settings.embedding.embedding_batch_wait_ms / 1000
+)
+
+
+async def embed_text_batched(text: str) -> torch.Tensor:
+    """
+    Embed a text together with the texts of other running jobs, see `EmbeddingBatcher`.
+
+    Args:
+        text (str): Text to be embedded.
+
+    Returns:
+        torch.Tensor: Tensor containing the embedding.
+    """
+    return await embedding_batcher.embed(text)
@@ -138,6 +138,19 @@ def update_track_embedding_and_duration(track_id: str, embedding_vector, track_d
         return {"error": str(e)}
 
 
+def get_sonic_embedded_track_ids():
+    """
+    Returns the ids of the tracks that have a sonic embedding, oldest first.
+    """
+    query = """
+    SELECT id FROM "Track" WHERE "sonicEmbeddingVector" IS NOT NULL ORDER BY "createdAt";
+    """
+
+    with conn.cursor() as cur:
+        cur.execute(query)
+        return [row[0] for row in cur.fetchall()]
+
+
 ALLOWED_RECORDS = ["Track", "Album", "Artist", "UserPreference", "Playlist"]
 
 def update_embedding(record_id: str, embedding_vector, record: str = None):
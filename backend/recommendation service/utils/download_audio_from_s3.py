@@ -1,3 +1,4 @@
+import json
 from io import BytesIO
 import librosa
 from libs.s3_client import client
@@ -43,3 +44,33 @@ def get_audio_duration(audio_stream: BytesIO) -> float:
     duration = librosa.get_duration(y=audio_data, sr=sr)
     
     return duration
+
+
+def download_track_analysis(bucket_name: str, object_key: str):
+    """
+    Download the analysis the media service wrote while transcoding an audio file: its
+    duration, loudness and waveform peaks, and a 48 kHz mono excerpt to embed.
+
+    Args:
+        bucket_name (str): The HLS bucket.
+        object_key (str): The key of the source audio, e.g. `music/<track id>`.
+    Returns:
+        tuple | None: The analysis dict and the excerpt as a WAV byte stream, or None when
+            the audio has not been transcoded with an analysis yet.
+    """
+    try:
+        response = client.get_object(Bucket=bucket_name, Key=f"{object_key}/manifest.json")
+    except client.exceptions.NoSuchKey:
+        return None
+
+    # the rendition, and the analysis with it, may be stored under a prefix shared by identical uploads
+    manifest = json.loads(response["Body"].read())
+    if not manifest.get("analysis"):
+        return None
+
+    prefix = manifest["prefix"]
+    response = client.get_object(Bucket=bucket_name, Key=f"{prefix}{manifest['analysis']}")
+    analysis = json.loads(response["Body"].read())
+
+    response = client.get_object(Bucket=bucket_name, Key=f"{prefix}{analysis['excerpt']['uri']}")
+    return analysis, BytesIO(response["Body"].read())
@@ -1,6 +1,15 @@
+"""
+Worker of the `embedding` queue.
+
+Usage (from the recommendation service directory):
+    python -m workers.embedding_worker reembed-audio             # queue a new sonic embedding of every track
+    python -m workers.embedding_worker reembed-audio --limit 100 --dry-run
+"""
+import argparse
 import asyncio
 import logging
-from bullmq import Worker
+from bullmq import Queue, Worker
+from libs.db.queries import get_sonic_embedded_track_ids
 from libs.redis import connection_url
 from workers.processes.embedding_processes import (
     process_audio_metadata_embedding_job,
@@ -14,6 +23,9 @@ from workers.processes.embedding_processes import (
 
 ALLOWED_JOB_EMBEDDING_TYPES = ["track", "track_audio", "album", "artist", "user_pref", "user_playlist", "search_query"]
 
+# BullMQ serves lower numbers first; unprioritized jobs, e.g. of new uploads, come before any
+REEMBED_PRIORITY = 10
+
 async def process_selector(job, token):
     """
     Selects and processes the appropriate embedding job based on the job data.
@@ -84,3 +96,48 @@ async def embedding_worker():
         print("Shutting down worker...")
         await worker.close()
         print("Worker shut down successfully.")
+
+
+async def reembed_audio(limit: int = None, dry_run: bool = False):
+    """
+    Queue a new sonic embedding of every track that has one. Vectors computed from the whole
+    track, before every embedding was computed from the same excerpt (see
+    `AudioEmbeddingConfig`), do not compare with the newer ones.
+    """
+    track_ids = get_sonic_embedded_track_ids()
+    if limit:
+        track_ids = track_ids[:limit]
+
+    print(f"{len(track_ids)} tracks to re-embed")
+    if dry_run:
+        for track_id in track_ids:
+            print(track_id)
+        return
+
+    queue = Queue("embedding", {"connection": connection_url})
+    try:
+        for track_id in track_ids:
+            await queue.add(
+                "embedding",
+                {"type": "track_audio", "track_id": track_id},
+                {"priority": REEMBED_PRIORITY, "removeOnFail": 1000}
+            )
+    finally:
+        await queue.close()
+    print(f"Queued {len(track_ids)} sonic embeddings on the embedding queue")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    reembed_parser = commands.add_parser("reembed-audio", help="queue a new sonic embedding of every track")
+    reembed_parser.add_argument("--limit", type=int, default=None)
+    reembed_parser.add_argument("--dry-run", action="store_true", help="only list the track IDs")
+    args = parser.parse_args()
+
+    if args.command == "reembed-audio":
+        asyncio.run(reembed_audio(limit=args.limit, dry_run=args.dry_run))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,11 @@
 import logging
-from io import BytesIO
 from libs.db.queries import update_embedding, get_full_track_details
 from utils.metadata_to_embedding_text import metadata_to_embedding_text
-from embeddings.data_embedder import embed_text
+from embeddings.data_embedder import embed_text_batched
 
 from config.config import settings
-from utils.download_audio_from_s3 import download_audio_from_s3, get_audio_duration
-from embeddings.audio_embedding import extract_audio_features
+from utils.download_audio_from_s3 import download_audio_from_s3, download_track_analysis
+from embeddings.audio_embedding import extract_audio_features, extract_track_features
 from libs.db.queries import get_track, update_track_embedding_and_duration
 
 
@@ -25,7 +24,7 @@ async def process_audio_metadata_embedding_job(job):
         embedding_text = metadata_to_embedding_text(track_details)
 
         # Generate the embedding vector by embedding the text
-        embedding_vector = embed_text(embedding_text).tolist()
+        embedding_vector = (await embed_text_batched(embedding_text)).tolist()
 
         update_embedding(track_id, embedding_vector, record="Track")
 
@@ -52,17 +51,19 @@ async def process_audio_embedding_job(job):
         # Extract object ID from the audio URL in the track data
         _, object_id = track.get("audioUrl", "").split(f"{settings.s3_storage.s3_bucket_name}/", 1)
 
-        audio_stream = download_audio_from_s3(settings.s3_storage.s3_bucket_name, object_id)
-
-        # Make a copy of the audio stream to avoid modifying the original stream
-        stream_copy = BytesIO(audio_stream.getvalue())
-        
-        # Get the audio duration using the stream copy
-        audio_duration = get_audio_duration(stream_copy)
-        del stream_copy  # Free the memory used by the copy
-
-  
-        features = extract_audio_features(audio_stream)
+        # The transcode of the media service analyses the track in the same decode: its exact
+        # duration and a 48 kHz mono excerpt, so the original is only decoded here for tracks
+        # transcoded before. Both paths embed the same excerpt of the track, see
+        # `AudioEmbeddingConfig`, so that every sonic vector compares with the others.
+        track_analysis = download_track_analysis(settings.s3_storage.hls_bucket_name, object_id)
+        if track_analysis:
+            analysis, audio_stream = track_analysis
+            audio_duration = analysis["duration"]
+            features = extract_audio_features(audio_stream)
+        else:
+            logging.info(f"[Job {job.id}] No analysis for track {track_id}, decoding the original")
+            audio_stream = download_audio_from_s3(settings.s3_storage.s3_bucket_name, object_id)
+            features, audio_duration = extract_track_features(audio_stream)
         del audio_stream
 
         update_track_embedding_and_duration(track_id, features, audio_duration)
@@ -88,7 +89,7 @@ async def process_album_embedding_job(job):
     if not album_metadata:
         return {"status": "no album metadata"}
     try:
-        embedding_vector = embed_text(album_metadata).tolist()
+        embedding_vector = (await embed_text_batched(album_metadata)).tolist()
         update_embedding(album_id, embedding_vector, record="Album")
 
         return {"status": "done", "data": embedding_vector}
@@ -108,7 +109,7 @@ async def process_artist_embedding_job(job):
     if not artist_metadata:
         return {"status": "no artist metadata"}
     try:
-        embedding_vector = embed_text(artist_metadata).tolist()
+        embedding_vector = (await embed_text_batched(artist_metadata)).tolist()
         update_embedding(artist_id, embedding_vector, record="Artist")
 
         return {"status": "done", "data": embedding_vector}
@@ -128,7 +129,7 @@ async def process_user_pref_embedding_job(job):
     if not user_metadata:
         return {"status": "no user metadata"}
     try:
-        embedding_vector = embed_text(user_metadata).tolist()
+        embedding_vector = (await embed_text_batched(user_metadata)).tolist()
         update_embedding(user_id, embedding_vector, record="UserPreference")
 
         return {"status": "done", "data": embedding_vector}
@@ -150,7 +151,7 @@ async def process_user_playlist_embedding_job(job):
         logging.error(f"[Job {job.id}] No playlist metadata found")
         return {"status": "no playlist metadata"}
     try:
-        embedding_vector = embed_text(playlist_metadata).tolist()
+        embedding_vector = (await embed_text_batched(playlist_metadata)).tolist()
         update_embedding(playlist_id, embedding_vector, record="Playlist")
 
         return {"status": "done", "data": embedding_vector}
@@ -167,7 +168,7 @@ async def process_search_query_embedding_job(job):
         logging.error(f"[Job {job.id}] No query text found")
         return {"status": "no query text"}
     try:
-        embedding_vector = embed_text(query_text).tolist()
+        embedding_vector = (await embed_text_batched(query_text)).tolist()
         return {"status": "done", "data": embedding_vector}
 
     except Exception as e: